@@ -27,59 +27,377 @@ Boston, MA 02110-1301, USA gnu@gnu.org
 
 '''
 
-import gnucash
-import gnucash_simple
 import json
+import argparse
 import atexit
-from functools import wraps
+import fcntl
+import hashlib
+import csv
+import bisect
+import calendar
+from functools import wraps, lru_cache
 import re
+import html
+import multiprocessing
 import sys
+import os
+import sqlite3
+import tempfile
+import time
+import threading
+import queue
+import asyncio
+import concurrent.futures
+import resource
+import tracemalloc
+import zlib
+import struct
+import ctypes
+import ctypes.util
+import select
+import subprocess
+
+try:
+    from urllib.request import pathname2url
+    from urllib.parse import urlsplit, parse_qs
+except ImportError:
+    from urllib import pathname2url
+    from urlparse import urlsplit, parse_qs
 
 # to resolve bug in http://stackoverflow.com/questions/2427240/thread-safe-equivalent-to-pythons-time-strptime
 import _strptime
 import datetime
 
-from decimal import Decimal
-
-from gnucash.gnucash_business import Vendor, Bill, Entry, GncNumeric, \
-    Customer, Invoice, Split, Account, Transaction
-
-from gnucash.gnucash_business import \
-    GNC_AMT_TYPE_VALUE, \
-    GNC_AMT_TYPE_PERCENT
-
-from gnucash import \
-    QOF_QUERY_AND, \
-    QOF_QUERY_OR, \
-    QOF_QUERY_NAND, \
-    QOF_QUERY_NOR, \
-    QOF_QUERY_XOR
-
-from gnucash import \
-    QOF_STRING_MATCH_NORMAL, \
-    QOF_STRING_MATCH_CASEINSENSITIVE
-
-from gnucash import \
-    QOF_COMPARE_LT, \
-    QOF_COMPARE_LTE, \
-    QOF_COMPARE_EQUAL, \
-    QOF_COMPARE_GT, \
-    QOF_COMPARE_GTE, \
-    QOF_COMPARE_NEQ
-
-from gnucash import \
-    INVOICE_TYPE
-
-from gnucash import \
-    INVOICE_IS_PAID
-   
-from gnucash.gnucash_core_c import \
-    GNC_INVOICE_CUST_INVOICE, \
-    GNC_INVOICE_VEND_INVOICE, \
-    INVOICE_IS_POSTED
+from decimal import Decimal, ROUND_HALF_UP
+
+# The bindings are only needed for the live book, commands run against a
+# --snapshot work without them
+try:
+    import gnucash
+    import gnucash_simple
+
+    from gnucash.gnucash_business import Vendor, Bill, Entry, GncNumeric, \
+        Customer, Invoice, Split, Account, Transaction, Job
+
+    from gnucash.gnucash_business import \
+        GNC_AMT_TYPE_VALUE, \
+        GNC_AMT_TYPE_PERCENT
+
+    from gnucash import \
+        QOF_QUERY_AND, \
+        QOF_QUERY_OR, \
+        QOF_QUERY_NAND, \
+        QOF_QUERY_NOR, \
+        QOF_QUERY_XOR
+
+    from gnucash import \
+        QOF_STRING_MATCH_NORMAL, \
+        QOF_STRING_MATCH_CASEINSENSITIVE
+
+    from gnucash import \
+        QOF_COMPARE_LT, \
+        QOF_COMPARE_LTE, \
+        QOF_COMPARE_EQUAL, \
+        QOF_COMPARE_GT, \
+        QOF_COMPARE_GTE, \
+        QOF_COMPARE_NEQ
+
+    from gnucash import \
+        INVOICE_TYPE
+
+    from gnucash import \
+        INVOICE_IS_PAID
+
+    from gnucash.gnucash_core_c import \
+        GNC_INVOICE_CUST_INVOICE, \
+        GNC_INVOICE_VEND_INVOICE, \
+        INVOICE_IS_POSTED
+
+    from gnucash.gnucash_core_c import \
+        ACCT_TYPE_INCOME, \
+        ACCT_TYPE_EXPENSE
+except ImportError:
+    gnucash = None
+    gnucash_simple = None
+
+    ACCT_TYPE_INCOME = 8
+    ACCT_TYPE_EXPENSE = 9
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
 
 # define globals for compatiblity with Gnucash rest
 session = None
+session_connection_string = None
+save_scheduler = None
+journal = None
+changes = None
+
+# The book's fingerprint before the changes not yet saved in this session
+session_base_fingerprint = None
+
+# Called with (connection_string, book) after each save so sidecars can
+# catch up with the changes, and with (connection_string, saved_fingerprint,
+# fingerprint) once the session ends and the book has settled
+save_hooks = []
+end_hooks = []
+
+class App(object):
+    # start_session falls back to app.connection_string when called without
+    # parameters, which is how the HTTP server's engine opens the book
+    connection_string = ''
+
+app = App()
+
+# Mutating operations by name, used to replay the journal
+journaled_operations = {}
+
+class Journal(object):
+
+    # An append only file of mutating operations, each fsync'd before the
+    # operation is applied so unsaved work survives the process dying. A
+    # lock file beside it is held for the life of the write session, so
+    # only one live writer ever appends to or replays the journal. The lock
+    # is on a separate file as rewrite replaces the journal's inode
+
+    def __init__(self, path):
+        self.path = path
+        self.lock_fd = os.open(path + '.lock', os.O_WRONLY | os.O_CREAT, 0o600)
+
+        try:
+            fcntl.flock(self.lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(self.lock_fd)
+            raise
+
+        self.fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+
+    def append(self, name, args, base):
+
+        # Returns the offset the entry was written at for discard
+        line = json.dumps({'op': name, 'args': list(args), 'base': base},
+            default=str) + '\n'
+
+        offset = os.lseek(self.fd, 0, os.SEEK_END)
+
+        os.write(self.fd, line.encode('utf-8'))
+        os.fsync(self.fd)
+
+        return offset
+
+    def discard(self, offset):
+
+        # Drops the entries from offset on
+        os.ftruncate(self.fd, offset)
+        os.fsync(self.fd)
+
+    def read(self):
+
+        entries = []
+
+        with open(self.path, 'r') as journal_file:
+            for line in journal_file:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    # A torn final line was never fsync'd, so its operation
+                    # was never applied either
+                    break
+
+        return entries
+
+    def rewrite(self, entries):
+
+        data = ''.join(json.dumps(entry, default=str) + '\n' for entry in entries)
+
+        os.close(self.fd)
+        write_file_atomic(self.path, data.encode('utf-8'))
+        self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        os.fsync(self.fd)
+
+    def truncate(self):
+
+        os.ftruncate(self.fd, 0)
+        os.fsync(self.fd)
+
+    def close(self):
+
+        os.close(self.fd)
+        os.close(self.lock_fd)
+
+def open_journal(connection_string):
+
+    # None when another live writer, such as the HTTP server, holds the
+    # journal. Its entries are that writer's unsaved work, so they mustn't
+    # be replayed here and this session's operations go unjournaled
+    try:
+        return Journal(sidecar_path(connection_string, 'journal'))
+    except BlockingIOError:
+        return None
+
+def close_journal(discard):
+
+    global journal
+
+    if journal is None:
+        return
+
+    if discard:
+        journal.truncate()
+
+    journal.close()
+    journal = None
+
+# A process that exits with a write session still open abandoned it after
+# an error, so its operations were never saved and must not be replayed
+# into a later session. A process that dies never gets here, which is the
+# case the journal is for
+atexit.register(close_journal, True)
+
+def journaled(name):
+
+    def decorator(func):
+
+        journaled_operations[name] = func
+
+        @wraps(func)
+        def wrapper(book, *args):
+            offset = log_operation(book, name, args)
+            record_changes_before(book, name, args)
+
+            try:
+                result = func(book, *args)
+            except Exception:
+                # Operations check their arguments before changing
+                # anything, so one that raised has nothing to replay. An
+                # unexpected exception would only raise again on replay
+                if offset is not None and journal is not None:
+                    journal.discard(offset)
+                raise
+
+            record_changes(book, name, args, result)
+            return result
+
+        return wrapper
+
+    return decorator
+
+class ChangeSet(object):
+
+    # What the operations in a write session touched, so sidecars can be
+    # updated for just those entities after a save
+
+    def __init__(self):
+        self.transactions = set()
+        self.invoices = set()
+        self.accounts = {}
+        self.everything = False
+
+    def touch_account(self, guid, date):
+
+        # Keep the earliest date each account was touched from
+        if guid not in self.accounts or date < self.accounts[guid]:
+            self.accounts[guid] = date
+
+    def touch_transaction(self, transaction):
+
+        date = transaction.GetDate().strftime("%Y-%m-%d")
+
+        for split in transaction.GetSplitList():
+            self.touch_account(split.GetAccount().GetGUID().to_string(), date)
+
+def record_changes_before(book, name, args):
+
+    # Edits and deletes can move a transaction out of accounts and dates,
+    # which are only known before the operation runs
+    if changes is None or name not in ['edit_transaction', 'delete_transaction']:
+        return
+
+    guid = gnucash.gnucash_core.GUID()
+    gnucash.gnucash_core.GUIDString(args[0], guid)
+
+    transaction = guid.TransLookup(book)
+
+    if transaction is not None:
+        changes.touch_transaction(transaction)
+
+def record_changes(book, name, args, result):
+
+    if changes is None:
+        return
+
+    if name in ['add_transaction', 'edit_transaction']:
+        changes.transactions.add(result['guid'])
+    elif name == 'delete_transaction':
+        changes.transactions.add(args[0])
+    elif name in ['add_invoice', 'update_invoice']:
+        changes.invoices.add(('invoice', result['id']))
+    elif name in ['post_invoice', 'pay_invoice', 'add_entry']:
+        changes.invoices.add(('invoice', args[0]))
+    elif name in ['add_bill', 'update_bill']:
+        changes.invoices.add(('bill', result['id']))
+    elif name in ['pay_bill', 'add_bill_entry']:
+        changes.invoices.add(('bill', args[0]))
+    elif name == 'reconcile_split':
+        changes.transactions.add(result['transaction_guid'])
+    elif name in ['add_customer', 'update_customer', 'add_vendor', 'add_account']:
+        pass
+    else:
+        # Anything we can't attribute means sidecars need a full pass
+        changes.everything = True
+
+def log_operation(book, name, args):
+
+    # Each entry records the book's fingerprint before the operation so a
+    # replay can tell which operations already reached the book
+    if journal is not None:
+        return journal.append(name, args, book_fingerprint(session_connection_string))
+
+    return None
+
+def changed_invoices(book, changes):
+
+    # Resolves the invoices and bills in a change set, with one query per
+    # kind rather than a query per ID once there are several
+    results = []
+
+    for kind, lookup, get_all in [
+        ('invoice', get_gnucash_invoice, get_gnucash_invoices),
+        ('bill', get_gnucash_bill, get_gnucash_bills)]:
+
+        ids = [id for invoice_kind, id in changes.invoices if invoice_kind == kind]
+
+        if len(ids) == 1:
+            invoice = lookup(book, ids[0])
+
+            if invoice is not None:
+                results.append((kind, invoice))
+        elif len(ids) > 1:
+            ids = set(ids)
+
+            for invoice in get_all(book, {}):
+                if invoice.GetID() in ids:
+                    results.append((kind, invoice))
+
+    return results
+
+def changed_transactions(book, changes):
+
+    # Returns the transactions in a change set that still exist
+    transactions = []
+
+    for transaction_guid in changes.transactions:
+        guid = gnucash.gnucash_core.GUID()
+        gnucash.gnucash_core.GUIDString(transaction_guid, guid)
+
+        transaction = guid.TransLookup(book)
+
+        if transaction is not None:
+            transactions.append(transaction)
+
+    return transactions
 
 def get_customers(book):
 
@@ -154,8 +472,18 @@ def get_account(book, guid):
 
 def get_account_splits(book, guid, date_posted_from, date_posted_to):
 
+    splits = []
+
+    for split in get_gnucash_splits(book, guid, date_posted_from, date_posted_to):
+        splits.append(gnucash_simple.splitToDict(split,
+            ['account', 'transaction', 'other_split']))
+
+    return splits
+
+def get_gnucash_splits(book, guid, date_posted_from, date_posted_to):
+
+    # guid may be None to return the splits for every account
     account_guid = gnucash.gnucash_core.GUID() 
-    gnucash.gnucash_core.GUIDString(guid, account_guid)
 
     query = gnucash.Query()
     query.search_for('Split')
@@ -189,8 +517,12 @@ def get_account_splits(book, guid, date_posted_from, date_posted_to):
                 'The date posted to must be provided in the form YYYY-MM-DD',
                 {'field': 'date_posted_from'})
 
+        # Dates posted are stored part way through the day, so the range is
+        # half open at the midnight after date_posted_to to take in all of
+        # that day. Adjacent ranges then meet without a gap or an overlap
         pred_data = gnucash.gnucash_core.QueryDatePredicate(
-            QOF_COMPARE_LTE, QOF_DATE_MATCH_NORMAL, date_posted_to.date())
+            QOF_COMPARE_LT, QOF_DATE_MATCH_NORMAL,
+            (date_posted_to + datetime.timedelta(days=1)).date())
         param_list = [SPLIT_TRANS, TRANS_DATE_POSTED]
         query.add_term(param_list, pred_data, QOF_QUERY_AND)
     
@@ -205,9 +537,7 @@ def get_account_splits(book, guid, date_posted_from, date_posted_to):
     splits = []
 
     for split in query.run():
-        splits.append(gnucash_simple.splitToDict(
-            gnucash.gnucash_business.Split(instance=split),
-            ['account', 'transaction', 'other_split']))
+        splits.append(gnucash.gnucash_business.Split(instance=split))
 
     query.destroy()
 
@@ -216,6 +546,15 @@ def get_account_splits(book, guid, date_posted_from, date_posted_to):
 # Might be a good idea to pass though these options as properties instead
 def get_invoices(book, properties):
 
+    invoices = []
+
+    for invoice in get_gnucash_invoices(book, properties):
+        invoices.append(gnucash_simple.invoiceToDict(invoice))
+
+    return invoices
+
+def get_gnucash_invoices(book, properties):
+
     defaults = [
         'customer',
         'is_posted',
@@ -223,6 +562,7 @@ def get_invoices(book, properties):
         'is_active',
         'date_opened_from',
         'date_opened_to',
+        'date_opened_before',
         'date_due_to',
         'date_due_from',
         'date_posted_to',
@@ -310,6 +650,18 @@ def get_invoices(book, properties):
             QOF_COMPARE_LTE, 2, properties['date_opened_to'].date())
         query.add_term(['date_opened'], pred_data, QOF_QUERY_AND)
 
+    if properties['date_opened_before'] is not None:
+        try:
+            properties['date_opened_before'] = datetime.datetime.strptime(properties['date_opened_before'], "%Y-%m-%d")
+        except ValueError:
+            raise Error('InvalidDateOpenedBefore',
+                'The date opened before must be provided in the form YYYY-MM-DD',
+                {'field': 'date_opened_before'})
+
+        pred_data = gnucash.gnucash_core.QueryDatePredicate(
+            QOF_COMPARE_LT, 2, properties['date_opened_before'].date())
+        query.add_term(['date_opened'], pred_data, QOF_QUERY_AND)
+
     if properties['date_posted_from'] is not None:
         try:
             properties['date_posted_from'] = datetime.datetime.strptime(properties['date_posted_from'], "%Y-%m-%d")
@@ -342,8 +694,7 @@ def get_invoices(book, properties):
     invoices = []
 
     for result in query.run():
-        invoices.append(gnucash_simple.invoiceToDict(
-            gnucash.gnucash_business.Invoice(instance=result)))
+        invoices.append(gnucash.gnucash_business.Invoice(instance=result))
 
     query.destroy()
 
@@ -351,9 +702,19 @@ def get_invoices(book, properties):
 
 def get_bills(book, properties):
 
+    bills = []
+
+    for bill in get_gnucash_bills(book, properties):
+        bills.append(gnucash_simple.billToDict(bill))
+
+    return bills
+
+def get_gnucash_bills(book, properties):
+
     # define defaults and set to None
     defaults = [
         'customer',
+        'is_posted',
         'is_paid',
         'is_active',
         'date_opened_from',
@@ -372,6 +733,11 @@ def get_bills(book, properties):
     query.search_for('gncInvoice')
     query.set_book(book)
 
+    if properties['is_posted'] == 0:
+        query.add_boolean_match([INVOICE_IS_POSTED], False, QOF_QUERY_AND)
+    elif properties['is_posted'] == 1:
+        query.add_boolean_match([INVOICE_IS_POSTED], True, QOF_QUERY_AND)
+
     if properties['is_paid'] == 0:
         query.add_boolean_match([INVOICE_IS_PAID], False, QOF_QUERY_AND)
     elif properties['is_paid'] == 1:
@@ -473,8 +839,7 @@ def get_bills(book, properties):
     bills = []
 
     for result in query.run():
-        bills.append(gnucash_simple.billToDict(
-            gnucash.gnucash_business.Bill(instance=result)))
+        bills.append(gnucash.gnucash_business.Bill(instance=result))
 
     query.destroy()
 
@@ -539,8 +904,14 @@ def get_gnucash_bill(book ,id):
 
 def get_invoice(book, id):
 
-    return gnucash_simple.invoiceToDict(get_gnucash_invoice(book, id))
+    invoice = get_gnucash_invoice(book, id)
+
+    if invoice is None:
+        return None
+    else:
+        return gnucash_simple.invoiceToDict(invoice)
 
+@journaled('pay_invoice')
 def pay_invoice(book, id, transaction_guid, posted_account_guid, transfer_account_guid,
     payment_date, memo, num, auto_pay):
 
@@ -580,1178 +951,7579 @@ def pay_invoice(book, id, transaction_guid, posted_account_guid, transfer_accoun
         raise Error('NoTransferAccount', 'No account exists with this GUID',
             {'field': 'transfer_account_guid'})
 
-    invoice.ApplyPayment(transaction, transfer_account, invoice.GetTotal(), GncNumeric(0),
-        payment_date, memo, num)
+    pay_gnucash_invoice(invoice, transaction, transfer_account, payment_date,
+        memo, num)
 
-    return gnucash_simple.invoiceToDict(invoice)    
+    return gnucash_simple.invoiceToDict(invoice)
 
-def pay_bill(book, id, posted_account_guid, transfer_account_guid, payment_date,
-    memo, num, auto_pay):
+def pay_gnucash_invoice(invoice, transaction, transfer_account, payment_date,
+    memo, num):
 
-    # The posted_account_guid is not actually used in bill.ApplyPayment - why is it on the payment screen?
+    # Pays what's left on the invoice, which is less than the total once it
+    # has been partly paid
+    invoice.ApplyPayment(transaction, transfer_account, invoice_outstanding(invoice),
+        GncNumeric(0), payment_date, memo, num)
 
-    bill = get_gnucash_bill(book, id)
+def invoice_outstanding(invoice):
 
-    if bill is None:
-        raise Error('NoBill', 'A bill with this ID does not exist',
-            {'field': 'id'})
+    # The balance of the posted lot, or the total before it's posted
+    lot = invoice.GetPostedLot()
 
-    try:
-        payment_date = datetime.datetime.strptime(payment_date, "%Y-%m-%d")
-    except ValueError:
-        raise Error('InvalidPaymentDate',
-            'The payment date must be provided in the form YYYY-MM-DD',
-            {'field': 'payment_date'})
+    if lot is None:
+        return invoice.GetTotal()
 
-    account_guid = gnucash.gnucash_core.GUID() 
-    gnucash.gnucash_core.GUIDString(transfer_account_guid, account_guid)
+    return lot.get_balance()
 
-    transfer_account = account_guid.AccountLookup(book)
+class PaymentMatcher(object):
 
-    if transfer_account is None:
-        raise Error('NoTransferAccount', 'No account exists with this GUID',
-            {'field': 'transfer_account_guid'})
+    # Hash indexes of open posted invoices so each statement line is matched
+    # with a few dictionary probes rather than a scan of the receivables
 
-    # We pay the negitive total as the bill as this seemed to cause issues
-    # with the split not being set correctly and not being marked as paid
-    bill.ApplyPayment(None, transfer_account, bill.GetTotal().neg(), GncNumeric(0),
-        payment_date, memo, num)
+    def __init__(self, invoices):
+        self.by_id = {}
+        self.by_total = {}
+        self.by_customer = {}
+        self.paid = set()
 
-    return gnucash_simple.billToDict(bill)
+        self.outstanding = {}
 
-def get_bill(book, id):
+        for invoice in invoices:
+            owner = invoice.GetOwner()
 
-    return gnucash_simple.billToDict(get_gnucash_bill(book, id))
+            # Matched on what's left to pay rather than the total, so partly
+            # paid invoices match their remaining amount
+            outstanding = gnc_numeric_to_decimal(invoice_outstanding(invoice))
 
-def add_vendor(book, id, currency_mnumonic, name, contact, address_line_1,
-    address_line_2, address_line_3, address_line_4, phone, fax, email):
+            self.outstanding[invoice.GetID()] = outstanding
+            self.by_id[invoice.GetID().lower()] = invoice
+            self.by_total.setdefault(outstanding, []).append(invoice)
 
-    if name == '':
-        raise Error('NoVendorName', 'A name must be entered for this company',
-            {'field': 'name'})
+            for key in [owner.GetID(), owner.GetName()]:
+                if key:
+                    self.by_customer.setdefault(key.lower(), []).append(invoice)
 
-    if (address_line_1 == ''
-        and address_line_2 == ''
-        and address_line_3 == ''
-        and address_line_4 == ''):
-        raise Error('NoVendorAddress',
-            'An address must be entered for this company',
-            {'field': 'address'})
+    def open(self, invoices):
+        return [invoice for invoice in invoices if invoice.GetID() not in self.paid]
 
-    commod_table = book.get_table()
-    currency = commod_table.lookup('CURRENCY', currency_mnumonic)
+    def match(self, amount, reference, customer):
 
-    if currency is None:
-        raise Error('InvalidVendorCurrency',
-            'A valid currency must be supplied for this vendor',
-            {'field': 'currency'})
+        # Returns (invoice, reason), invoice is None when the line is
+        # ambiguous or unmatched and reason says which
 
-    if id is None:
-        id = book.VendorNextID()
+        tokens = re.findall(r'[\w\-/.]+', reference.lower())
 
-    vendor = Vendor(book, id, currency, name)
+        referenced = []
 
-    address = vendor.GetAddr()
-    address.SetName(contact)
-    address.SetAddr1(address_line_1)
-    address.SetAddr2(address_line_2)
-    address.SetAddr3(address_line_3)
-    address.SetAddr4(address_line_4)
-    address.SetPhone(phone)
-    address.SetFax(fax)
-    address.SetEmail(email)
+        for token in tokens:
+            token = token.strip('.')
 
-    return gnucash_simple.vendorToDict(vendor)
+            if token in self.by_id and self.by_id[token] not in referenced:
+                referenced.append(self.by_id[token])
 
-def add_customer(book, id, currency_mnumonic, name, contact, address_line_1,
-    address_line_2, address_line_3, address_line_4, phone, fax, email):
+        # A reference to an invoice an earlier line paid is a duplicate
+        # payment, not one to match on amount alone
+        if referenced and not self.open(referenced):
+            return None, 'unmatched: already paid invoice ' + ', '.join(
+                invoice.GetID() for invoice in referenced)
 
-    if name == '':
-        raise Error('NoCustomerName',
-            'A name must be entered for this company', {'field': 'name'})
+        referenced = self.open(referenced)
 
-    if (address_line_1 == ''
-        and address_line_2 == ''
-        and address_line_3 == ''
-        and address_line_4 == ''):
-        raise Error('NoCustomerAddress',
-            'An address must be entered for this company',
-            {'field': 'address'})
+        if len(referenced) > 1:
+            return None, 'ambiguous: references invoices ' + ', '.join(
+                invoice.GetID() for invoice in referenced)
+        elif len(referenced) == 1:
+            invoice = referenced[0]
 
-    commod_table = book.get_table()
-    currency = commod_table.lookup('CURRENCY', currency_mnumonic)
+            if self.outstanding[invoice.GetID()] != amount:
+                return None, 'ambiguous: amount does not match invoice ' + invoice.GetID()
 
-    if currency is None:
-        raise Error('InvalidCustomerCurrency',
-            'A valid currency must be supplied for this customer',
-            {'field': 'currency'})
+            return invoice, 'reference'
 
-    if id is None:
-        id = book.CustomerNextID()
+        candidates = self.open(self.by_total.get(amount, []))
 
-    customer = Customer(book, id, currency, name)
+        if len(candidates) == 0:
+            return None, 'unmatched'
+        elif len(candidates) == 1:
+            return candidates[0], 'amount'
 
-    address = customer.GetAddr()
-    address.SetName(contact)
-    address.SetAddr1(address_line_1)
-    address.SetAddr2(address_line_2)
-    address.SetAddr3(address_line_3)
-    address.SetAddr4(address_line_4)
-    address.SetPhone(phone)
-    address.SetFax(fax)
-    address.SetEmail(email)
+        # Several open invoices share the amount, narrow them by customer
+        owners = set()
 
-    return gnucash_simple.customerToDict(customer)
+        for key in [customer.lower()] + tokens:
+            for invoice in self.by_customer.get(key, []):
+                owners.add(invoice.GetID())
 
-def update_customer(book, id, name, contact, address_line_1, address_line_2,
-    address_line_3, address_line_4, phone, fax, email):
+        narrowed = [invoice for invoice in candidates if invoice.GetID() in owners]
 
-    customer = book.CustomerLookupByID(id)
+        if len(narrowed) == 1:
+            return narrowed[0], 'amount and customer'
 
-    if customer is None:
-        raise Error('NoCustomer', 'A customer with this ID does not exist',
-            {'field': 'id'})
+        return None, 'ambiguous: amount matches invoices ' + ', '.join(
+            invoice.GetID() for invoice in (narrowed or candidates))
 
-    if name == '':
-        raise Error('NoCustomerName',
-            'A name must be entered for this company', {'field': 'name'})
+def read_statement(path):
 
-    if (address_line_1 == ''
-        and address_line_2 == ''
-        and address_line_3 == ''
-        and address_line_4 == ''):
-        raise Error('NoCustomerAddress',
-            'An address must be entered for this company',
-            {'field': 'address'})
+    # Statement lines need a date and an amount, with the reference taken
+    # from a reference or description column
+    try:
+        with open(path, 'r') as statement_file:
+            rows = list(csv.DictReader(statement_file))
+    except (IOError, OSError):
+        raise Error('InvalidStatement', 'The statement file could not be read',
+            {'field': 'csv'})
 
-    customer.SetName(name)
+    lines = []
 
-    address = customer.GetAddr()
-    address.SetName(contact)
-    address.SetAddr1(address_line_1)
-    address.SetAddr2(address_line_2)
-    address.SetAddr3(address_line_3)
-    address.SetAddr4(address_line_4)
-    address.SetPhone(phone)
-    address.SetFax(fax)
-    address.SetEmail(email)
+    for number, row in enumerate(rows, 2):
+        row = dict((str(key).strip().lower(), (value or '').strip())
+            for key, value in row.items() if key is not None)
 
-    return gnucash_simple.customerToDict(customer)
+        line = {
+            'line': number,
+            'date': row.get('date', ''),
+            'amount': row.get('amount', ''),
+            'reference': row.get('reference', row.get('description', '')),
+            'customer': row.get('customer', '')
+        }
 
-def add_invoice(book, id, customer_id, currency_mnumonic, date_opened, notes):
+        lines.append(line)
 
-    # Check customer ID is provided to avoid "CRIT <qof> qof_query_string_predicate: assertion '*str != '\0'' failed" error
-    if customer_id == '':
-        raise Error('NoCustomer',
-            'A customer ID must be provided', {'field': 'id'})
+    return lines
 
-    customer = book.CustomerLookupByID(customer_id)
+def match_payments(book, lines, transfer_account_guid, apply):
 
-    if customer is None:
-        raise Error('NoCustomer',
-            'A customer with this ID does not exist', {'field': 'id'})
+    account_guid = gnucash.gnucash_core.GUID()
+    gnucash.gnucash_core.GUIDString(transfer_account_guid, account_guid)
 
-    if id is None:
-        id = book.InvoiceNextID(customer)
+    transfer_account = account_guid.AccountLookup(book)
 
-    try:
-        date_opened = datetime.datetime.strptime(date_opened, "%Y-%m-%d")
-    except ValueError:
-        raise Error('InvalidDateOpened',
-            'The date opened must be provided in the form YYYY-MM-DD',
-            {'field': 'date_opened'})
+    if transfer_account is None:
+        raise Error('NoTransferAccount', 'No account exists with this GUID',
+            {'field': 'transfer_account_guid'})
 
-    if currency_mnumonic is None:
-        currency_mnumonic = customer.GetCurrency().get_mnemonic()
+    matcher = PaymentMatcher(get_gnucash_invoices(book, {'is_posted': 1, 'is_paid': 0}))
 
-    commod_table = book.get_table()
-    currency = commod_table.lookup('CURRENCY', currency_mnumonic)
+    results = {'matched': [], 'ambiguous': [], 'unmatched': []}
 
-    if currency is None:
-        raise Error('InvalidInvoiceCurrency',
-            'A valid currency must be supplied for this invoice',
-            {'field': 'currency'})
-    elif currency.get_mnemonic() != customer.GetCurrency().get_mnemonic():
-        # Does Gnucash actually enforce this?
-        raise Error('MismatchedInvoiceCurrency',
-            'The currency of this invoice does not match the customer',
-            {'field': 'currency'})
+    for line in lines:
 
-    invoice = Invoice(book, id, currency, customer, date_opened.date())
+        try:
+            payment_date = datetime.datetime.strptime(line['date'], "%Y-%m-%d")
+        except ValueError:
+            line['reason'] = 'unmatched: the date must be in the form YYYY-MM-DD'
+            results['unmatched'].append(line)
+            continue
 
-    invoice.SetNotes(notes)
+        try:
+            amount = Decimal(line['amount']).quantize(Decimal('.01'))
+        except ArithmeticError:
+            line['reason'] = 'unmatched: the amount is not valid'
+            results['unmatched'].append(line)
+            continue
 
-    return gnucash_simple.invoiceToDict(invoice)
+        invoice, reason = matcher.match(amount, line['reference'], line['customer'])
 
-def update_invoice(book, id, customer_id, currency_mnumonic, date_opened,
-    notes, posted, posted_account_guid, posted_date, due_date, posted_memo,
-    posted_accumulatesplits, posted_autopay):
+        line['reason'] = reason
 
-    invoice = get_gnucash_invoice(book, id)
+        if invoice is None:
+            results[reason.split(':')[0]].append(line)
+            continue
 
-    if invoice is None:
-        raise Error('NoInvoice',
-            'An invoice with this ID does not exist',
-            {'field': 'id'})
+        line['invoice'] = invoice.GetID()
+        matcher.paid.add(invoice.GetID())
 
-    customer = book.CustomerLookupByID(customer_id)
+        if apply:
+            log_operation(book, 'pay_invoice', [invoice.GetID(), '', '',
+                transfer_account_guid, line['date'], line['reference'], '', False])
 
-    if customer is None:
-        raise Error('NoCustomer', 'A customer with this ID does not exist',
-            {'field': 'customer_id'})
+            pay_gnucash_invoice(invoice, None, transfer_account, payment_date,
+                line['reference'], '')
 
-    try:
-        date_opened = datetime.datetime.strptime(date_opened, "%Y-%m-%d")
-    except ValueError:
-        raise Error('InvalidDateOpened',
-            'The date opened must be provided in the form YYYY-MM-DD',
-            {'field': 'date_opened'})
+            record_changes(book, 'pay_invoice', [invoice.GetID()], None)
 
-    if posted_date == '':
-        if posted == 1:
-            raise Error('NoDatePosted',
-                'The date posted must be supplied when posted=1',
-                {'field': 'date_posted'})
-    else:
-        try:
-            posted_date = datetime.datetime.strptime(posted_date, "%Y-%m-%d")
-        except ValueError:
-            raise Error('InvalidDatePosted',
-                'The date posted must be provided in the form YYYY-MM-DD',
-                {'field': 'posted_date'})
+        results['matched'].append(line)
 
-    if due_date == '':
-        if posted == 1:
-            raise Error('NoDateDue',
-                'The due date must be supplied when posted=1',
-                {'field': 'due_date'})
-    else:
-        try:
-            due_date = datetime.datetime.strptime(due_date, "%Y-%m-%d")
-        except ValueError:
-            raise Error('InvalidDateDue',
-                'The due date must be provided in the form YYYY-MM-DD',
-                {'field': 'due_date'})
+    return results
 
-    if posted_account_guid == '':
-        if posted == 1:
-            raise Error('NoPostedAccountGuid',
-                'The posted account GUID must be supplied when posted=1',
-                {'field': 'posted_account_guid'})
-    else:
-        guid = gnucash.gnucash_core.GUID() 
-        gnucash.gnucash_core.GUIDString(posted_account_guid, guid)
+RECONCILE_STATES = {'cleared': 'c', 'reconciled': 'y'}
 
-        posted_account = guid.AccountLookup(book)
+@journaled('reconcile_split')
+def reconcile_split(book, split_guid, state):
 
-        if posted_account is None:
-            raise Error('NoAccount',
-                'No account exists with the posted account GUID',
-                {'field': 'posted_account_guid'})
+    guid = gnucash.gnucash_core.GUID()
+    gnucash.gnucash_core.GUIDString(split_guid, guid)
 
-    invoice.SetOwner(customer)
-    invoice.SetDateOpened(date_opened)
-    invoice.SetNotes(notes)
+    split = guid.SplitLookup(book)
 
-    # post if currently unposted and posted=1
-    if ((invoice.GetDatePosted() is None or invoice.GetDatePosted().strftime("%Y-%m-%d") == '1970-01-01') and posted == 1):
-        invoice.PostToAccount(posted_account, posted_date, due_date,
-            posted_memo, posted_accumulatesplits, posted_autopay)
+    if split is None:
+        raise Error('InvalidSplitGuid', 'No split exists with this GUID',
+            {'field': 'guid'})
 
-    return gnucash_simple.invoiceToDict(invoice)
+    set_split_reconcile(split, state)
 
-def update_bill(book, id, vendor_id, currency_mnumonic, date_opened, notes,
-    posted, posted_account_guid, posted_date, due_date, posted_memo,
-    posted_accumulatesplits, posted_autopay):
+    return {'guid': split_guid,
+        'transaction_guid': split.GetParent().GetGUID().to_string(),
+        'reconcile': state}
 
-    bill = get_gnucash_bill(book, id)
+def set_split_reconcile(split, state):
 
-    if bill is None:
-        raise Error('NoBill', 'A bill with this ID does not exist',
-            {'field': 'id'})
+    transaction = split.GetParent()
 
-    vendor = book.VendorLookupByID(vendor_id)
+    transaction.BeginEdit()
+    split.SetReconcile(state)
 
-    if vendor is None:
-        raise Error('NoVendor',
-            'A vendor with this ID does not exist',
-            {'field': 'vendor_id'})
+    if state == 'y':
+        split.SetDateReconciledSecs(int(time.time()))
 
-    try:
-        date_opened = datetime.datetime.strptime(date_opened, "%Y-%m-%d")
-    except ValueError:
-        raise Error('InvalidDateOpened',
-            'The date opened must be provided in the form YYYY-MM-DD',
-            {'field': 'date_opened'})
+    transaction.CommitEdit()
 
-    if posted_date == '':
-        if posted == 1:
-            raise Error('NoDatePosted',
-                'The date posted must be supplied when posted=1',
-                {'field': 'date_posted'})
-    else:
+def reconcile_matches(lines, splits, tolerance_days):
+
+    # Both sides are sorted by (amount, date) and walked together, so each
+    # statement line is only compared with the splits of the same amount
+    # within the window rather than every split in the account. lines and
+    # splits are (amount, date, item) tuples, returns the matched pairs
+    # and the leftovers on each side
+    lines = sorted(lines, key=lambda line: (line[0], line[1]))
+    splits = sorted(splits, key=lambda split: (split[0], split[1]))
+
+    window = datetime.timedelta(days=tolerance_days)
+
+    matched = []
+    unmatched_lines = []
+    unmatched_splits = []
+
+    i = 0
+    j = 0
+
+    while i < len(lines) and j < len(splits):
+        line_amount, line_date, line = lines[i]
+        split_amount, split_date, split = splits[j]
+
+        if line_amount < split_amount:
+            unmatched_lines.append(line)
+            i += 1
+        elif split_amount < line_amount:
+            unmatched_splits.append(split)
+            j += 1
+        elif line_date < split_date - window:
+            unmatched_lines.append(line)
+            i += 1
+        elif split_date < line_date - window:
+            unmatched_splits.append(split)
+            j += 1
+        else:
+            matched.append((line, split))
+            i += 1
+            j += 1
+
+    unmatched_lines.extend(line for amount, date, line in lines[i:])
+    unmatched_splits.extend(split for amount, date, split in splits[j:])
+
+    return matched, unmatched_lines, unmatched_splits
+
+def reconcile_account(book, account_guid, lines, tolerance_days, state, apply):
+
+    # An unknown account would otherwise just match nothing
+    if account_guid == '':
+        raise Error('NoAccount', 'No account exists with this name',
+            {'field': 'account'})
+
+    results = {'matched': [], 'unmatched_lines': [], 'unmatched_splits': []}
+
+    statement = []
+
+    for line in lines:
         try:
-            posted_date = datetime.datetime.strptime(posted_date, "%Y-%m-%d")
+            date = datetime.datetime.strptime(line['date'], "%Y-%m-%d").date()
         except ValueError:
-            raise Error('InvalidDatePosted',
-                'The date posted must be provided in the form YYYY-MM-DD',
-                {'field': 'posted_date'})
+            line['reason'] = 'the date must be in the form YYYY-MM-DD'
+            results['unmatched_lines'].append(line)
+            continue
 
-    if due_date == '':
-        if posted == 1:
-            raise Error('NoDateDue',
-                'The due date must be supplied when posted=1',
-                {'field': 'date_sue'})
-    else:
         try:
-            due_date = datetime.datetime.strptime(due_date, "%Y-%m-%d")
-        except ValueError:
-            raise Error('InvalidDateDue',
-                'The due date must be provided in the form YYYY-MM-DD',
-                {'field': 'due_date'})
+            amount = Decimal(line['amount']).quantize(Decimal('.01'))
+        except ArithmeticError:
+            line['reason'] = 'the amount is not valid'
+            results['unmatched_lines'].append(line)
+            continue
 
-    if posted_account_guid == '':
-        if posted == 1:
-            raise Error('NoPostedAccountGuid',
-                'The posted account GUID must be supplied when posted=1',
-                {'field': 'posted_account_guid'})
-    else:
-        guid = gnucash.gnucash_core.GUID() 
-        gnucash.gnucash_core.GUIDString(posted_account_guid, guid)
+        statement.append((amount, date, line))
 
-        posted_account = guid.AccountLookup(book)
+    if len(statement) == 0:
+        return results
 
-        if posted_account is None:
-            raise Error('NoAccount',
-                'No account exists with the posted account GUID',
-                {'field': 'posted_account_guid'})
+    # Only splits that could fall in a line's window need fetching
+    window = datetime.timedelta(days=tolerance_days)
+    date_from = min(date for amount, date, line in statement) - window
+    date_to = max(date for amount, date, line in statement) + window
 
-    bill.SetOwner(vendor)
-    bill.SetDateOpened(date_opened)
-    bill.SetNotes(notes)
+    candidates = []
 
-    # post if currently unposted and posted=1
-    if bill.GetDatePosted() is None and posted == 1:
-        bill.PostToAccount(posted_account, posted_date, due_date, posted_memo,
-            posted_accumulatesplits, posted_autopay)
+    for split in get_gnucash_splits(book, account_guid,
+        date_from.strftime("%Y-%m-%d"), date_to.strftime("%Y-%m-%d")):
 
-    return gnucash_simple.billToDict(bill)
+        # Reconciled and voided splits are already settled
+        if split.GetReconcile() in ['y', 'v']:
+            continue
 
-def add_entry(book, invoice_id, date, description, account_guid, quantity,
-    price, discount_type, discount):
+        date = split.GetParent().GetDate()
 
-    invoice = get_gnucash_invoice(book, invoice_id)
+        if isinstance(date, datetime.datetime):
+            date = date.date()
 
-    if invoice is None:
-        raise Error('NoInvoice',
-            'No invoice exists with this ID', {'field': 'invoice_id'})
+        candidates.append((gnc_numeric_to_decimal(split.GetAmount()).quantize(
+            Decimal('.01')), date, split))
 
-    try:
-        date = datetime.datetime.strptime(date, "%Y-%m-%d")
-    except ValueError:
-        raise Error('InvalidDateOpened',
-            'The date opened must be provided in the form YYYY-MM-DD',
-            {'field': 'date'})
+    matched, unmatched_lines, unmatched_splits = reconcile_matches(
+        statement, candidates, tolerance_days)
 
-    # Only value based discounts are supported
-    if discount_type != GNC_AMT_TYPE_VALUE:
-        raise Error('UnsupportedDiscountType', 'Only value based discounts are currently supported',
-            {'field': 'discount_type'})
+    for line, split in matched:
+        guid = split.GetGUID().to_string()
+        transaction = split.GetParent()
 
-    guid = gnucash.gnucash_core.GUID() 
-    gnucash.gnucash_core.GUIDString(account_guid, guid)
+        line['split'] = guid
+        line['description'] = transaction.GetDescription()
 
-    account = guid.AccountLookup(book)
+        if apply and split.GetReconcile() != state:
+            log_operation(book, 'reconcile_split', [guid, state])
 
-    if account is None:
-        raise Error('NoAccount', 'No account exists with this GUID',
-            {'field': 'account_guid'})
+            set_split_reconcile(split, state)
 
-    try:
-        quantity = Decimal(quantity).quantize(Decimal('.01'))
-    except ArithmeticError:
-        raise Error('InvalidQuantity', 'This quantity is not valid',
-            {'field': 'quantity'})
+            record_changes(book, 'reconcile_split', [guid, state], {
+                'guid': guid,
+                'transaction_guid': transaction.GetGUID().to_string(),
+                'reconcile': state})
 
-    try:
-        price = Decimal(price).quantize(Decimal('.01'))
-    except ArithmeticError:
-        raise Error('InvalidPrice', 'This price is not valid',
-            {'field': 'price'})
+        results['matched'].append(line)
 
-    # Currently only value based discounts are supported
-    try:
-        discount = Decimal(discount).quantize(Decimal('.01'))
-    except ArithmeticError:
-        raise Error('InvalidDiscount', 'This discount is not valid',
-            {'field': 'discount'})
+    results['unmatched_lines'].extend(unmatched_lines)
+    results['unmatched_lines'].sort(key=lambda line: line['line'])
 
-    entry = Entry(book, invoice, date.date())
-    entry.SetDateEntered(datetime.datetime.now())
-    entry.SetDescription(description)
-    entry.SetInvAccount(account)
-    entry.SetQuantity(gnc_numeric_from_decimal(quantity))
-    entry.SetInvPrice(gnc_numeric_from_decimal(price))
-    # Do we need to set this?
-    # entry.SetInvDiscountHow()
-    entry.SetInvDiscountType(discount_type)
-    # Currently only value based discounts are supported
-    entry.SetInvDiscount(gnc_numeric_from_decimal(discount))
+    for split in sorted(unmatched_splits, key=lambda split: split.GetParent().GetDate()):
+        results['unmatched_splits'].append(reconcile_split_dict(split))
 
-    return gnucash_simple.entryToDict(entry)
+    return results
 
-def add_bill_entry(book, bill_id, date, description, account_guid, quantity, 
-    price):
+def reconcile_split_dict(split):
 
-    bill = get_gnucash_bill(book,bill_id)
+    transaction = split.GetParent()
 
-    if bill is None:
-        raise Error('NoBill', 'No bill exists with this ID',
-            {'field': 'bill_id'})
+    return {
+        'guid': split.GetGUID().to_string(),
+        'date': transaction.GetDate().strftime("%Y-%m-%d"),
+        'amount': str(gnc_numeric_to_decimal(split.GetAmount()).quantize(Decimal('.01'))),
+        'description': transaction.GetDescription(),
+        'reconcile': split.GetReconcile()
+    }
 
-    try:
-        date = datetime.datetime.strptime(date, "%Y-%m-%d")
-    except ValueError:
-        raise Error('InvalidDateOpened',
-            'The date opened must be provided in the form YYYY-MM-DD',
-            {'field': 'date'})
+EXTERNAL_ID_PREFIX = 'external-id: '
 
-    guid = gnucash.gnucash_core.GUID() 
-    gnucash.gnucash_core.GUIDString(account_guid, guid)
+def external_id_from_notes(notes):
 
-    account = guid.AccountLookup(book)
+    # Imports record the source system's ID as a line in the notes
+    for line in (notes or '').splitlines():
+        if line.startswith(EXTERNAL_ID_PREFIX):
+            return line[len(EXTERNAL_ID_PREFIX):].strip()
 
-    if account is None:
-        raise Error('NoAccount', 'No account exists with this GUID',
-            {'field': 'account_guid'})
+    return None
 
-    try:
-        quantity = Decimal(quantity).quantize(Decimal('.01'))
-    except ArithmeticError:
-        raise Error('InvalidQuantity', 'This quantity is not valid',
-            {'field': 'quantity'})
+def transaction_key(date, amount, account_guids, description):
 
-    try:
-        price = Decimal(price).quantize(Decimal('.01'))
-    except ArithmeticError:
-        raise Error('InvalidPrice', 'This price is not valid',
-            {'field': 'price'})
-    
-    entry = Entry(book, bill, date.date())
-    entry.SetDateEntered(datetime.datetime.now())
-    entry.SetDescription(description)
-    entry.SetBillAccount(account)
-    entry.SetQuantity(gnc_numeric_from_decimal(quantity))
-    entry.SetBillPrice(gnc_numeric_from_decimal(price))
-    
-    return gnucash_simple.entryToDict(entry)
+    # Keyed on the size of the transaction rather than the sign of any one
+    # split, so the same movement keys the same whichever way it was entered
+    return (date, amount.normalize(), tuple(sorted(set(account_guids))),
+        hashlib.sha1(normalise_text(description).encode('utf-8')).hexdigest()[:16])
 
-def get_entry(book, entry_guid):
+def transaction_amount(transaction):
 
-    guid = gnucash.gnucash_core.GUID() 
-    gnucash.gnucash_core.GUIDString(entry_guid, guid)
+    amount = Decimal(0)
 
-    entry = book.EntryLookup(guid)
+    for split in transaction.GetSplitList():
+        value = gnc_numeric_to_decimal(split.GetValue())
+
+        if value > 0:
+            amount += value
+
+    return amount
+
+def existing_transaction_key(transaction):
+
+    account_guids = [split.GetAccount().GetGUID().to_string()
+        for split in transaction.GetSplitList()]
+
+    return transaction_key(transaction.GetDate().strftime("%Y-%m-%d"),
+        transaction_amount(transaction), account_guids, transaction.GetDescription())
+
+class DuplicateIndex(object):
+
+    # Built once per session from the existing transactions, then probed
+    # once per imported row. Rows are added as they're created so repeats
+    # within one import file are caught too
+
+    def __init__(self):
+        self.by_key = {}
+        self.by_external_id = {}
+
+    @classmethod
+    def from_book(cls, book):
+
+        index = cls()
+
+        query = gnucash.Query()
+        query.search_for('Trans')
+        query.set_book(book)
+
+        for result in query.run():
+            transaction = Transaction(instance=result)
+
+            index.add(existing_transaction_key(transaction),
+                external_id_from_notes(transaction.GetNotes()),
+                transaction.GetGUID().to_string())
+
+        query.destroy()
+
+        return index
+
+    def add(self, key, external_id, guid):
+
+        self.by_key.setdefault(key, []).append(guid)
+
+        if external_id:
+            self.by_external_id.setdefault(external_id, []).append(guid)
+
+    def probe(self, key, external_id):
+
+        # An external ID is authoritative when the row has one
+        if external_id:
+            guids = self.by_external_id.get(external_id)
+
+            if guids:
+                return guids[0]
+
+        guids = self.by_key.get(key)
+
+        if guids:
+            return guids[0]
 
-    if entry is None:
         return None
-    else:
-        return gnucash_simple.entryToDict(entry)
 
-def update_entry(book, entry_guid, date, description, account_guid, quantity,
-    price, discount_type, discount):
+    def groups(self):
 
-    guid = gnucash.gnucash_core.GUID() 
-    gnucash.gnucash_core.GUIDString(entry_guid, guid)
+        return [guids for guids in self.by_key.values() if len(guids) > 1]
 
-    entry = book.EntryLookup(guid)
+def account_guids_by_name(book):
 
-    if entry is None:
-        raise Error('NoEntry', 'No entry exists with this GUID',
-            {'field': 'entry_guid'})
+    # As account_guid_from_name the first account with a name wins, full
+    # names are accepted as well
+    guids = {}
 
-    try:
-        date = datetime.datetime.strptime(date, "%Y-%m-%d")
-    except ValueError:
-        raise Error('InvalidDateOpened',
-            'The date opened must be provided in the form YYYY-MM-DD',
-            {'field': 'date'})
+    for account in book.get_root_account().get_descendants():
+        guid = account.GetGUID().to_string()
+        guids.setdefault(account.GetName().lower(), guid)
+        guids.setdefault(account.get_full_name().lower(), guid)
 
-    # Only check discount type for invoices
-    if entry.GetInvAccount() is not None:
-        # Only value based discounts are supported
-        if discount_type != GNC_AMT_TYPE_VALUE:
-            raise Error('UnsupportedDiscountType', 'Only value based discounts are currently supported',
-                {'field': 'discount_type'})
- 
-    gnucash.gnucash_core.GUIDString(account_guid, guid)
+    return guids
 
-    account = guid.AccountLookup(book)
+class LookupCache(object):
 
-    if account is None:
-        raise Error('NoAccount', 'No account exists with this GUID',
-            {'field': 'account_guid'})
+    # Resolves IDs and names to objects for bulk commands, each kind is
+    # loaded with one query the first time it's needed rather than a
+    # query or a tree walk per row
 
-    try:
-        quantity = Decimal(quantity).quantize(Decimal('.01'))
-    except ArithmeticError:
-        raise Error('InvalidQuantity', 'This quantity is not valid',
-            {'field': 'quantity'})
+    def __init__(self, book):
+        self.book = book
+        self.invoices = None
+        self.bills = None
+        self.account_guids = None
+        self.accounts = {}
+        self.customers = {}
+        self.vendors = {}
+
+    def invoice(self, id):
+
+        return self.all_invoices().get(id)
+
+    def all_invoices(self):
 
+        if self.invoices is None:
+            self.invoices = dict((invoice.GetID(), invoice)
+                for invoice in get_gnucash_invoices(self.book, {}))
+
+        return self.invoices
+
+    def bill(self, id):
+
+        if self.bills is None:
+            self.bills = dict((bill.GetID(), bill)
+                for bill in get_gnucash_bills(self.book, {}))
+
+        return self.bills.get(id)
+
+    def add_invoice(self, invoice):
+
+        if self.invoices is not None:
+            self.invoices[invoice.GetID()] = invoice
+
+    def add_bill(self, bill):
+
+        if self.bills is not None:
+            self.bills[bill.GetID()] = bill
+
+    def account(self, name):
+
+        if self.account_guids is None:
+            self.account_guids = account_guids_by_name(self.book)
+
+        account_guid = self.account_guids.get(name.lower())
+
+        if account_guid is None:
+            return None
+
+        if account_guid not in self.accounts:
+            guid = gnucash.gnucash_core.GUID()
+            gnucash.gnucash_core.GUIDString(account_guid, guid)
+
+            self.accounts[account_guid] = guid.AccountLookup(self.book)
+
+        return self.accounts[account_guid]
+
+    def customer(self, id):
+
+        if id not in self.customers:
+            self.customers[id] = self.book.CustomerLookupByID(id)
+
+        return self.customers[id]
+
+    def vendor(self, id):
+
+        if id not in self.vendors:
+            self.vendors[id] = self.book.VendorLookupByID(id)
+
+        return self.vendors[id]
+
+def read_transaction_rows(path):
+
+    # Each row moves amount out of the transfer account into the account
     try:
-        price = Decimal(price).quantize(Decimal('.01'))
-    except ArithmeticError:
-        raise Error('InvalidPrice', 'This price is not valid',
-            {'field': 'price'})
+        with open(path, 'r') as transactions_file:
+            rows = list(csv.DictReader(transactions_file))
+    except (IOError, OSError):
+        raise Error('InvalidTransactionsFile', 'The transactions file could not be read',
+            {'field': 'csv'})
+
+    lines = []
+
+    for number, row in enumerate(rows, 2):
+        row = dict((str(key).strip().lower(), (value or '').strip())
+            for key, value in row.items() if key is not None)
+
+        lines.append({
+            'line': number,
+            'date': row.get('date', ''),
+            'num': row.get('num', ''),
+            'description': row.get('description', ''),
+            'currency': row.get('currency', ''),
+            'amount': row.get('amount', ''),
+            'account': row.get('account', ''),
+            'transfer_account': row.get('transfer_account', ''),
+            'external_id': row.get('external_id', '')
+        })
+
+    return lines
+
+def import_transactions(book, lines, skip_duplicates):
+
+    accounts = account_guids_by_name(book)
+    index = DuplicateIndex.from_book(book)
+    commod_table = book.get_table()
 
-    # Only discount for invoices
-    if entry.GetInvAccount() is not None:
-        # Currently only value based discounts are supported
+    results = []
 
-        # As bills may pass the discount though as None check this and raise an error for invoices
-        if discount is None:
-            raise Error('InvalidDiscount', 'This discount is not valid',
-                {'field': 'discount'})
+    for line in lines:
+        result = {'line': line['line'], 'external_id': line['external_id']}
+        results.append(result)
+
+        # Rows are checked, and the date and amount put in the form the
+        # book stores, before they're keyed, so a row only matches its
+        # duplicate and add_transaction is only given rows it accepts
+        if commod_table.lookup('CURRENCY', line['currency']) is None:
+            result['status'] = 'error'
+            result['reason'] = 'The currency is not valid'
+            continue
 
         try:
-            discount = Decimal(discount).quantize(Decimal('.01'))
+            date = datetime.datetime.strptime(line['date'], "%Y-%m-%d").strftime("%Y-%m-%d")
+        except ValueError:
+            result['status'] = 'error'
+            result['reason'] = 'The date must be in the form YYYY-MM-DD'
+            continue
+
+        try:
+            amount = Decimal(line['amount']).quantize(Decimal('.01'), ROUND_HALF_UP)
         except ArithmeticError:
-            raise Error('InvalidDiscount', 'This discount is not valid',
-                {'field': 'discount'})
+            result['status'] = 'error'
+            result['reason'] = 'The amount is not valid'
+            continue
 
-    entry.SetDate(date.date())
+        account_guid = accounts.get(line['account'].lower())
+        transfer_guid = accounts.get(line['transfer_account'].lower())
 
-    entry.SetDateEntered(datetime.datetime.now())
-    entry.SetDescription(description)
-    entry.SetQuantity(gnc_numeric_from_decimal(quantity))
+        if account_guid is None or transfer_guid is None:
+            result['status'] = 'error'
+            result['reason'] = 'No account exists with this name'
+            continue
 
-    if entry.GetInvAccount() is not None:
-        entry.SetInvAccount(account)
-        entry.SetInvPrice(gnc_numeric_from_decimal(price))
-    else:
-        entry.SetBillAccount(account)
-        entry.SetBillPrice(gnc_numeric_from_decimal(price))
+        key = transaction_key(date, abs(amount), [account_guid, transfer_guid],
+            line['description'])
 
-    # Only set discount for invoices
-    if entry.GetInvAccount() is not None:
-        # Do we need to set this?
-        # entry.SetInvDiscountHow()
+        duplicate = index.probe(key, line['external_id'])
 
-        entry.SetInvDiscountType(discount_type)
-        # Currently only value based discounts are supported
-        entry.SetInvDiscount(gnc_numeric_from_decimal(discount))
+        if duplicate is not None:
+            result['duplicate_of'] = duplicate
 
-    return gnucash_simple.entryToDict(entry)
+            if skip_duplicates:
+                result['status'] = 'skipped'
+                continue
 
-def delete_entry(book, entry_guid):
+        if line['external_id']:
+            notes = EXTERNAL_ID_PREFIX + line['external_id']
+        else:
+            notes = None
 
-    guid = gnucash.gnucash_core.GUID() 
-    gnucash.gnucash_core.GUIDString(entry_guid, guid)
+        try:
+            transaction = add_transaction(book, line['num'], line['description'],
+                date, line['currency'], [
+                    {'account_guid': account_guid, 'value': str(amount)},
+                    {'account_guid': transfer_guid, 'value': str(-amount)}], notes)
+        except Error as error:
+            result['status'] = 'error'
+            result['reason'] = error.message
+            continue
 
-    entry = book.EntryLookup(guid)
+        index.add(key, line['external_id'], transaction['guid'])
 
-    invoice = entry.GetInvoice()
-    bill = entry.GetBill()
+        result['status'] = 'created'
+        result['guid'] = transaction['guid']
 
-    if invoice is not None and entry is not None:
-        invoice.RemoveEntry(entry)
-    elif bill is not None and entry is not None:
-        bill.RemoveEntry(entry)
+    return results
 
-    if entry is not None:
-        entry.Destroy()
+def find_duplicate_transactions(book):
 
-def delete_transaction(book, transaction_guid):
+    groups = []
 
-    guid = gnucash.gnucash_core.GUID() 
-    gnucash.gnucash_core.GUIDString(transaction_guid, guid)
+    for guids in DuplicateIndex.from_book(book).groups():
+        group = []
 
-    transaction = guid.TransLookup(book)
+        for transaction_guid in guids:
+            guid = gnucash.gnucash_core.GUID()
+            gnucash.gnucash_core.GUIDString(transaction_guid, guid)
 
-    # Might be nicer to raise a 404?
-    if transaction is None:
-        raise Error('NoTransaction', 'A transaction with this GUID does not exist',
-            {'field': 'id'})
+            transaction = guid.TransLookup(book)
 
-    transaction.Destroy()
+            group.append({
+                'guid': transaction_guid,
+                'date': transaction.GetDate().strftime("%Y-%m-%d"),
+                'num': transaction.GetNum(),
+                'description': transaction.GetDescription(),
+                'amount': str(transaction_amount(transaction))
+            })
 
-def add_bill(book, id, vendor_id, currency_mnumonic, date_opened, notes):
+        groups.append(group)
 
-    vendor = book.VendorLookupByID(vendor_id)
+    groups.sort(key=lambda group: (group[0]['date'], group[0]['description']))
 
-    if vendor is None:
-        raise Error('NoVendor', 'A vendor with this ID does not exist',
-            {'field': 'id'})
+    return groups
 
-    if id is None:
-        id = book.BillNextID(vendor)
+@journaled('pay_bill')
+def pay_bill(book, id, posted_account_guid, transfer_account_guid, payment_date,
+    memo, num, auto_pay):
+
+    # The posted_account_guid is not actually used in bill.ApplyPayment - why is it on the payment screen?
+
+    bill = get_gnucash_bill(book, id)
+
+    if bill is None:
+        raise Error('NoBill', 'A bill with this ID does not exist',
+            {'field': 'id'})
 
     try:
-        date_opened = datetime.datetime.strptime(date_opened, "%Y-%m-%d")
+        payment_date = datetime.datetime.strptime(payment_date, "%Y-%m-%d")
     except ValueError:
-        raise Error('InvalidDateOpened',
-            'The date opened must be provided in the form YYYY-MM-DD',
-            {'field': 'date_opened'})
-
-    if currency_mnumonic is None:
-        currency_mnumonic = vendor.GetCurrency().get_mnemonic()
+        raise Error('InvalidPaymentDate',
+            'The payment date must be provided in the form YYYY-MM-DD',
+            {'field': 'payment_date'})
 
-    commod_table = book.get_table()
-    currency = commod_table.lookup('CURRENCY', currency_mnumonic)
+    account_guid = gnucash.gnucash_core.GUID() 
+    gnucash.gnucash_core.GUIDString(transfer_account_guid, account_guid)
 
-    if currency is None:
-        raise Error('InvalidBillCurrency',
-            'A valid currency must be supplied for this bill',
-            {'field': 'currency'})
-    elif currency.get_mnemonic() != vendor.GetCurrency().get_mnemonic():
-        # Does Gnucash actually enforce this?
-        raise Error('MismatchedBillCurrency',
-            'The currency of this bill does not match the vendor',
-            {'field': 'currency'})
+    transfer_account = account_guid.AccountLookup(book)
 
-    bill = Bill(book, id, currency, vendor, date_opened.date())
+    if transfer_account is None:
+        raise Error('NoTransferAccount', 'No account exists with this GUID',
+            {'field': 'transfer_account_guid'})
 
-    bill.SetNotes(notes)
+    # We pay the negitive total as the bill as this seemed to cause issues
+    # with the split not being set correctly and not being marked as paid
+    bill.ApplyPayment(None, transfer_account, bill.GetTotal().neg(), GncNumeric(0),
+        payment_date, memo, num)
 
     return gnucash_simple.billToDict(bill)
 
-def add_account(book, name, currency_mnumonic, account_type_id, parent_account_guid):
+def get_bill(book, id):
 
-    from gnucash.gnucash_core_c import \
-    ACCT_TYPE_BANK, ACCT_TYPE_CASH, ACCT_TYPE_CREDIT, ACCT_TYPE_ASSET, \
-    ACCT_TYPE_LIABILITY , ACCT_TYPE_STOCK , ACCT_TYPE_MUTUAL, \
-    ACCT_TYPE_INCOME, ACCT_TYPE_EXPENSE, ACCT_TYPE_EQUITY, \
-    ACCT_TYPE_RECEIVABLE, ACCT_TYPE_PAYABLE, ACCT_TYPE_TRADING 
+    bill = get_gnucash_bill(book, id)
+
+    if bill is None:
+        return None
+    else:
+        return gnucash_simple.billToDict(bill)
+
+@journaled('add_vendor')
+def add_vendor(book, id, currency_mnumonic, name, contact, address_line_1,
+    address_line_2, address_line_3, address_line_4, phone, fax, email):
 
     if name == '':
-        raise Error('NoAccountName', 'A name must be entered for this account',
+        raise Error('NoVendorName', 'A name must be entered for this company',
             {'field': 'name'})
 
+    if (address_line_1 == ''
+        and address_line_2 == ''
+        and address_line_3 == ''
+        and address_line_4 == ''):
+        raise Error('NoVendorAddress',
+            'An address must be entered for this company',
+            {'field': 'address'})
+
     commod_table = book.get_table()
     currency = commod_table.lookup('CURRENCY', currency_mnumonic)
 
     if currency is None:
-        raise Error('InvalidAccountCurrency',
-            'A valid currency must be supplied for this account',
+        raise Error('InvalidVendorCurrency',
+            'A valid currency must be supplied for this vendor',
             {'field': 'currency'})
 
-    if account_type_id not in [ACCT_TYPE_BANK, ACCT_TYPE_CASH, ACCT_TYPE_CREDIT, \
-    ACCT_TYPE_ASSET, ACCT_TYPE_LIABILITY , ACCT_TYPE_STOCK , ACCT_TYPE_MUTUAL, \
-    ACCT_TYPE_INCOME, ACCT_TYPE_EXPENSE, ACCT_TYPE_EQUITY, ACCT_TYPE_RECEIVABLE, \
-    ACCT_TYPE_PAYABLE, ACCT_TYPE_TRADING]:
-        raise Error('InvalidAccountTypeID',
-            'A valid account type ID must be supplied for this account',
-            {'field': 'account_type_id'})
+    if id is None:
+        id = book.VendorNextID()
 
-    if parent_account_guid == '':
-        parent_account = book.get_root_account()
-    else:
-        account_guid = gnucash.gnucash_core.GUID() 
-        gnucash.gnucash_core.GUIDString(parent_account_guid, account_guid)
+    vendor = Vendor(book, id, currency, name)
+
+    address = vendor.GetAddr()
+    address.SetName(contact)
+    address.SetAddr1(address_line_1)
+    address.SetAddr2(address_line_2)
+    address.SetAddr3(address_line_3)
+    address.SetAddr4(address_line_4)
+    address.SetPhone(phone)
+    address.SetFax(fax)
+    address.SetEmail(email)
+
+    return gnucash_simple.vendorToDict(vendor)
+
+@journaled('add_customer')
+def add_customer(book, id, currency_mnumonic, name, contact, address_line_1,
+    address_line_2, address_line_3, address_line_4, phone, fax, email):
+
+    if name == '':
+        raise Error('NoCustomerName',
+            'A name must be entered for this company', {'field': 'name'})
+
+    if (address_line_1 == ''
+        and address_line_2 == ''
+        and address_line_3 == ''
+        and address_line_4 == ''):
+        raise Error('NoCustomerAddress',
+            'An address must be entered for this company',
+            {'field': 'address'})
+
+    commod_table = book.get_table()
+    currency = commod_table.lookup('CURRENCY', currency_mnumonic)
+
+    if currency is None:
+        raise Error('InvalidCustomerCurrency',
+            'A valid currency must be supplied for this customer',
+            {'field': 'currency'})
+
+    if id is None:
+        id = book.CustomerNextID()
+
+    customer = Customer(book, id, currency, name)
+
+    address = customer.GetAddr()
+    address.SetName(contact)
+    address.SetAddr1(address_line_1)
+    address.SetAddr2(address_line_2)
+    address.SetAddr3(address_line_3)
+    address.SetAddr4(address_line_4)
+    address.SetPhone(phone)
+    address.SetFax(fax)
+    address.SetEmail(email)
+
+    return gnucash_simple.customerToDict(customer)
+
+@journaled('update_customer')
+def update_customer(book, id, name, contact, address_line_1, address_line_2,
+    address_line_3, address_line_4, phone, fax, email):
+
+    customer = book.CustomerLookupByID(id)
+
+    if customer is None:
+        raise Error('NoCustomer', 'A customer with this ID does not exist',
+            {'field': 'id'})
+
+    if name == '':
+        raise Error('NoCustomerName',
+            'A name must be entered for this company', {'field': 'name'})
+
+    if (address_line_1 == ''
+        and address_line_2 == ''
+        and address_line_3 == ''
+        and address_line_4 == ''):
+        raise Error('NoCustomerAddress',
+            'An address must be entered for this company',
+            {'field': 'address'})
+
+    customer.SetName(name)
+
+    address = customer.GetAddr()
+    address.SetName(contact)
+    address.SetAddr1(address_line_1)
+    address.SetAddr2(address_line_2)
+    address.SetAddr3(address_line_3)
+    address.SetAddr4(address_line_4)
+    address.SetPhone(phone)
+    address.SetFax(fax)
+    address.SetEmail(email)
+
+    return gnucash_simple.customerToDict(customer)
+
+@journaled('add_invoice')
+def add_invoice(book, id, customer_id, currency_mnumonic, date_opened, notes):
+
+    # Check customer ID is provided to avoid "CRIT <qof> qof_query_string_predicate: assertion '*str != '\0'' failed" error
+    if customer_id == '':
+        raise Error('NoCustomer',
+            'A customer ID must be provided', {'field': 'id'})
+
+    customer = book.CustomerLookupByID(customer_id)
+
+    if customer is None:
+        raise Error('NoCustomer',
+            'A customer with this ID does not exist', {'field': 'id'})
+
+    if id is None:
+        id = book.InvoiceNextID(customer)
+
+    try:
+        date_opened = datetime.datetime.strptime(date_opened, "%Y-%m-%d")
+    except ValueError:
+        raise Error('InvalidDateOpened',
+            'The date opened must be provided in the form YYYY-MM-DD',
+            {'field': 'date_opened'})
+
+    currency = invoice_currency(book, customer, currency_mnumonic)
+
+    invoice = create_invoice(book, id, currency, customer, date_opened, notes)
+
+    return gnucash_simple.invoiceToDict(invoice)
+
+def invoice_currency(book, customer, currency_mnumonic):
+
+    if currency_mnumonic is None:
+        currency_mnumonic = customer.GetCurrency().get_mnemonic()
+
+    commod_table = book.get_table()
+    currency = commod_table.lookup('CURRENCY', currency_mnumonic)
+
+    if currency is None:
+        raise Error('InvalidInvoiceCurrency',
+            'A valid currency must be supplied for this invoice',
+            {'field': 'currency'})
+    elif currency.get_mnemonic() != customer.GetCurrency().get_mnemonic():
+        # Does Gnucash actually enforce this?
+        raise Error('MismatchedInvoiceCurrency',
+            'The currency of this invoice does not match the customer',
+            {'field': 'currency'})
+
+    return currency
+
+def create_invoice(book, id, currency, customer, date_opened, notes):
+
+    invoice = Invoice(book, id, currency, customer, date_opened.date())
+
+    invoice.SetNotes(notes)
+
+    return invoice
+
+@journaled('update_invoice')
+def update_invoice(book, id, customer_id, currency_mnumonic, date_opened,
+    notes, posted, posted_account_guid, posted_date, due_date, posted_memo,
+    posted_accumulatesplits, posted_autopay):
+
+    invoice = get_gnucash_invoice(book, id)
+
+    if invoice is None:
+        raise Error('NoInvoice',
+            'An invoice with this ID does not exist',
+            {'field': 'id'})
+
+    customer = book.CustomerLookupByID(customer_id)
+
+    if customer is None:
+        raise Error('NoCustomer', 'A customer with this ID does not exist',
+            {'field': 'customer_id'})
+
+    try:
+        date_opened = datetime.datetime.strptime(date_opened, "%Y-%m-%d")
+    except ValueError:
+        raise Error('InvalidDateOpened',
+            'The date opened must be provided in the form YYYY-MM-DD',
+            {'field': 'date_opened'})
+
+    if posted_date == '':
+        if posted == 1:
+            raise Error('NoDatePosted',
+                'The date posted must be supplied when posted=1',
+                {'field': 'date_posted'})
+    else:
+        try:
+            posted_date = datetime.datetime.strptime(posted_date, "%Y-%m-%d")
+        except ValueError:
+            raise Error('InvalidDatePosted',
+                'The date posted must be provided in the form YYYY-MM-DD',
+                {'field': 'posted_date'})
+
+    if due_date == '':
+        if posted == 1:
+            raise Error('NoDateDue',
+                'The due date must be supplied when posted=1',
+                {'field': 'due_date'})
+    else:
+        try:
+            due_date = datetime.datetime.strptime(due_date, "%Y-%m-%d")
+        except ValueError:
+            raise Error('InvalidDateDue',
+                'The due date must be provided in the form YYYY-MM-DD',
+                {'field': 'due_date'})
+
+    if posted_account_guid == '':
+        if posted == 1:
+            raise Error('NoPostedAccountGuid',
+                'The posted account GUID must be supplied when posted=1',
+                {'field': 'posted_account_guid'})
+    else:
+        guid = gnucash.gnucash_core.GUID() 
+        gnucash.gnucash_core.GUIDString(posted_account_guid, guid)
+
+        posted_account = guid.AccountLookup(book)
+
+        if posted_account is None:
+            raise Error('NoAccount',
+                'No account exists with the posted account GUID',
+                {'field': 'posted_account_guid'})
+
+    invoice.SetOwner(customer)
+    invoice.SetDateOpened(date_opened)
+    invoice.SetNotes(notes)
+
+    # post if currently unposted and posted=1
+    if is_unposted(invoice) and posted == 1:
+        invoice.PostToAccount(posted_account, posted_date, due_date,
+            posted_memo, posted_accumulatesplits, posted_autopay)
+
+    return gnucash_simple.invoiceToDict(invoice)
+
+@journaled('post_invoice')
+def post_invoice(book, id, posted_account_guid, posted_date, due_date,
+    posted_memo, posted_accumulatesplits, posted_autopay):
+
+    invoice = get_gnucash_invoice(book, id)
+
+    if invoice is None:
+        raise Error('NoInvoice',
+            'An invoice with this ID does not exist',
+            {'field': 'id'})
+
+    guid = gnucash.gnucash_core.GUID()
+    gnucash.gnucash_core.GUIDString(posted_account_guid, guid)
+
+    posted_account = guid.AccountLookup(book)
+
+    if posted_account is None:
+        raise Error('NoAccount',
+            'No account exists with the posted account GUID',
+            {'field': 'posted_account_guid'})
+
+    posted_date, due_date = parse_posting_dates(posted_date, due_date)
+
+    post_gnucash_invoice(invoice, posted_account, posted_date, due_date,
+        posted_memo, posted_accumulatesplits, posted_autopay)
+
+    return gnucash_simple.invoiceToDict(invoice)
+
+def parse_posting_dates(posted_date, due_date):
+
+    try:
+        posted_date = datetime.datetime.strptime(posted_date, "%Y-%m-%d")
+    except (ValueError, TypeError):
+        raise Error('InvalidDatePosted',
+            'The date posted must be provided in the form YYYY-MM-DD',
+            {'field': 'posted_date'})
+
+    try:
+        due_date = datetime.datetime.strptime(due_date, "%Y-%m-%d")
+    except (ValueError, TypeError):
+        raise Error('InvalidDateDue',
+            'The due date must be provided in the form YYYY-MM-DD',
+            {'field': 'due_date'})
+
+    return posted_date, due_date
+
+def is_unposted(invoice):
+
+    # Unposted invoices and bills can report the epoch as their date posted
+    return (invoice.GetDatePosted() is None
+        or invoice.GetDatePosted().strftime("%Y-%m-%d") == '1970-01-01')
+
+def post_gnucash_invoice(invoice, posted_account, posted_date, due_date,
+    posted_memo, posted_accumulatesplits, posted_autopay):
+
+    # post if currently unposted
+    if is_unposted(invoice):
+        invoice.PostToAccount(posted_account, posted_date, due_date,
+            posted_memo, posted_accumulatesplits, posted_autopay)
+        return True
+    else:
+        return False
+
+def post_invoices(book, properties, posted_account_guid, posted_date, due_date,
+    posted_memo, posted_accumulatesplits, posted_autopay):
+
+    # Posts every unposted invoice matching properties, the candidates come
+    # from one query and the posted account and dates are resolved once
+
+    guid = gnucash.gnucash_core.GUID()
+    gnucash.gnucash_core.GUIDString(posted_account_guid, guid)
+
+    posted_account = guid.AccountLookup(book)
+
+    if posted_account is None:
+        raise Error('NoAccount',
+            'No account exists with the posted account GUID',
+            {'field': 'posted_account_guid'})
+
+    parsed_posted_date, parsed_due_date = parse_posting_dates(posted_date, due_date)
+
+    properties['is_posted'] = 0
+
+    results = []
+
+    for invoice in get_gnucash_invoices(book, properties):
+
+        id = invoice.GetID()
+
+        log_operation(book, 'post_invoice', [id, posted_account_guid,
+            posted_date, due_date, posted_memo, posted_accumulatesplits,
+            posted_autopay])
+
+        posted = post_gnucash_invoice(invoice, posted_account, parsed_posted_date,
+            parsed_due_date, posted_memo, posted_accumulatesplits,
+            posted_autopay)
+
+        record_changes(book, 'post_invoice', [id], None)
+
+        if posted:
+            results.append({'id': id, 'posted': True, 'message': 'posted'})
+        else:
+            results.append({'id': id, 'posted': False, 'message': 'already posted'})
+
+    return results
+
+@journaled('update_bill')
+def update_bill(book, id, vendor_id, currency_mnumonic, date_opened, notes,
+    posted, posted_account_guid, posted_date, due_date, posted_memo,
+    posted_accumulatesplits, posted_autopay):
+
+    bill = get_gnucash_bill(book, id)
+
+    if bill is None:
+        raise Error('NoBill', 'A bill with this ID does not exist',
+            {'field': 'id'})
+
+    vendor = book.VendorLookupByID(vendor_id)
+
+    if vendor is None:
+        raise Error('NoVendor',
+            'A vendor with this ID does not exist',
+            {'field': 'vendor_id'})
+
+    try:
+        date_opened = datetime.datetime.strptime(date_opened, "%Y-%m-%d")
+    except ValueError:
+        raise Error('InvalidDateOpened',
+            'The date opened must be provided in the form YYYY-MM-DD',
+            {'field': 'date_opened'})
+
+    if posted_date == '':
+        if posted == 1:
+            raise Error('NoDatePosted',
+                'The date posted must be supplied when posted=1',
+                {'field': 'date_posted'})
+    else:
+        try:
+            posted_date = datetime.datetime.strptime(posted_date, "%Y-%m-%d")
+        except ValueError:
+            raise Error('InvalidDatePosted',
+                'The date posted must be provided in the form YYYY-MM-DD',
+                {'field': 'posted_date'})
+
+    if due_date == '':
+        if posted == 1:
+            raise Error('NoDateDue',
+                'The due date must be supplied when posted=1',
+                {'field': 'date_sue'})
+    else:
+        try:
+            due_date = datetime.datetime.strptime(due_date, "%Y-%m-%d")
+        except ValueError:
+            raise Error('InvalidDateDue',
+                'The due date must be provided in the form YYYY-MM-DD',
+                {'field': 'due_date'})
+
+    if posted_account_guid == '':
+        if posted == 1:
+            raise Error('NoPostedAccountGuid',
+                'The posted account GUID must be supplied when posted=1',
+                {'field': 'posted_account_guid'})
+    else:
+        guid = gnucash.gnucash_core.GUID() 
+        gnucash.gnucash_core.GUIDString(posted_account_guid, guid)
+
+        posted_account = guid.AccountLookup(book)
+
+        if posted_account is None:
+            raise Error('NoAccount',
+                'No account exists with the posted account GUID',
+                {'field': 'posted_account_guid'})
+
+    bill.SetOwner(vendor)
+    bill.SetDateOpened(date_opened)
+    bill.SetNotes(notes)
+
+    # post if currently unposted and posted=1, the same path bill import
+    # posts through so its journaled update_bill replays the same way
+    if posted == 1:
+        post_gnucash_invoice(bill, posted_account, posted_date, due_date,
+            posted_memo, posted_accumulatesplits, posted_autopay)
+
+    return gnucash_simple.billToDict(bill)
+
+@journaled('add_entry')
+def add_entry(book, invoice_id, date, description, account_guid, quantity,
+    price, discount_type, discount):
+
+    invoice = get_gnucash_invoice(book, invoice_id)
+
+    if invoice is None:
+        raise Error('NoInvoice',
+            'No invoice exists with this ID', {'field': 'invoice_id'})
+
+    try:
+        date = datetime.datetime.strptime(date, "%Y-%m-%d")
+    except ValueError:
+        raise Error('InvalidDateOpened',
+            'The date opened must be provided in the form YYYY-MM-DD',
+            {'field': 'date'})
+
+    # Only value based discounts are supported
+    if discount_type != GNC_AMT_TYPE_VALUE:
+        raise Error('UnsupportedDiscountType', 'Only value based discounts are currently supported',
+            {'field': 'discount_type'})
+
+    guid = gnucash.gnucash_core.GUID() 
+    gnucash.gnucash_core.GUIDString(account_guid, guid)
+
+    account = guid.AccountLookup(book)
+
+    if account is None:
+        raise Error('NoAccount', 'No account exists with this GUID',
+            {'field': 'account_guid'})
+
+    try:
+        quantity = Decimal(quantity).quantize(Decimal('.01'))
+    except ArithmeticError:
+        raise Error('InvalidQuantity', 'This quantity is not valid',
+            {'field': 'quantity'})
+
+    try:
+        price = Decimal(price).quantize(Decimal('.01'))
+    except ArithmeticError:
+        raise Error('InvalidPrice', 'This price is not valid',
+            {'field': 'price'})
+
+    # Currently only value based discounts are supported
+    try:
+        discount = Decimal(discount).quantize(Decimal('.01'))
+    except ArithmeticError:
+        raise Error('InvalidDiscount', 'This discount is not valid',
+            {'field': 'discount'})
+
+    entry = create_entry(book, invoice, date, description, account, quantity,
+        price, discount_type, discount)
+
+    return gnucash_simple.entryToDict(entry)
+
+def create_entry(book, invoice, date, description, account, quantity, price,
+    discount_type, discount):
+
+    # Takes the resolved invoice and account and parsed values so bulk
+    # imports can resolve and parse each value once
+    entry = Entry(book, invoice, date.date())
+    entry.SetDateEntered(datetime.datetime.now())
+    entry.SetDescription(description)
+    entry.SetInvAccount(account)
+    entry.SetQuantity(gnc_numeric_from_decimal(quantity))
+    entry.SetInvPrice(gnc_numeric_from_decimal(price))
+    # Do we need to set this?
+    # entry.SetInvDiscountHow()
+    entry.SetInvDiscountType(discount_type)
+    # Currently only value based discounts are supported
+    entry.SetInvDiscount(gnc_numeric_from_decimal(discount))
+
+    return entry
+
+def read_entry_rows(path):
+
+    try:
+        with open(path, 'r') as entries_file:
+            rows = list(csv.DictReader(entries_file))
+    except (IOError, OSError):
+        raise Error('InvalidEntriesFile', 'The entries file could not be read',
+            {'field': 'csv'})
+
+    lines = []
+
+    for number, row in enumerate(rows, 2):
+        row = dict((str(key).strip().lower(), (value or '').strip())
+            for key, value in row.items() if key is not None)
+
+        lines.append({
+            'line': number,
+            'invoice_id': row.get('invoice_id', ''),
+            'date': row.get('date', ''),
+            'description': row.get('description', ''),
+            'account': row.get('account', ''),
+            'quantity': row.get('quantity', ''),
+            'price': row.get('price', ''),
+            'discount': row.get('discount', '') or '0'
+        })
+
+    return lines
+
+def parse_entry_line(line):
+
+    # Every value is parsed once, up front, before anything is written
+    try:
+        date = datetime.datetime.strptime(line['date'], "%Y-%m-%d")
+    except ValueError:
+        raise Error('InvalidDate', 'The date must be provided in the form YYYY-MM-DD',
+            {'field': 'date'})
+
+    values = []
+
+    # Bill entries have no discount
+    for field in [field for field in ['quantity', 'price', 'discount'] if field in line]:
+        try:
+            values.append(Decimal(line[field]).quantize(Decimal('.01')))
+        except ArithmeticError:
+            raise Error('Invalid' + field.capitalize(), 'This ' + field + ' is not valid',
+                {'field': field})
+
+    return [date] + values
+
+def import_entries(book, lines):
+
+    # Lines are grouped by invoice so each invoice is edited once, with
+    # invoices and accounts resolved through the cache
+    lookups = LookupCache(book)
+
+    groups = {}
+
+    for line in lines:
+        groups.setdefault(line['invoice_id'], []).append(line)
+
+    results = []
+
+    for invoice_id, group in groups.items():
+        invoice = lookups.invoice(invoice_id)
+
+        if invoice is not None:
+            invoice.BeginEdit()
+
+        for line in group:
+            result = {'line': line['line'], 'invoice_id': invoice_id}
+            results.append(result)
+
+            try:
+                if invoice is None:
+                    raise Error('NoInvoice', 'No invoice exists with this ID',
+                        {'field': 'invoice_id'})
+
+                account = lookups.account(line['account'])
+
+                if account is None:
+                    raise Error('NoAccount', 'No account exists with this name',
+                        {'field': 'account'})
+
+                date, quantity, price, discount = parse_entry_line(line)
+            except Error as error:
+                result['status'] = 'error'
+                result['reason'] = error.message
+                continue
+
+            args = [invoice_id, line['date'], line['description'],
+                account.GetGUID().to_string(), line['quantity'], line['price'],
+                GNC_AMT_TYPE_VALUE, line['discount']]
+
+            log_operation(book, 'add_entry', args)
+
+            entry = create_entry(book, invoice, date, line['description'], account,
+                quantity, price, GNC_AMT_TYPE_VALUE, discount)
+
+            record_changes(book, 'add_entry', args, None)
+
+            result['status'] = 'created'
+            result['guid'] = entry.GetGUID().to_string()
+
+        if invoice is not None:
+            invoice.CommitEdit()
+
+    results.sort(key=lambda result: result['line'])
+
+    return results
+
+@journaled('add_bill_entry')
+def add_bill_entry(book, bill_id, date, description, account_guid, quantity, 
+    price):
+
+    bill = get_gnucash_bill(book,bill_id)
+
+    if bill is None:
+        raise Error('NoBill', 'No bill exists with this ID',
+            {'field': 'bill_id'})
+
+    try:
+        date = datetime.datetime.strptime(date, "%Y-%m-%d")
+    except ValueError:
+        raise Error('InvalidDateOpened',
+            'The date opened must be provided in the form YYYY-MM-DD',
+            {'field': 'date'})
+
+    guid = gnucash.gnucash_core.GUID() 
+    gnucash.gnucash_core.GUIDString(account_guid, guid)
+
+    account = guid.AccountLookup(book)
+
+    if account is None:
+        raise Error('NoAccount', 'No account exists with this GUID',
+            {'field': 'account_guid'})
+
+    try:
+        quantity = Decimal(quantity).quantize(Decimal('.01'))
+    except ArithmeticError:
+        raise Error('InvalidQuantity', 'This quantity is not valid',
+            {'field': 'quantity'})
+
+    try:
+        price = Decimal(price).quantize(Decimal('.01'))
+    except ArithmeticError:
+        raise Error('InvalidPrice', 'This price is not valid',
+            {'field': 'price'})
+
+    entry = create_bill_entry(book, bill, date, description, account, quantity, price)
+
+    return gnucash_simple.entryToDict(entry)
+
+def create_bill_entry(book, bill, date, description, account, quantity, price):
+
+    entry = Entry(book, bill, date.date())
+    entry.SetDateEntered(datetime.datetime.now())
+    entry.SetDescription(description)
+    entry.SetBillAccount(account)
+    entry.SetQuantity(gnc_numeric_from_decimal(quantity))
+    entry.SetBillPrice(gnc_numeric_from_decimal(price))
+
+    return entry
+
+def read_bill_rows(path):
+
+    # A row per bill entry, the bill's own columns are taken from the first
+    # row for each bill_id
+    try:
+        with open(path, 'r') as bills_file:
+            rows = list(csv.DictReader(bills_file))
+    except (IOError, OSError):
+        raise Error('InvalidBillsFile', 'The bills file could not be read',
+            {'field': 'csv'})
+
+    lines = []
+
+    for number, row in enumerate(rows, 2):
+        row = dict((str(key).strip().lower(), (value or '').strip())
+            for key, value in row.items() if key is not None)
+
+        lines.append({
+            'line': number,
+            'bill_id': row.get('bill_id', ''),
+            'vendor_id': row.get('vendor_id', ''),
+            'currency': row.get('currency', '') or None,
+            'date_opened': row.get('date_opened', ''),
+            'notes': row.get('notes', ''),
+            'date': row.get('date', ''),
+            'description': row.get('description', ''),
+            'account': row.get('account', ''),
+            'quantity': row.get('quantity', ''),
+            'price': row.get('price', ''),
+            'posted_account': row.get('posted_account', ''),
+            'posted_date': row.get('posted_date', ''),
+            'due_date': row.get('due_date', '')
+        })
+
+    return lines
+
+def import_bill(book, lookups, bill_id, first):
+
+    # Returns the bill for an import group, creating it from the group's
+    # first row when it doesn't exist yet
+    bill = lookups.bill(bill_id)
+
+    if bill is not None:
+        if bill.IsPosted():
+            raise Error('BillPosted', 'This bill has already been posted',
+                {'field': 'bill_id'})
+
+        return bill
+
+    vendor = lookups.vendor(first['vendor_id'])
+
+    if vendor is None:
+        raise Error('NoVendor', 'A vendor with this ID does not exist',
+            {'field': 'vendor_id'})
+
+    try:
+        date_opened = datetime.datetime.strptime(first['date_opened'], "%Y-%m-%d")
+    except ValueError:
+        raise Error('InvalidDateOpened',
+            'The date opened must be provided in the form YYYY-MM-DD',
+            {'field': 'date_opened'})
+
+    currency = bill_currency(book, vendor, first['currency'])
+
+    args = [bill_id, first['vendor_id'], first['currency'], first['date_opened'],
+        first['notes']]
+
+    log_operation(book, 'add_bill', args)
+
+    bill = create_bill(book, bill_id, currency, vendor, date_opened, first['notes'])
+
+    record_changes(book, 'add_bill', args, {'id': bill_id})
+
+    lookups.add_bill(bill)
+
+    return bill
+
+def import_bills(book, lines):
+
+    # Bills, their entries and postings in one session. Rows are grouped by
+    # bill_id and a bill is only posted when all of its rows went in
+    lookups = LookupCache(book)
+
+    groups = {}
+
+    for line in lines:
+        groups.setdefault(line['bill_id'], []).append(line)
+
+    results = []
+
+    for bill_id, group in groups.items():
+        group_results = [{'line': line['line'], 'bill_id': bill_id} for line in group]
+        results.extend(group_results)
+
+        try:
+            if bill_id == '':
+                raise Error('NoBillID', 'Each row must have a bill_id',
+                    {'field': 'bill_id'})
+
+            bill = import_bill(book, lookups, bill_id, group[0])
+        except Error as error:
+            for result in group_results:
+                result['status'] = 'error'
+                result['reason'] = error.message
+            continue
+
+        bill.BeginEdit()
+
+        for line, result in zip(group, group_results):
+            try:
+                account = lookups.account(line['account'])
+
+                if account is None:
+                    raise Error('NoAccount', 'No account exists with this name',
+                        {'field': 'account'})
+
+                date, quantity, price = parse_entry_line(line)
+            except Error as error:
+                result['status'] = 'error'
+                result['reason'] = error.message
+                continue
+
+            args = [bill_id, line['date'], line['description'],
+                account.GetGUID().to_string(), line['quantity'], line['price']]
+
+            log_operation(book, 'add_bill_entry', args)
+
+            entry = create_bill_entry(book, bill, date, line['description'], account,
+                quantity, price)
+
+            record_changes(book, 'add_bill_entry', args, None)
+
+            result['status'] = 'created'
+            result['guid'] = entry.GetGUID().to_string()
+
+        bill.CommitEdit()
+
+        if group[0]['posted_account'] == '':
+            continue
+
+        if any(result['status'] == 'error' for result in group_results):
+            for result in group_results:
+                result['posted'] = False
+            continue
+
+        try:
+            posted_account = lookups.account(group[0]['posted_account'])
+
+            if posted_account is None:
+                raise Error('NoAccount', 'No account exists with the posted account name',
+                    {'field': 'posted_account'})
+
+            posted_date, due_date = parse_posting_dates(group[0]['posted_date'],
+                group[0]['due_date'])
+        except Error as error:
+            for result in group_results:
+                result['posted'] = False
+                result['reason'] = error.message
+            continue
+
+        # Journaled as the update_bill the single bill commands would make
+        args = [bill_id, bill.GetOwner().GetID(), bill.GetCurrency().get_mnemonic(),
+            bill.GetDateOpened().strftime("%Y-%m-%d"), bill.GetNotes(), 1,
+            posted_account.GetGUID().to_string(), group[0]['posted_date'],
+            group[0]['due_date'], '', False, False]
+
+        log_operation(book, 'update_bill', args)
+
+        posted = post_gnucash_invoice(bill, posted_account, posted_date, due_date,
+            '', False, False)
+
+        record_changes(book, 'update_bill', args, {'id': bill_id})
+
+        for result in group_results:
+            result['posted'] = posted
+
+    results.sort(key=lambda result: result['line'])
+
+    return results
+
+RECURRING_PREFIX = 'recurring: '
+
+RECURRING_CADENCES = {'weekly': None, 'monthly': 1, 'quarterly': 3, 'yearly': 12}
+
+def read_schedules(path):
+
+    # Schedules are YAML, or JSON when PyYAML isn't installed. Either a list
+    # of schedules or a mapping with a schedules key
+    try:
+        with open(path, 'r') as schedules_file:
+            source = schedules_file.read()
+    except (IOError, OSError):
+        raise Error('InvalidSchedules', 'The schedules file could not be read',
+            {'field': 'schedule'})
+
+    if yaml is not None:
+        try:
+            data = yaml.safe_load(source)
+        except yaml.YAMLError:
+            raise Error('InvalidSchedules', 'The schedules file is not valid YAML',
+                {'field': 'schedule'})
+    else:
+        try:
+            data = json.loads(source)
+        except ValueError:
+            raise Error('InvalidSchedules',
+                'The schedules file must be JSON when PyYAML is not installed',
+                {'field': 'schedule'})
+
+    if isinstance(data, dict):
+        data = data.get('schedules')
+
+    if not isinstance(data, list) or not all(isinstance(schedule, dict)
+        for schedule in data):
+        raise Error('InvalidSchedules', 'The schedules file must hold a list of schedules',
+            {'field': 'schedule'})
+
+    schedules = []
+
+    for schedule in data:
+        entries = schedule.get('entries') or []
+
+        if not isinstance(entries, list) or not all(isinstance(entry, dict)
+            for entry in entries):
+            entries = None
+
+        # YAML gives dates and numbers as objects, everything is handled as
+        # the strings the other commands take
+        schedules.append({
+            'name': str(schedule.get('name') or ''),
+            'customer': str(schedule.get('customer') or ''),
+            'currency': str(schedule['currency']) if schedule.get('currency') else None,
+            'cadence': str(schedule.get('cadence') or 'monthly'),
+            'start': str(schedule.get('start') or ''),
+            'end': str(schedule['end']) if schedule.get('end') else None,
+            'due_days': schedule.get('due_days', 30),
+            'posted_account': str(schedule.get('posted_account') or ''),
+            'notes': str(schedule.get('notes') or ''),
+            'entries': None if entries is None else [{
+                'description': str(entry.get('description') or ''),
+                'account': str(entry.get('account') or ''),
+                'quantity': str(entry.get('quantity', 1)),
+                'price': str(entry.get('price', '')),
+                'discount': str(entry.get('discount') or 0)
+            } for entry in entries]
+        })
+
+    return schedules
+
+def add_months(date, months):
+
+    # Keeps the day of the month, clamped to the length of shorter months
+    month = date.month - 1 + months
+    year = date.year + month // 12
+    month = month % 12 + 1
+
+    return date.replace(year=year, month=month,
+        day=min(date.day, calendar.monthrange(year, month)[1]))
+
+def recurring_dates(start, end, cadence, as_of):
+
+    # Every occurrence from start up to as_of, counted from start each time
+    # so a clamped month end doesn't drift the days after it
+    dates = []
+
+    while True:
+        if RECURRING_CADENCES[cadence] is None:
+            date = start + datetime.timedelta(weeks=len(dates))
+        else:
+            date = add_months(start, len(dates) * RECURRING_CADENCES[cadence])
+
+        if date > as_of or (end is not None and date > end):
+            return dates
+
+        dates.append(date)
+
+def recurring_marker(name, date):
+
+    return RECURRING_PREFIX + name + ' ' + date.strftime("%Y-%m-%d")
+
+def recurring_markers(invoices):
+
+    markers = set()
+
+    for invoice in invoices:
+        for line in (invoice.GetNotes() or '').splitlines():
+            if line.startswith(RECURRING_PREFIX):
+                markers.add(line.strip())
+
+    return markers
+
+def parse_schedule(lookups, schedule):
+
+    # Resolves a schedule's customer, accounts and values once for all of
+    # its periods
+    if schedule['name'] == '':
+        raise Error('NoScheduleName', 'Each schedule must have a name',
+            {'field': 'name'})
+
+    if schedule['cadence'] not in RECURRING_CADENCES:
+        raise Error('InvalidCadence', 'The cadence must be one of '
+            + ', '.join(sorted(RECURRING_CADENCES)), {'field': 'cadence'})
+
+    customer = lookups.customer(schedule['customer']) if schedule['customer'] else None
+
+    if customer is None:
+        raise Error('NoCustomer', 'A customer with this ID does not exist',
+            {'field': 'customer'})
+
+    currency = invoice_currency(lookups.book, customer, schedule['currency'])
+
+    try:
+        start = datetime.datetime.strptime(schedule['start'], "%Y-%m-%d")
+    except ValueError:
+        raise Error('InvalidStart', 'The start must be provided in the form YYYY-MM-DD',
+            {'field': 'start'})
+
+    try:
+        end = None if schedule['end'] is None else datetime.datetime.strptime(
+            schedule['end'], "%Y-%m-%d")
+    except ValueError:
+        raise Error('InvalidEnd', 'The end must be provided in the form YYYY-MM-DD',
+            {'field': 'end'})
+
+    try:
+        due_days = int(schedule['due_days'])
+    except (ValueError, TypeError):
+        raise Error('InvalidDueDays', 'The due days must be a whole number',
+            {'field': 'due_days'})
+
+    posted_account = None
+
+    if schedule['posted_account'] != '':
+        posted_account = lookups.account(schedule['posted_account'])
+
+        if posted_account is None:
+            raise Error('NoAccount', 'No account exists with the posted account name',
+                {'field': 'posted_account'})
+
+    if not schedule['entries']:
+        raise Error('NoEntries', 'Each schedule must have at least one entry',
+            {'field': 'entries'})
+
+    entries = []
+
+    for entry in schedule['entries']:
+        account = lookups.account(entry['account'])
+
+        if account is None:
+            raise Error('NoAccount', 'No account exists with this name',
+                {'field': 'account'})
+
+        date, quantity, price, discount = parse_entry_line(dict(entry,
+            date=schedule['start']))
+
+        entries.append((entry, account, quantity, price, discount))
+
+    return customer, currency, start, end, due_days, posted_account, entries
+
+def run_recurring(book, schedules, as_of, apply):
+
+    # Generates every invoice that's due up to as_of and not generated
+    # already. Each invoice carries a marker line naming its schedule and
+    # period in the notes, so a rerun finds it and creates nothing
+    lookups = LookupCache(book)
+
+    markers = recurring_markers(lookups.all_invoices().values())
+
+    results = []
+
+    for schedule in schedules:
+        try:
+            (customer, currency, start, end, due_days, posted_account,
+                entries) = parse_schedule(lookups, schedule)
+        except Error as error:
+            results.append({'schedule': schedule['name'], 'period': None,
+                'status': 'error', 'reason': error.message})
+            continue
+
+        for date in recurring_dates(start, end, schedule['cadence'], as_of):
+            marker = recurring_marker(schedule['name'], date)
+
+            result = {'schedule': schedule['name'], 'period': date.strftime("%Y-%m-%d")}
+            results.append(result)
+
+            if marker in markers:
+                result['status'] = 'exists'
+                continue
+
+            if not apply:
+                result['status'] = 'due'
+                continue
+
+            markers.add(marker)
+
+            id = book.InvoiceNextID(customer)
+            notes = '\n'.join(line for line in [schedule['notes'], marker] if line)
+
+            args = [id, customer.GetID(), currency.get_mnemonic(), result['period'], notes]
+
+            log_operation(book, 'add_invoice', args)
+
+            invoice = create_invoice(book, id, currency, customer, date, notes)
+
+            record_changes(book, 'add_invoice', args, {'id': id})
+
+            lookups.add_invoice(invoice)
+
+            invoice.BeginEdit()
+
+            for entry, account, quantity, price, discount in entries:
+                args = [id, result['period'], entry['description'],
+                    account.GetGUID().to_string(), entry['quantity'], entry['price'],
+                    GNC_AMT_TYPE_VALUE, entry['discount']]
+
+                log_operation(book, 'add_entry', args)
+
+                create_entry(book, invoice, date, entry['description'], account,
+                    quantity, price, GNC_AMT_TYPE_VALUE, discount)
+
+                record_changes(book, 'add_entry', args, None)
+
+            invoice.CommitEdit()
+
+            result['status'] = 'created'
+            result['id'] = id
+            result['posted'] = False
+
+            if posted_account is None:
+                continue
+
+            due_date = date + datetime.timedelta(days=due_days)
+
+            args = [id, posted_account.GetGUID().to_string(), result['period'],
+                due_date.strftime("%Y-%m-%d"), '', False, False]
+
+            log_operation(book, 'post_invoice', args)
+
+            result['posted'] = post_gnucash_invoice(invoice, posted_account, date,
+                due_date, '', False, False)
+
+            record_changes(book, 'post_invoice', args, None)
+
+    return results
+
+def get_entry(book, entry_guid):
+
+    guid = gnucash.gnucash_core.GUID() 
+    gnucash.gnucash_core.GUIDString(entry_guid, guid)
+
+    entry = book.EntryLookup(guid)
+
+    if entry is None:
+        return None
+    else:
+        return gnucash_simple.entryToDict(entry)
+
+@journaled('update_entry')
+def update_entry(book, entry_guid, date, description, account_guid, quantity,
+    price, discount_type, discount):
+
+    guid = gnucash.gnucash_core.GUID() 
+    gnucash.gnucash_core.GUIDString(entry_guid, guid)
+
+    entry = book.EntryLookup(guid)
+
+    if entry is None:
+        raise Error('NoEntry', 'No entry exists with this GUID',
+            {'field': 'entry_guid'})
+
+    try:
+        date = datetime.datetime.strptime(date, "%Y-%m-%d")
+    except ValueError:
+        raise Error('InvalidDateOpened',
+            'The date opened must be provided in the form YYYY-MM-DD',
+            {'field': 'date'})
+
+    # Only check discount type for invoices
+    if entry.GetInvAccount() is not None:
+        # Only value based discounts are supported
+        if discount_type != GNC_AMT_TYPE_VALUE:
+            raise Error('UnsupportedDiscountType', 'Only value based discounts are currently supported',
+                {'field': 'discount_type'})
+ 
+    gnucash.gnucash_core.GUIDString(account_guid, guid)
+
+    account = guid.AccountLookup(book)
+
+    if account is None:
+        raise Error('NoAccount', 'No account exists with this GUID',
+            {'field': 'account_guid'})
+
+    try:
+        quantity = Decimal(quantity).quantize(Decimal('.01'))
+    except ArithmeticError:
+        raise Error('InvalidQuantity', 'This quantity is not valid',
+            {'field': 'quantity'})
+
+    try:
+        price = Decimal(price).quantize(Decimal('.01'))
+    except ArithmeticError:
+        raise Error('InvalidPrice', 'This price is not valid',
+            {'field': 'price'})
+
+    # Only discount for invoices
+    if entry.GetInvAccount() is not None:
+        # Currently only value based discounts are supported
+
+        # As bills may pass the discount though as None check this and raise an error for invoices
+        if discount is None:
+            raise Error('InvalidDiscount', 'This discount is not valid',
+                {'field': 'discount'})
+
+        try:
+            discount = Decimal(discount).quantize(Decimal('.01'))
+        except ArithmeticError:
+            raise Error('InvalidDiscount', 'This discount is not valid',
+                {'field': 'discount'})
+
+    entry.SetDate(date.date())
+
+    entry.SetDateEntered(datetime.datetime.now())
+    entry.SetDescription(description)
+    entry.SetQuantity(gnc_numeric_from_decimal(quantity))
+
+    if entry.GetInvAccount() is not None:
+        entry.SetInvAccount(account)
+        entry.SetInvPrice(gnc_numeric_from_decimal(price))
+    else:
+        entry.SetBillAccount(account)
+        entry.SetBillPrice(gnc_numeric_from_decimal(price))
+
+    # Only set discount for invoices
+    if entry.GetInvAccount() is not None:
+        # Do we need to set this?
+        # entry.SetInvDiscountHow()
+
+        entry.SetInvDiscountType(discount_type)
+        # Currently only value based discounts are supported
+        entry.SetInvDiscount(gnc_numeric_from_decimal(discount))
+
+    return gnucash_simple.entryToDict(entry)
+
+@journaled('delete_entry')
+def delete_entry(book, entry_guid):
+
+    guid = gnucash.gnucash_core.GUID() 
+    gnucash.gnucash_core.GUIDString(entry_guid, guid)
+
+    entry = book.EntryLookup(guid)
+
+    invoice = entry.GetInvoice()
+    bill = entry.GetBill()
+
+    if invoice is not None and entry is not None:
+        invoice.RemoveEntry(entry)
+    elif bill is not None and entry is not None:
+        bill.RemoveEntry(entry)
+
+    if entry is not None:
+        entry.Destroy()
+
+@journaled('delete_transaction')
+def delete_transaction(book, transaction_guid):
+
+    guid = gnucash.gnucash_core.GUID() 
+    gnucash.gnucash_core.GUIDString(transaction_guid, guid)
+
+    transaction = guid.TransLookup(book)
+
+    # Might be nicer to raise a 404?
+    if transaction is None:
+        raise Error('NoTransaction', 'A transaction with this GUID does not exist',
+            {'field': 'id'})
+
+    transaction.Destroy()
+
+@journaled('add_bill')
+def add_bill(book, id, vendor_id, currency_mnumonic, date_opened, notes):
+
+    vendor = book.VendorLookupByID(vendor_id)
+
+    if vendor is None:
+        raise Error('NoVendor', 'A vendor with this ID does not exist',
+            {'field': 'id'})
+
+    if id is None:
+        id = book.BillNextID(vendor)
+
+    try:
+        date_opened = datetime.datetime.strptime(date_opened, "%Y-%m-%d")
+    except ValueError:
+        raise Error('InvalidDateOpened',
+            'The date opened must be provided in the form YYYY-MM-DD',
+            {'field': 'date_opened'})
+
+    currency = bill_currency(book, vendor, currency_mnumonic)
+
+    bill = create_bill(book, id, currency, vendor, date_opened, notes)
+
+    return gnucash_simple.billToDict(bill)
+
+def bill_currency(book, vendor, currency_mnumonic):
+
+    if currency_mnumonic is None:
+        currency_mnumonic = vendor.GetCurrency().get_mnemonic()
+
+    commod_table = book.get_table()
+    currency = commod_table.lookup('CURRENCY', currency_mnumonic)
+
+    if currency is None:
+        raise Error('InvalidBillCurrency',
+            'A valid currency must be supplied for this bill',
+            {'field': 'currency'})
+    elif currency.get_mnemonic() != vendor.GetCurrency().get_mnemonic():
+        # Does Gnucash actually enforce this?
+        raise Error('MismatchedBillCurrency',
+            'The currency of this bill does not match the vendor',
+            {'field': 'currency'})
+
+    return currency
+
+def create_bill(book, id, currency, vendor, date_opened, notes):
+
+    bill = Bill(book, id, currency, vendor, date_opened.date())
+
+    bill.SetNotes(notes)
+
+    return bill
+
+@journaled('add_account')
+def add_account(book, name, currency_mnumonic, account_type_id, parent_account_guid):
+
+    from gnucash.gnucash_core_c import \
+    ACCT_TYPE_BANK, ACCT_TYPE_CASH, ACCT_TYPE_CREDIT, ACCT_TYPE_ASSET, \
+    ACCT_TYPE_LIABILITY , ACCT_TYPE_STOCK , ACCT_TYPE_MUTUAL, \
+    ACCT_TYPE_INCOME, ACCT_TYPE_EXPENSE, ACCT_TYPE_EQUITY, \
+    ACCT_TYPE_RECEIVABLE, ACCT_TYPE_PAYABLE, ACCT_TYPE_TRADING 
+
+    if name == '':
+        raise Error('NoAccountName', 'A name must be entered for this account',
+            {'field': 'name'})
+
+    commod_table = book.get_table()
+    currency = commod_table.lookup('CURRENCY', currency_mnumonic)
+
+    if currency is None:
+        raise Error('InvalidAccountCurrency',
+            'A valid currency must be supplied for this account',
+            {'field': 'currency'})
+
+    if account_type_id not in [ACCT_TYPE_BANK, ACCT_TYPE_CASH, ACCT_TYPE_CREDIT, \
+    ACCT_TYPE_ASSET, ACCT_TYPE_LIABILITY , ACCT_TYPE_STOCK , ACCT_TYPE_MUTUAL, \
+    ACCT_TYPE_INCOME, ACCT_TYPE_EXPENSE, ACCT_TYPE_EQUITY, ACCT_TYPE_RECEIVABLE, \
+    ACCT_TYPE_PAYABLE, ACCT_TYPE_TRADING]:
+        raise Error('InvalidAccountTypeID',
+            'A valid account type ID must be supplied for this account',
+            {'field': 'account_type_id'})
+
+    if parent_account_guid == '':
+        parent_account = book.get_root_account()
+    else:
+        account_guid = gnucash.gnucash_core.GUID() 
+        gnucash.gnucash_core.GUIDString(parent_account_guid, account_guid)
+
+        parent_account = account_guid.AccountLookup(book)
+
+    if parent_account is None:
+        raise Error('InvalidParentAccount',
+            'A valid account parent account must be supplied for this account',
+            {'field': 'parent_account_guid'})
+
+    account = Account(book)
+    parent_account.append_child(account)
+    account.SetName(name)
+    account.SetType(account_type_id)
+    account.SetCommodity(currency)
+
+    return gnucash_simple.accountToDict(account)
+
+@journaled('add_transaction')
+def add_transaction(book, num, description, date_posted, currency_mnumonic, splits,
+    notes=None):
+
+    # Everything is checked before the transaction is created, so an error
+    # never leaves a partly built transaction open in a long lived session
+    commod_table = book.get_table()
+    currency = commod_table.lookup('CURRENCY', currency_mnumonic)
+
+    if currency is None:
+        raise Error('InvalidTransactionCurrency',
+            'A valid currency must be supplied for this transaction',
+            {'field': 'currency'})
+
+    try:
+        date_posted = datetime.datetime.strptime(date_posted, "%Y-%m-%d")
+    except ValueError:
+        raise Error('InvalidDatePosted',
+            'The date posted must be provided in the form YYYY-MM-DD',
+            {'field': 'date_posted'})
+
+    if len(splits) is 0:
+        raise Error('NoSplits',
+            'At least one split must be provided',
+            {'field': 'splits'})
+
+    split_accounts = []
+
+    for split_values in splits:
+        account_guid = gnucash.gnucash_core.GUID() 
+        gnucash.gnucash_core.GUIDString(split_values['account_guid'], account_guid)
+
+        account = account_guid.AccountLookup(book)
+
+        if account is None:
+            raise Error('InvalidSplitAccount',
+                'A valid account must be supplied for this split',
+                {'field': 'account'})
+
+        if account.GetCommodity().get_mnemonic() != currency_mnumonic:
+            raise Error('InvalidSplitAccountCurrency',
+                'The transaction currency must match the account currency for this split',
+                {'field': 'account'})
+
+        # TODO - the API should probably allow numerator and denomiator rather than assue 100 - it would also avoid the issue of rounding errrors with float/int conversion
+        value = split_values['value']
+
+        try: 
+            value = float(value)
+            value = value * 100
+            value = round(value)
+        except ValueError:
+            raise Error('InvalidSplitValue',
+            'A valid value must be supplied for this split',
+            {'field': 'value'})
+        except TypeError:
+            raise Error('InvalidSplitValue',
+            'A valid value must be supplied for this split',
+            {'field': 'value'})
+
+        split_accounts.append((account, value))
+
+    transaction = Transaction(book)
+
+    transaction.BeginEdit()
+
+    for account, value in split_accounts:
+        split = Split(book)
+        split.SetValue(GncNumeric(value, 100))
+        split.SetAccount(account)
+        split.SetParent(transaction)
+
+    # TODO - check that splits match...
+
+    transaction.SetCurrency(currency)
+    transaction.SetDescription(description)
+    transaction.SetNum(num)
+
+    if notes is not None:
+        transaction.SetNotes(notes)
+
+    # This function changes at some point between Gnucash/Python 2/3
+    if sys.version_info >= (3,0):
+        transaction.SetDatePostedSecs(date_posted)
+    else:
+        transaction.SetDatePostedTS(date_posted)
+
+    transaction.CommitEdit()
+
+    return gnucash_simple.transactionToDict(transaction, ['splits'])
+
+def get_transaction(book, transaction_guid):
+
+    guid = gnucash.gnucash_core.GUID() 
+    gnucash.gnucash_core.GUIDString(transaction_guid, guid)
+
+    transaction = guid.TransLookup(book)
+
+    if transaction is None:
+        return None
+    else:
+        return gnucash_simple.transactionToDict(transaction, ['splits'])
+
+@journaled('edit_transaction')
+def edit_transaction(book, transaction_guid, num, description, date_posted,
+    currency_mnumonic, splits):
+
+    guid = gnucash.gnucash_core.GUID() 
+    gnucash.gnucash_core.GUIDString(transaction_guid, guid)
+
+    transaction = guid.TransLookup(book)
+
+    if transaction is None:
+        raise Error('InvalidTransactionGuid',
+            'A transaction with this GUID does not exist',
+            {'field': 'guid'})
+
+    # As with add_transaction nothing is changed until every value is checked
+    commod_table = book.get_table()
+    currency = commod_table.lookup('CURRENCY', currency_mnumonic)
+
+    if currency is None:
+        raise Error('InvalidTransactionCurrency',
+            'A valid currency must be supplied for this transaction',
+            {'field': 'currency'})
+
+    try:
+        date_posted = datetime.datetime.strptime(date_posted, "%Y-%m-%d")
+    except ValueError:
+        raise Error('InvalidDatePosted',
+            'The date posted must be provided in the form YYYY-MM-DD',
+            {'field': 'date_posted'})
+
+    if len(splits) is 0:
+        raise Error('NoSplits',
+            'At least one split must be provided',
+            {'field': 'splits'})
+
+    split_guids = []
+    split_updates = []
+
+    for split_values in splits:
+
+        split_guids.append(split_values['guid']);
+
+        split_guid = gnucash.gnucash_core.GUID() 
+        gnucash.gnucash_core.GUIDString(split_values['guid'], split_guid)
+
+        split = split_guid.SplitLookup(book)
+
+        if split is None:
+            raise Error('InvalidSplitGuid',
+                'A valid guid must be supplied for this split',
+                {'field': 'guid'})
+
+        account_guid = gnucash.gnucash_core.GUID() 
+        gnucash.gnucash_core.GUIDString(
+            split_values['account_guid'], account_guid)
+
+        account = account_guid.AccountLookup(book)
+
+        if account is None:
+            raise Error('InvalidSplitAccount',
+                'A valid account must be supplied for this split',
+                {'field': 'account'})
+
+        if account.GetCommodity().get_mnemonic() != currency_mnumonic:
+            raise Error('InvalidSplitAccountCurrency',
+                'The transaction currency must match the account currency for this split',
+                {'field': 'account'})
+
+        # TODO - the API should probably allow numerator and denomiator rather than assue 100
+        value = split_values['value']
+
+        try: 
+            value = float(value)
+            value = value * 100
+            value = int(value)
+        except ValueError:
+            raise Error('InvalidSplitValue',
+            'A valid value must be supplied for this split',
+            {'field': 'value'})
+        except TypeError:
+            raise Error('InvalidSplitValue',
+            'A valid value must be supplied for this split',
+            {'field': 'value'})
+
+        split_updates.append((split, account, value))
+
+    if len(split_guids) != len(set(split_guids)):
+        raise Error('DuplicateSplitGuid',
+            'One of the splits provided shares a GUID with another split',
+            {'field': 'guid'})
+
+    transaction.BeginEdit()
+
+    for split, account, value in split_updates:
+        split.SetValue(GncNumeric(value, 100))
+        split.SetAccount(account)
+        split.SetParent(transaction)
+
+    transaction.SetCurrency(currency)
+    transaction.SetDescription(description)
+    transaction.SetNum(num)
+
+    # This function changes at some point between Guncash/Python 2/3
+    if sys.version_info >= (3,0):
+        transaction.SetDatePostedSecs(date_posted)
+    else:
+        transaction.SetDatePostedTS(date_posted)
+
+    transaction.CommitEdit()
+
+    return gnucash_simple.transactionToDict(transaction, ['splits'])
+
+def start_session(connection_string, is_new, ignore_lock):
+
+    global session
+    global session_connection_string
+
+    # If no parameters are supplied attempt to use the app.connection_string if one exists
+    if connection_string == '' and is_new == '' and  ignore_lock == '' and hasattr(app, 'connection_string') and app.connection_string != '':
+        is_new = False
+        ignore_lock = False
+        connection_string = app.connection_string
+
+    if connection_string == '':
+        raise Error('InvalidConnectionString', 'A connection string must be supplied',
+            {'field': 'connection_string'})
+
+    if str(is_new).lower() in ['true', '1', 't', 'y', 'yes']:
+        is_new = True
+    elif str(is_new).lower() in ['false', '0', 'f', 'n', 'no']:
+        is_new = False
+    else:
+        raise Error('InvalidIsNew', 'is_new must be true or false',
+            {'field': 'is_new'})
+
+    if str(ignore_lock).lower() in ['true', '1', 't', 'y', 'yes']:
+        ignore_lock = True
+    elif str(ignore_lock).lower() in ['false', '0', 'f', 'n', 'no']:
+        ignore_lock = False
+    else:
+        raise Error('InvalidIgnoreLock', 'ignore_lock must be true or false',
+            {'field': 'ignore_lock'})
+
+    if session is not None:
+        raise Error('SessionExists',
+            'The session already exists',
+            {})
+
+    try:
+        session = gnucash.Session(connection_string, is_new=is_new, ignore_lock=ignore_lock)
+    except gnucash.GnuCashBackendException as e:
+        raise Error('GnuCashBackendException',
+            'There was an error starting the session',
+            {
+                'message': e.args[0],
+                'code': parse_gnucash_backend_exception(e.args[0])
+            })
+
+    session_connection_string = connection_string
+
+    return session
+
+def start_write_session(connection_string, ignore_lock=True):
+
+    global journal
+    global changes
+    global session_base_fingerprint
+
+    # Fingerprint before opening as taking the lock may touch the book
+    fingerprint = book_fingerprint(connection_string)
+
+    session = start_session(connection_string, False, ignore_lock)
+
+    journal = open_journal(connection_string)
+    changes = ChangeSet()
+    session_base_fingerprint = fingerprint
+
+    if journal is None:
+        return session
+
+    try:
+        replay_journal(session.book, fingerprint)
+    except Error:
+        # The replayed operations still haven't reached the book
+        close_journal(False)
+        end_session(False)
+        raise
+
+    return session
+
+def replay_journal(book, fingerprint):
+
+    entries = journal.read()
+
+    if len(entries) == 0:
+        return 0
+
+    if fingerprint is None:
+        # Database backends commit as they go so there is no way to tell
+        # what was lost, but at most it was the operation in flight
+        sys.stderr.write('Discarding journal of %d operations as the book '
+            'cannot be fingerprinted\n' % len(entries))
+        journal.truncate()
+        return 0
+
+    # Replay from the operation that was logged against the book as it is
+    # now, anything before it already reached the book
+    pending = None
+
+    for i, entry in enumerate(entries):
+        if entry['base'] == fingerprint:
+            pending = entries[i:]
+            break
+
+    if pending is None:
+        journal.truncate()
+        return 0
+
+    # Replayed operations aren't recorded so sidecars need a full pass
+    changes.everything = True
+
+    for i, entry in enumerate(pending):
+
+        base = book_fingerprint(session_connection_string)
+
+        # Backends that write as they go move the book on with every
+        # replayed operation, so rebase what's left of the journal in case
+        # the replay itself is interrupted
+        if entry['base'] != base:
+            entry['base'] = base
+            journal.rewrite(pending[i:])
+
+        try:
+            journaled_operations[entry['op']](book, *entry['args'])
+        except Error as error:
+            sys.stderr.write('Replaying ' + entry['op'] + ' failed: '
+                + error.message + '\n')
+        except Exception as error:
+            # Anything else is logged and skipped too, so one bad entry
+            # can't stop every later start
+            sys.stderr.write('Replaying ' + entry['op'] + ' failed: '
+                + repr(error) + '\n')
+
+    save_session()
+
+    sys.stderr.write('Replayed %d journaled operations\n' % len(pending))
+
+    return len(pending)
+
+def start_read_session(connection_string, use_replica=True):
+
+    # Read only commands are routed to the read replica of SQLite books so
+    # they never contend with a writer on the live book
+    if use_replica and is_sqlite_book(connection_string):
+        if not replica_is_current(connection_string):
+            refresh_replica(connection_string)
+
+        replica = sidecar_path(connection_string, 'replica')
+
+        return start_session('sqlite3://' + os.path.abspath(replica), False, True)
+
+    return start_session(connection_string, False, True)
+
+def end_session(save=True):
+
+    global session
+    global session_connection_string
+    global changes
+    global session_base_fingerprint
+
+    if session == None:
+        raise Error('SessionDoesNotExist',
+            'The session does not exist',
+            {})
+
+    if save:
+        save_session()
+
+    session.end()
+    session.destroy()
+
+    session = None
+
+    # A session ended without saving is abandoned, so is its journal
+    close_journal(not save)
+
+    changes = None
+
+    connection_string = session_connection_string
+    session_connection_string = None
+
+    if save:
+        saved_fingerprint = session_base_fingerprint
+        fingerprint = book_fingerprint(connection_string)
+
+        for hook in end_hooks:
+            run_sidecar_hook(hook, connection_string, saved_fingerprint, fingerprint)
+
+    session_base_fingerprint = None
+
+    # Refresh the replica once the writer has let go of the book, a failure
+    # here shouldn't fail the write as readers will refresh a stale replica
+    if save and is_sqlite_book(connection_string):
+        try:
+            refresh_replica(connection_string)
+        except Error as error:
+            sys.stderr.write(error.message + '\n')
+
+def save_session():
+
+    global changes
+    global session_base_fingerprint
+
+    if session == None:
+        raise Error('SessionDoesNotExist',
+            'The session does not exist',
+            {})
+
+    try:
+        session.save()
+    except gnucash.GnuCashBackendException as e:
+        raise Error('GnuCashBackendException',
+            'There was an error saving the session',
+            {
+                'message': e.args[0],
+                'code': parse_gnucash_backend_exception(e.args[0])
+            })
+
+    # Everything journaled so far is now in the book
+    if journal is not None:
+        journal.truncate()
+
+    if changes is not None:
+        for hook in save_hooks:
+            run_sidecar_hook(hook, session_connection_string, session.book)
+
+        changes = ChangeSet()
+        session_base_fingerprint = book_fingerprint(session_connection_string)
+
+def run_sidecar_hook(hook, *args):
+
+    # The book has already been saved, so a sidecar that can't be updated
+    # mustn't fail the command. Each sidecar only records the book's
+    # fingerprint once its update is complete, so a failed one keeps its
+    # old fingerprint and is rebuilt as stale by the next reader or writer
+    try:
+        hook(*args)
+    except (sqlite3.Error, OSError, Error) as e:
+        message = e.message if isinstance(e, Error) else str(e)
+
+        sys.stderr.write('The ' + hook.__name__.split('_', 1)[1].replace('_', ' ')
+            + ' sidecar could not be updated and will be rebuilt: ' + message + '\n')
+
+def get_session():
+
+    global session
+
+    if session == None:
+        raise Error('SessionDoesNotExist',
+            'The session does not exist',
+            {})
+
+    return session
+
+def book_path(connection_string):
+
+    # Returns the local file behind a connection string or None for the
+    # database backends
+    match = re.match(r'^([a-z0-9]+)://(.*)$', connection_string)
+
+    if match is None:
+        return connection_string
+    elif match.group(1) in ['sqlite3', 'xml', 'file']:
+        return match.group(2)
+    else:
+        return None
+
+def is_sqlite_book(connection_string):
+
+    path = book_path(connection_string)
+
+    if path is None or not os.path.isfile(path):
+        return False
+
+    with open(path, 'rb') as book_file:
+        return book_file.read(16) == b'SQLite format 3\x00'
+
+def book_fingerprint(connection_string):
+
+    path = book_path(connection_string)
+
+    if path is None or not os.path.exists(path):
+        return None
+
+    fingerprint = []
+
+    # SQLite may hold committed pages in the WAL so include it if present
+    for file_path in [path, path + '-wal']:
+        if os.path.exists(file_path):
+            stat = os.stat(file_path)
+            fingerprint.append([stat.st_size, stat.st_mtime_ns])
+
+    return fingerprint
+
+def sidecar_path(connection_string, name):
+
+    path = book_path(connection_string)
+
+    if path is not None:
+        return path + '.gncli-' + name
+
+    # Database backends have no file to sit beside so use a per user cache
+    cache_dir = os.path.join(os.path.expanduser('~'), '.cache', 'gncli')
+
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+
+    return os.path.join(cache_dir,
+        hashlib.sha1(connection_string.encode('utf-8')).hexdigest() + '.' + name)
+
+def write_file_atomic(path, data):
+
+    # Write to a temporary file in the same directory and rename it over the
+    # target so readers never see a partially written file
+    handle, temp_path = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(path)), prefix='.gncli-')
+
+    try:
+        with os.fdopen(handle, 'wb') as temp_file:
+            temp_file.write(data)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+def read_sidecar_json(connection_string, name):
+
+    path = sidecar_path(connection_string, name)
+
+    try:
+        with open(path, 'r') as sidecar_file:
+            return json.load(sidecar_file)
+    except (IOError, OSError, ValueError):
+        return None
+
+def write_sidecar_json(connection_string, name, data):
+
+    write_file_atomic(sidecar_path(connection_string, name),
+        json.dumps(data).encode('utf-8'))
+
+def replica_is_current(connection_string):
+
+    replica = read_sidecar_json(connection_string, 'replica.json')
+
+    if replica is None or not os.path.exists(sidecar_path(connection_string, 'replica')):
+        return False
+
+    return replica['fingerprint'] == book_fingerprint(connection_string)
+
+def refresh_replica(connection_string):
+
+    if not is_sqlite_book(connection_string):
+        raise Error('ReplicaNotSupported',
+            'Read replicas are only supported for SQLite books',
+            {'field': 'connection_string'})
+
+    path = os.path.abspath(book_path(connection_string))
+    replica = sidecar_path(connection_string, 'replica')
+
+    # Take the fingerprint before copying so a write that lands during the
+    # backup leaves the replica looking stale rather than current
+    fingerprint = book_fingerprint(connection_string)
+
+    handle, temp_path = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(replica)), prefix='.gncli-')
+    os.close(handle)
+
+    try:
+        source = sqlite3.connect('file:' + pathname2url(path) + '?mode=ro', uri=True)
+        target = sqlite3.connect(temp_path)
+
+        try:
+            # The online backup API gives a consistent copy without
+            # blocking the writer for longer than the copy itself
+            source.backup(target)
+
+            # Drop any lock held by the writer at the time of the copy
+            try:
+                target.execute('DELETE FROM gnclock')
+                target.commit()
+            except sqlite3.OperationalError:
+                pass
+        finally:
+            target.close()
+            source.close()
+
+        os.replace(temp_path, replica)
+    except sqlite3.Error as e:
+        os.remove(temp_path)
+        raise Error('ReplicaFailed',
+            'There was an error refreshing the read replica',
+            {'message': str(e)})
+
+    write_sidecar_json(connection_string, 'replica.json',
+        {'fingerprint': fingerprint, 'refreshed': time.time()})
+
+    return replica
+
+def parse_gnucash_backend_exception(exception_string):
+    # Argument is of the form "call to %s resulted in the following errors, %s" - extract the second string
+    reresult = re.match(r'^call to (.*?) resulted in the following errors, (.*?)$', exception_string)
+    if len(reresult.groups()) == 2:
+        return reresult.group(2)
+    else:
+        return ''
+
+def sint(s):
+    try:
+        return int(s)
+    except ValueError:
+        return None
+
+def gnc_numeric_from_decimal(decimal_value):
+    sign, digits, exponent = decimal_value.as_tuple()
+
+    # convert decimal digits to a fractional numerator
+    # equivlent to
+    # numerator = int(''.join(digits))
+    # but without the wated conversion to string and back,
+    # this is probably the same algorithm int() uses
+    numerator = 0
+    TEN = int(Decimal(0).radix()) # this is always 10
+    numerator_place_value = 1
+    # add each digit to the final value multiplied by the place value
+    # from least significant to most sigificant
+    for i in range(len(digits)-1,-1,-1):
+        numerator += digits[i] * numerator_place_value
+        numerator_place_value *= TEN
+
+    if decimal_value.is_signed():
+        numerator = -numerator
+
+    # if the exponent is negative, we use it to set the denominator
+    if exponent < 0 :
+        denominator = TEN ** (-exponent)
+    # if the exponent isn't negative, we bump up the numerator
+    # and set the denominator to 1
+    else:
+        numerator *= TEN ** exponent
+        denominator = 1
+
+    return GncNumeric(numerator, denominator)
+
+def normalise_text(text):
+
+    return ' '.join(text.lower().split())
+
+def trigrams(text):
+
+    # Pad so short words and word boundaries still produce grams
+    text = '  ' + normalise_text(text) + ' '
+
+    return set(text[i:i + 3] for i in range(len(text) - 2))
+
+def get_name_records(book, kind):
+
+    # The fields indexed for each customer or vendor, keyed by ID
+    query = gnucash.Query()
+    query.set_book(book)
+
+    if kind == 'customer':
+        query.search_for('gncCustomer')
+        owner_class = gnucash.gnucash_business.Customer
+    else:
+        query.search_for('gncVendor')
+        owner_class = gnucash.gnucash_business.Vendor
+
+    records = {}
+
+    for result in query.run():
+        owner = owner_class(instance=result)
+        address = owner.GetAddr()
+
+        records[owner.GetID()] = [owner.GetID(), owner.GetName(),
+            address.GetName(), address.GetEmail(), address.GetAddr1(),
+            address.GetAddr2(), address.GetAddr3(), address.GetAddr4()]
+
+    query.destroy()
+
+    return records
+
+class NameIndex(object):
+
+    # A persistent trigram index over customer and vendor fields, kept in a
+    # sidecar so searches don't need to open the book
+
+    def __init__(self, data=None):
+
+        if data is None:
+            data = {'fingerprint': None, 'kinds': {}}
+
+        self.fingerprint = data['fingerprint']
+        self.records = {}
+        self.grams = {}
+
+        for kind, kind_data in data['kinds'].items():
+            self.records[kind] = kind_data['records']
+            self.grams[kind] = dict((gram, set(ids))
+                for gram, ids in kind_data['grams'].items())
+
+    @classmethod
+    def load(cls, connection_string):
+        return cls(read_sidecar_json(connection_string, 'names'))
+
+    def save(self, connection_string):
+
+        kinds = {}
+
+        for kind in self.records:
+            kinds[kind] = {
+                'records': self.records[kind],
+                'grams': dict((gram, sorted(ids))
+                    for gram, ids in self.grams[kind].items())
+            }
+
+        write_sidecar_json(connection_string, 'names',
+            {'fingerprint': self.fingerprint, 'kinds': kinds})
+
+    def record_grams(self, fields):
+
+        grams = set()
+
+        for field in fields:
+            if field:
+                grams |= trigrams(field)
+
+        return grams
+
+    def update(self, kind, records):
+
+        # Only re-index records whose fields changed since the last build
+        old_records = self.records.setdefault(kind, {})
+        grams = self.grams.setdefault(kind, {})
+
+        changed = 0
+
+        for id in list(old_records.keys()):
+            if records.get(id) != old_records[id]:
+                for gram in self.record_grams(old_records[id]):
+                    grams[gram].discard(id)
+
+                    if len(grams[gram]) == 0:
+                        del grams[gram]
+
+                del old_records[id]
+                changed += 1
+
+        for id, fields in records.items():
+            if id not in old_records:
+                for gram in self.record_grams(fields):
+                    grams.setdefault(gram, set()).add(id)
+
+                old_records[id] = fields
+                changed += 1
+
+        return changed
+
+    def search(self, kind, text, limit):
+
+        query_grams = trigrams(text)
+        grams = self.grams.get(kind, {})
+        records = self.records.get(kind, {})
+
+        hits = {}
+
+        for gram in query_grams:
+            for id in grams.get(gram, []):
+                hits[id] = hits.get(id, 0) + 1
+
+        text = normalise_text(text)
+
+        results = []
+
+        for id, count in hits.items():
+            fields = records[id]
+
+            # Rank by how much of the query matched, favouring exact
+            # substrings and then records without much else in them
+            score = count / float(len(query_grams))
+
+            if any(text in normalise_text(field) for field in fields if field):
+                score += 1
+
+            dice = 2.0 * count / (len(query_grams) + len(self.record_grams(fields)))
+
+            results.append((score, dice, id))
+
+        results.sort(key=lambda result: (-result[0], -result[1], result[2]))
+
+        return [{'id': id, 'name': records[id][1], 'score': round(score, 3)}
+            for score, dice, id in results[:limit]]
+
+def search_names(connection_string, kind, text, limit, use_replica=True):
+
+    index = NameIndex.load(connection_string)
+
+    fingerprint = book_fingerprint(connection_string)
+
+    if index.fingerprint is None or index.fingerprint != fingerprint:
+        session = start_read_session(connection_string, use_replica)
+
+        try:
+            for index_kind in ['customer', 'vendor']:
+                index.update(index_kind, get_name_records(session.book, index_kind))
+        finally:
+            end_session(False)
+
+        index.fingerprint = fingerprint
+        index.save(connection_string)
+
+    return index.search(kind, text, limit)
+
+def invoice_texts(invoice):
+
+    texts = [invoice.GetID(), invoice.GetNotes(), invoice.GetOwner().GetName()]
+
+    for entry in invoice.GetEntries():
+        texts.append(entry.GetDescription())
+
+    return texts
+
+def transaction_document(transaction):
+
+    texts = [transaction.GetNum(), transaction.GetDescription(),
+        transaction.GetNotes()]
+
+    total = Decimal(0)
+
+    for split in transaction.GetSplitList():
+        texts.append(split.GetMemo())
+
+        value = gnc_numeric_to_decimal(split.GetValue())
+
+        if value > 0:
+            total += value
+
+    # Posting transactions also carry their invoice's notes and entries
+    invoice = transaction.GetInvoiceFromTxn()
+
+    if invoice is not None:
+        texts.extend(invoice_texts(invoice))
+
+    date = transaction.GetDate().strftime("%Y-%m-%d")
+
+    summary = ' '.join([date, transaction.GetDescription(),
+        str(total.quantize(Decimal('.01'))),
+        transaction.GetCurrency().get_mnemonic()])
+
+    return {
+        'key': 'transaction:' + transaction.GetGUID().to_string(),
+        'guid': transaction.GetGUID().to_string(),
+        'kind': 'transaction',
+        'date': date,
+        'summary': summary,
+        'body': '\n'.join(text for text in texts if text)
+    }
+
+def invoice_document(invoice, kind):
+
+    # Only used for unposted invoices, posted ones are found through their
+    # posting transaction
+    date = invoice.GetDateOpened().strftime("%Y-%m-%d")
+
+    summary = ' '.join([date, kind.capitalize(), invoice.GetID(),
+        invoice.GetOwner().GetName(),
+        str(gnc_numeric_to_decimal(invoice.GetTotal()).quantize(Decimal('.01'))),
+        invoice.GetCurrency().get_mnemonic()])
+
+    return {
+        'key': 'invoice:' + invoice.GetGUID().to_string(),
+        'guid': invoice.GetGUID().to_string(),
+        'kind': kind,
+        'date': date,
+        'summary': summary,
+        'body': '\n'.join(text for text in invoice_texts(invoice) if text)
+    }
+
+def invoice_transactions(invoice):
+
+    # The posting transaction and any payments against the posted lot
+    transactions = {}
+
+    lot = invoice.GetPostedLot()
+
+    if lot is not None:
+        for split in lot.get_split_list():
+            transaction = split.GetParent()
+            transactions[transaction.GetGUID().to_string()] = transaction
+
+    transaction = invoice.GetPostedTxn()
+
+    if transaction is not None:
+        transactions[transaction.GetGUID().to_string()] = transaction
+
+    return list(transactions.values())
+
+class SearchIndex(object):
+
+    # An SQLite FTS5 sidecar over transaction descriptions, notes and split
+    # memos plus invoice notes and entry descriptions
+
+    def __init__(self, connection_string):
+        self.connection = sqlite3.connect(sidecar_path(connection_string, 'search'))
+        self.connection.execute('CREATE TABLE IF NOT EXISTS meta '
+            '(name TEXT PRIMARY KEY, value TEXT)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS documents '
+            '(id INTEGER PRIMARY KEY, key TEXT UNIQUE, hash TEXT, guid TEXT, '
+            'kind TEXT, date TEXT, summary TEXT)')
+        self.connection.execute('CREATE VIRTUAL TABLE IF NOT EXISTS search '
+            'USING fts5(body)')
+
+    @staticmethod
+    def exists(connection_string):
+        return os.path.exists(sidecar_path(connection_string, 'search'))
+
+    def get_fingerprint(self):
+
+        row = self.connection.execute(
+            "SELECT value FROM meta WHERE name = 'fingerprint'").fetchone()
+
+        if row is None:
+            return None
+        else:
+            return json.loads(row[0])
+
+    def set_fingerprint(self, fingerprint):
+
+        self.connection.execute("INSERT OR REPLACE INTO meta VALUES ('fingerprint', ?)",
+            (json.dumps(fingerprint),))
+        self.connection.commit()
+
+    def put(self, document):
+
+        # Unchanged documents are skipped so refreshes only pay for changes
+        hash = hashlib.sha1((document['summary'] + '\n' + document['body'])
+            .encode('utf-8')).hexdigest()
+
+        row = self.connection.execute('SELECT id, hash FROM documents WHERE key = ?',
+            (document['key'],)).fetchone()
+
+        if row is not None and row[1] == hash:
+            return False
+
+        self.remove(document['key'])
+
+        cursor = self.connection.execute('INSERT INTO documents '
+            '(key, hash, guid, kind, date, summary) VALUES (?, ?, ?, ?, ?, ?)',
+            (document['key'], hash, document['guid'], document['kind'],
+            document['date'], document['summary']))
+        self.connection.execute('INSERT INTO search (rowid, body) VALUES (?, ?)',
+            (cursor.lastrowid, document['body']))
+
+        return True
+
+    def remove(self, key):
+
+        row = self.connection.execute('SELECT id FROM documents WHERE key = ?',
+            (key,)).fetchone()
+
+        if row is not None:
+            self.connection.execute('DELETE FROM search WHERE rowid = ?', row)
+            self.connection.execute('DELETE FROM documents WHERE id = ?', row)
+
+    def rebuild(self, book):
+
+        seen = set()
+
+        query = gnucash.Query()
+        query.search_for('Trans')
+        query.set_book(book)
+
+        for result in query.run():
+            document = transaction_document(Transaction(instance=result))
+            seen.add(document['key'])
+            self.put(document)
+
+        query.destroy()
+
+        for invoice in get_gnucash_invoices(book, {'is_posted': 0}):
+            document = invoice_document(invoice, 'invoice')
+            seen.add(document['key'])
+            self.put(document)
+
+        for bill in get_gnucash_bills(book, {'is_posted': 0}):
+            document = invoice_document(bill, 'bill')
+            seen.add(document['key'])
+            self.put(document)
+
+        for key, in self.connection.execute('SELECT key FROM documents').fetchall():
+            if key not in seen:
+                self.remove(key)
+
+        self.connection.commit()
+
+    def update(self, book, changes):
+
+        existing = set()
+
+        for transaction in changed_transactions(book, changes):
+            existing.add(transaction.GetGUID().to_string())
+            self.put(transaction_document(transaction))
+
+        for transaction_guid in changes.transactions - existing:
+            self.remove('transaction:' + transaction_guid)
+
+        for kind, invoice in changed_invoices(book, changes):
+            if invoice.IsPosted():
+                self.remove('invoice:' + invoice.GetGUID().to_string())
+
+                for transaction in invoice_transactions(invoice):
+                    self.put(transaction_document(transaction))
+            else:
+                self.put(invoice_document(invoice, kind))
+
+        self.connection.commit()
+
+    def search(self, text, limit):
+
+        # Quote each word so the query is matched as plain text
+        terms = ' '.join('"' + word.replace('"', '""') + '"'
+            for word in text.split())
+
+        if terms == '':
+            return []
+
+        rows = self.connection.execute('SELECT documents.guid, documents.kind, '
+            'documents.date, documents.summary FROM search '
+            'JOIN documents ON documents.id = search.rowid '
+            'WHERE search MATCH ? ORDER BY rank LIMIT ?', (terms, limit))
+
+        return [{'guid': guid, 'kind': kind, 'date': date, 'summary': summary}
+            for guid, kind, date, summary in rows]
+
+    def close(self):
+        self.connection.close()
+
+def update_search_index(connection_string, book):
+
+    if not SearchIndex.exists(connection_string):
+        return
+
+    index = SearchIndex(connection_string)
+
+    try:
+        # The session's changes are only enough if the index was current
+        # before them, otherwise compare every document
+        if changes.everything or index.get_fingerprint() != session_base_fingerprint:
+            index.rebuild(book)
+        else:
+            index.update(book, changes)
+
+        index.set_fingerprint(book_fingerprint(connection_string))
+    finally:
+        index.close()
+
+def restamp_search_index(connection_string, saved_fingerprint, fingerprint):
+
+    if not SearchIndex.exists(connection_string):
+        return
+
+    index = SearchIndex(connection_string)
+
+    try:
+        # Ending the session may touch the book without changing its content
+        if saved_fingerprint is not None and index.get_fingerprint() == saved_fingerprint:
+            index.set_fingerprint(fingerprint)
+    finally:
+        index.close()
+
+save_hooks.append(update_search_index)
+end_hooks.append(restamp_search_index)
+
+def search_transactions(connection_string, text, limit, use_replica=True):
+
+    index = SearchIndex(connection_string)
+
+    try:
+        fingerprint = book_fingerprint(connection_string)
+
+        if fingerprint is None or index.get_fingerprint() != fingerprint:
+            session = start_read_session(connection_string, use_replica)
+
+            try:
+                index.rebuild(session.book)
+            finally:
+                end_session(False)
+
+            index.set_fingerprint(fingerprint)
+
+        return index.search(text, limit)
+    finally:
+        index.close()
+
+class Interner(object):
+
+    # Shares one copy of values that repeat across rows, such as currencies,
+    # dates, account GUIDs and owners
+
+    def __init__(self):
+        self.values = {}
+
+    def __call__(self, value):
+        return self.values.setdefault(value, value)
+
+class Record(object):
+
+    # Compact result rows, slots instead of a per row dict, converted to
+    # dicts only when they are output
+
+    __slots__ = ()
+
+    def __init__(self, *values):
+        for name, value in zip(self.__slots__, values):
+            setattr(self, name, value)
+
+    def as_tuple(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def to_dict(self):
+        return dict((name, getattr(self, name)) for name in self.__slots__)
+
+def numeric_value(num, denom):
+
+    # Exact decimal strings rather than floats, which lose cents
+    digits = len(str(denom)) - 1
+    if denom == 10 ** digits:
+        return '{:f}'.format(Decimal(num).scaleb(-digits))
+    return '{:f}'.format(Decimal(num) / Decimal(denom))
+
+class OwnerRecord(Record):
+
+    __slots__ = ('guid', 'id', 'name', 'currency')
+
+class AccountRecord(Record):
+
+    __slots__ = ('guid', 'name', 'full_name', 'type', 'commodity', 'scu',
+        'parent_guid')
+
+class EntryRecord(Record):
+
+    __slots__ = ('guid', 'date', 'description', 'account_guid',
+        'quantity_num', 'quantity_denom', 'price_num', 'price_denom',
+        'discount_num', 'discount_denom', 'discount_type')
+
+    def amount(self):
+
+        # The line's value as GnuCash computes it, after the discount
+        amount = Decimal(self.quantity_num) * Decimal(self.price_num) \
+            / Decimal(self.quantity_denom * self.price_denom)
+        discount = Decimal(self.discount_num) / Decimal(self.discount_denom)
+
+        if self.discount_type == 'percent':
+            return amount - amount * discount / 100
+
+        return amount - discount
+
+    def to_dict(self):
+        return {
+            'guid': self.guid,
+            'date': self.date,
+            'description': self.description,
+            'account_guid': self.account_guid,
+            'quantity': numeric_value(self.quantity_num, self.quantity_denom),
+            'price': numeric_value(self.price_num, self.price_denom),
+            'discount': numeric_value(self.discount_num, self.discount_denom),
+            'discount_type': self.discount_type
+        }
+
+class InvoiceRecord(Record):
+
+    __slots__ = ('guid', 'id', 'owner', 'currency', 'date_opened',
+        'date_posted', 'date_due', 'notes', 'active', 'posted', 'paid',
+        'total_num', 'total_denom', 'entries')
+
+    def to_dict(self):
+        return {
+            'guid': self.guid,
+            'id': self.id,
+            'owner': self.owner.to_dict(),
+            'currency': self.currency,
+            'date_opened': self.date_opened,
+            'date_posted': self.date_posted,
+            'date_due': self.date_due,
+            'notes': self.notes,
+            'active': self.active,
+            'posted': self.posted,
+            'paid': self.paid,
+            'total': numeric_value(self.total_num, self.total_denom),
+            'entries': [entry.to_dict() for entry in self.entries]
+        }
+
+class SplitRecord(Record):
+
+    __slots__ = ('guid', 'transaction_guid', 'account_guid', 'date', 'num',
+        'description', 'memo', 'currency', 'value_num', 'value_denom',
+        'amount_num', 'amount_denom', 'reconcile')
+
+    def to_dict(self):
+        return {
+            'guid': self.guid,
+            'transaction_guid': self.transaction_guid,
+            'account_guid': self.account_guid,
+            'date': self.date,
+            'num': self.num,
+            'description': self.description,
+            'memo': self.memo,
+            'currency': self.currency,
+            'value': numeric_value(self.value_num, self.value_denom),
+            'amount': numeric_value(self.amount_num, self.amount_denom),
+            'reconcile': self.reconcile
+        }
+
+def format_date(date, intern):
+
+    if date is None or date.strftime("%Y-%m-%d") == '1970-01-01':
+        return None
+
+    return intern(date.strftime("%Y-%m-%d"))
+
+def owner_record(owner, owners, intern):
+
+    guid = owner.GetGUID().to_string()
+
+    if guid not in owners:
+        owners[guid] = OwnerRecord(intern(guid), owner.GetID(), owner.GetName(),
+            intern(owner.GetCurrency().get_mnemonic()))
+
+    return owners[guid]
+
+def invoice_record(invoice, with_entries, owners, intern):
+
+    entries = ()
+
+    if with_entries:
+        entries = tuple(entry_record(entry, intern) for entry in invoice.GetEntries())
+
+    total = invoice.GetTotal()
+
+    return InvoiceRecord(invoice.GetGUID().to_string(), invoice.GetID(),
+        owner_record(invoice.GetOwner(), owners, intern),
+        intern(invoice.GetCurrency().get_mnemonic()),
+        format_date(invoice.GetDateOpened(), intern),
+        format_date(invoice.GetDatePosted(), intern),
+        format_date(invoice.GetDateDue(), intern),
+        invoice.GetNotes(), invoice.GetActive(), invoice.IsPosted(),
+        invoice.IsPaid(), total.num(), total.denom(), entries)
+
+def entry_record(entry, intern):
+
+    account = entry.GetInvAccount()
+
+    # Bill entries have no discount
+    if account is None:
+        account = entry.GetBillAccount()
+        price = entry.GetBillPrice()
+        discount = GncNumeric(0, 1)
+        discount_type = 'value'
+    else:
+        price = entry.GetInvPrice()
+        discount = entry.GetInvDiscount()
+
+        if entry.GetInvDiscountType() == GNC_AMT_TYPE_PERCENT:
+            discount_type = 'percent'
+        else:
+            discount_type = 'value'
+
+    if account is None:
+        account_guid = None
+    else:
+        account_guid = intern(account.GetGUID().to_string())
+
+    quantity = entry.GetQuantity()
+
+    return EntryRecord(entry.GetGUID().to_string(),
+        format_date(entry.GetDate(), intern), entry.GetDescription(),
+        account_guid, quantity.num(), quantity.denom(), price.num(),
+        price.denom(), discount.num(), discount.denom(), discount_type)
+
+def get_invoice_records(book, properties, with_entries=False):
+
+    owners = {}
+    intern = Interner()
+
+    records = []
+
+    for invoice in get_gnucash_invoices(book, properties):
+        records.append(invoice_record(invoice, with_entries, owners, intern))
+
+    return records
+
+def get_bill_records(book, properties, with_entries=False):
+
+    owners = {}
+    intern = Interner()
+
+    records = []
+
+    for bill in get_gnucash_bills(book, properties):
+        records.append(invoice_record(bill, with_entries, owners, intern))
+
+    return records
+
+STATS_GROUPS = ['owner', 'month', 'year', 'status', 'currency']
+
+STATS_METRICS = ['count', 'total', 'outstanding']
+
+def minor_units(num, denom, fraction):
+
+    # A gnc_numeric as a whole number of the currency's smallest unit,
+    # rounded half away from zero
+    units, remainder = divmod(abs(num) * fraction, denom)
+
+    if remainder * 2 >= denom:
+        units += 1
+
+    return units if num >= 0 else -units
+
+def invoice_stats(invoices, group_by, metrics, sign):
+
+    # One pass over the query results into integer counters keyed by the
+    # group, reading only the attributes the groups and metrics need.
+    # Amounts in different currencies never share a counter so currency is
+    # always part of the key. sign is -1 for bills, whose lots carry a
+    # credit balance
+    groups = {}
+    owners = {}
+    fractions = {}
+
+    for invoice in invoices:
+        currency = invoice.GetCurrency()
+        mnemonic = currency.get_mnemonic()
+
+        if mnemonic not in fractions:
+            fractions[mnemonic] = currency.get_fraction()
+
+        fraction = fractions[mnemonic]
+
+        posted = None
+        key = []
+
+        for group in group_by:
+            if group == 'owner':
+                owner = invoice.GetOwner()
+                value = owner.GetID()
+
+                if value not in owners:
+                    owners[value] = owner.GetName()
+            elif group in ['month', 'year']:
+                if posted is None:
+                    posted = invoice.IsPosted()
+
+                # Unposted invoices count from when they were opened
+                date = invoice.GetDatePosted() if posted else invoice.GetDateOpened()
+                value = date.strftime("%Y-%m" if group == 'month' else "%Y")
+            elif group == 'status':
+                if posted is None:
+                    posted = invoice.IsPosted()
+
+                if not posted:
+                    value = 'unposted'
+                elif invoice.IsPaid():
+                    value = 'paid'
+                else:
+                    value = 'unpaid'
+            else:
+                value = mnemonic
+
+            key.append(value)
+
+        if 'currency' not in group_by:
+            key.append(mnemonic)
+
+        key = tuple(key)
+
+        counters = groups.get(key)
+
+        if counters is None:
+            counters = groups[key] = [0, 0, 0]
+
+        counters[0] += 1
+
+        if 'total' in metrics:
+            total = invoice.GetTotal()
+            counters[1] += minor_units(total.num(), total.denom(), fraction)
+
+        if 'outstanding' in metrics:
+            if posted is None:
+                posted = invoice.IsPosted()
+
+            lot = invoice.GetPostedLot() if posted else None
+
+            if lot is not None and not invoice.IsPaid():
+                for split in lot.get_split_list():
+                    amount = split.GetAmount()
+                    counters[2] += sign * minor_units(amount.num(), amount.denom(),
+                        fraction)
+
+    columns = group_by + [column for column in ['currency'] if column not in group_by]
+
+    results = []
+
+    for key, counters in sorted(groups.items()):
+        row = dict(zip(columns, key))
+
+        if 'owner' in row:
+            row['owner_name'] = owners[row['owner']]
+
+        fraction = fractions[row['currency']]
+
+        for metric, value in zip(STATS_METRICS, counters):
+            if metric not in metrics:
+                continue
+
+            if metric == 'count':
+                row[metric] = value
+            else:
+                row[metric] = format_decimal(Decimal(value) / fraction, fraction)
+
+        results.append(row)
+
+    return results
+
+def parse_stats_fields(value, choices, field):
+
+    fields = [field.strip() for field in value.split(',') if field.strip()]
+
+    for name in fields:
+        if name not in choices:
+            raise Error('Invalid' + field.capitalize(), 'The ' + field.replace('_', ' ')
+                + ' must be from ' + ', '.join(choices), {'field': field})
+
+    # Repeats are dropped, the order given is kept for the output
+    return [name for i, name in enumerate(fields) if name not in fields[:i]]
+
+def split_record(split, intern):
+
+    transaction = split.GetParent()
+    value = split.GetValue()
+    amount = split.GetAmount()
+
+    return SplitRecord(split.GetGUID().to_string(),
+        intern(transaction.GetGUID().to_string()),
+        intern(split.GetAccount().GetGUID().to_string()),
+        format_date(transaction.GetDate(), intern), transaction.GetNum(),
+        transaction.GetDescription(), split.GetMemo(),
+        intern(transaction.GetCurrency().get_mnemonic()), value.num(),
+        value.denom(), amount.num(), amount.denom(),
+        intern(split.GetReconcile()))
+
+def get_split_records(book, guid, date_posted_from, date_posted_to):
+
+    return list(iter_split_records(book, guid, date_posted_from, date_posted_to))
+
+def iter_split_records(book, guid, date_posted_from, date_posted_to):
+
+    intern = Interner()
+
+    for split in get_gnucash_splits(book, guid, date_posted_from, date_posted_to):
+        yield split_record(split, intern)
+
+def get_account_records(book):
+
+    intern = Interner()
+
+    records = []
+
+    for account in book.get_root_account().get_descendants():
+        parent = account.get_parent()
+
+        if parent is None or parent.is_root():
+            parent_guid = None
+        else:
+            parent_guid = intern(parent.GetGUID().to_string())
+
+        records.append(AccountRecord(intern(account.GetGUID().to_string()),
+            account.GetName(), account.get_full_name(), account.GetType(),
+            intern(account.GetCommodity().get_mnemonic()),
+            account.GetCommoditySCU(), parent_guid))
+
+    return records
+
+def numeric_units(num, denom, scu):
+
+    # Converts an amount to whole units of the commodity's smallest unit,
+    # exact for amounts stored at the account's SCU which is the norm
+    units, remainder = divmod(num * scu, denom)
+
+    if remainder * 2 >= denom:
+        units += 1
+
+    return units
+
+def format_units(units, scu):
+
+    digits = len(str(scu)) - 1
+
+    return str((Decimal(units) / Decimal(scu)).quantize(Decimal(1).scaleb(-digits)))
+
+class PriceCache(object):
+
+    # The book's price database loaded once into sorted date and price
+    # arrays per commodity pair, each pair stored in both directions, so a
+    # lookup is a dictionary probe and a binary search
+
+    def __init__(self):
+        self.pairs = {}
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def from_book(cls, book):
+
+        prices = {}
+
+        pricedb = book.get_price_db()
+
+        for namespace in book.get_table().get_namespaces_list():
+            for commodity in namespace.get_commodity_list():
+                for price in pricedb.get_prices(commodity, None):
+                    value = gnc_numeric_to_decimal(price.get_value())
+
+                    if value == 0:
+                        continue
+
+                    time = price.get_time64()
+                    base = price.get_commodity().get_mnemonic()
+                    quote = price.get_currency().get_mnemonic()
+
+                    prices.setdefault((base, quote), []).append((time, value))
+                    prices.setdefault((quote, base), []).append((time, 1 / value))
+
+        cache = cls()
+
+        for pair, values in prices.items():
+            values.sort(key=lambda value: value[0])
+
+            cache.pairs[pair] = ([time.strftime("%Y-%m-%d") for time, value in values],
+                [value for time, value in values])
+
+        return cache
+
+    def lookup(self, base, quote, date):
+
+        # The latest price on or before the date, or None
+        if base == quote:
+            return Decimal(1)
+
+        pair = self.pairs.get((base, quote))
+
+        if pair is not None:
+            dates, values = pair
+            i = bisect.bisect_right(dates, date)
+
+            if i > 0:
+                self.hits += 1
+                return values[i - 1]
+
+        self.misses += 1
+
+        return None
+
+    def stats(self):
+
+        return {'hits': self.hits, 'misses': self.misses}
+
+def convert_units(num, denom, price, scu):
+
+    return int((Decimal(num) * price * scu / Decimal(denom)).to_integral_value(
+        rounding=ROUND_HALF_UP))
+
+def convert_report_records(accounts, splits, prices, currency, scu, price_date):
+
+    # Restates accounts and splits in the report currency so the reports
+    # can total across commodities. price_date picks the date each split is
+    # priced at, splits with no price are left out and counted as misses
+    by_guid = dict((account.guid, account) for account in accounts)
+
+    converted = [AccountRecord(account.guid, account.name, account.full_name,
+        account.type, currency, scu, account.parent_guid) for account in accounts]
+
+    def convert(splits):
+
+        for split in splits:
+            account = by_guid.get(split.account_guid)
+
+            if account is None:
+                continue
+
+            price = prices.lookup(account.commodity, currency, price_date(split))
+
+            if price is None:
+                continue
+
+            # Once restated the value and amount are the same figure
+            units = convert_units(split.amount_num, split.amount_denom, price, scu)
+
+            yield SplitRecord(split.guid, split.transaction_guid, split.account_guid,
+                split.date, split.num, split.description, split.memo, currency,
+                units, scu, units, scu, split.reconcile)
+
+    return converted, convert(splits)
+
+def report_currency(book, mnemonic):
+
+    # Loads the price cache and the currency's smallest unit for a
+    # --report-currency option
+    currency = book.get_table().lookup('CURRENCY', mnemonic)
+
+    if currency is None:
+        raise Error('InvalidReportCurrency', 'A valid report currency must be supplied',
+            {'field': 'report_currency'})
+
+    return PriceCache.from_book(book), currency.get_fraction()
+
+def write_price_stats(stats):
+
+    if stats is not None:
+        sys.stderr.write('Prices: %(hits)d hits, %(misses)d misses\n' % stats)
+
+def accumulate_balances(accounts, splits, period_of, period_count):
+
+    # One pass over the splits summing integer units per account and period,
+    # period_of maps a split's date to a column or None to skip it
+    by_guid = dict((account.guid, account) for account in accounts)
+
+    balances = {}
+
+    for split in splits:
+        period = period_of(split.date)
+
+        if period is None:
+            continue
+
+        account = by_guid.get(split.account_guid)
+
+        if account is None:
+            continue
+
+        row = balances.get(split.account_guid)
+
+        if row is None:
+            row = balances[split.account_guid] = [0] * period_count
+
+        row[period] += numeric_units(split.amount_num, split.amount_denom, account.scu)
+
+    return balances
+
+def account_children(accounts):
+
+    children = {}
+
+    for account in sorted(accounts, key=lambda account: account.name):
+        children.setdefault(account.parent_guid, []).append(account)
+
+    return children
+
+def rollup_balances(accounts, balances, period_count):
+
+    # Adds each account's balance into its parent in one post-order pass.
+    # Children in a different commodity can't be added without a price so
+    # they are left out of the parent's total
+    children = account_children(accounts)
+
+    totals = {}
+
+    stack = [(account, False) for account in children.get(None, [])]
+
+    while stack:
+        account, visited = stack.pop()
+
+        if not visited:
+            stack.append((account, True))
+
+            for child in children.get(account.guid, []):
+                stack.append((child, False))
+
+            continue
+
+        total = list(balances.get(account.guid, [0] * period_count))
+
+        for child in children.get(account.guid, []):
+            if child.commodity == account.commodity:
+                for i, units in enumerate(totals[child.guid]):
+                    total[i] += units
+
+        totals[account.guid] = total
+
+    return totals
+
+def walk_accounts(accounts):
+
+    # Yields (account, depth) in tree order
+    children = account_children(accounts)
+
+    stack = [(account, 0) for account in reversed(children.get(None, []))]
+
+    while stack:
+        account, depth = stack.pop()
+
+        yield account, depth
+
+        for child in reversed(children.get(account.guid, [])):
+            stack.append((child, depth + 1))
+
+def trial_balance_period(as_of):
+
+    return lambda date: 0 if date is not None and date <= as_of else None
+
+def trial_balance_rows(accounts, balances):
+
+    totals = rollup_balances(accounts, balances, 1)
+
+    debits = {}
+    credits = {}
+
+    for account, depth in walk_accounts(accounts):
+        units = totals[account.guid][0]
+
+        # Grand totals use each account's own balance so no split is
+        # counted twice, including a parent whose subtree nets to zero
+        own = balances.get(account.guid, [0])[0]
+
+        if own > 0:
+            debits[account.commodity] = debits.get(account.commodity, 0) + own
+        elif own < 0:
+            credits[account.commodity] = credits.get(account.commodity, 0) - own
+
+        if units == 0:
+            continue
+
+        yield {
+            'account': account.full_name,
+            'depth': depth,
+            'commodity': account.commodity,
+            'debit': format_units(units, account.scu) if units > 0 else '',
+            'credit': format_units(-units, account.scu) if units < 0 else ''
+        }
+
+    scus = dict((account.commodity, account.scu) for account in accounts)
+
+    for commodity in sorted(set(debits) | set(credits)):
+        yield {
+            'account': 'Total',
+            'depth': 0,
+            'commodity': commodity,
+            'debit': format_units(debits.get(commodity, 0), scus[commodity]),
+            'credit': format_units(credits.get(commodity, 0), scus[commodity])
+        }
+
+def report_periods(date_from, date_to, by):
+
+    # Returns the period labels and a function mapping a date to a period
+    if by != 'month':
+        return [date_from + ' to ' + date_to], \
+            lambda date: 0 if date is not None and date_from <= date <= date_to else None
+
+    labels = []
+
+    year, month = int(date_from[0:4]), int(date_from[5:7])
+
+    while '%04d-%02d' % (year, month) <= date_to[0:7]:
+        labels.append('%04d-%02d' % (year, month))
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+
+    index = dict((label, i) for i, label in enumerate(labels))
+
+    return labels, lambda date: index.get(date[0:7]) \
+        if date is not None and date_from <= date <= date_to else None
+
+def pnl_accounts(accounts):
+
+    accounts = [account for account in accounts
+        if account.type in [ACCT_TYPE_INCOME, ACCT_TYPE_EXPENSE]]
+
+    # Income and expense accounts hang off placeholders of other types, so
+    # treat the topmost income and expense accounts as roots
+    guids = set(account.guid for account in accounts)
+
+    return [account if account.parent_guid in guids else
+        AccountRecord(*(account.as_tuple()[:-1] + (None,))) for account in accounts]
+
+def pnl_rows(accounts, balances, labels):
+
+    # accounts are those from pnl_accounts
+    period_count = len(labels)
+
+    totals = rollup_balances(accounts, balances, period_count)
+
+    net = {}
+
+    for account, depth in walk_accounts(accounts):
+        units = totals[account.guid]
+
+        if not any(units):
+            continue
+
+        if account.parent_guid is None:
+            row = net.setdefault(account.commodity, [0] * period_count)
+
+            for i, value in enumerate(units):
+                row[i] -= value
+
+        # Income is held as credits so flip the sign for display
+        sign = -1 if account.type == ACCT_TYPE_INCOME else 1
+
+        row = {'account': account.full_name, 'depth': depth,
+            'commodity': account.commodity}
+
+        for label, value in zip(labels, units):
+            row[label] = format_units(sign * value, account.scu)
+
+        yield row
+
+    scus = dict((account.commodity, account.scu) for account in accounts)
+
+    for commodity in sorted(net):
+        row = {'account': 'Net income', 'depth': 0, 'commodity': commodity}
+
+        for label, value in zip(labels, net[commodity]):
+            row[label] = format_units(value, scus[commodity])
+
+        yield row
+
+def account_shards(accounts, workers):
+
+    # Splits the accounts into at most workers groups of whole subtrees.
+    # While there are fewer subtrees than workers the largest is broken
+    # into its root and its children's subtrees. Balances are accumulated
+    # per account, so any grouping gives the same totals
+    children = account_children(accounts)
+
+    def subtree(account):
+        guids = []
+        stack = [account]
+
+        while stack:
+            account = stack.pop()
+            guids.append(account.guid)
+            stack.extend(children.get(account.guid, []))
+
+        return guids
+
+    units = [(account, subtree(account)) for account in children.get(None, [])]
+
+    while len(units) < workers:
+        # A root already split from its children stands alone
+        splittable = [unit for unit in units if len(unit[1]) > 1]
+
+        if not splittable:
+            break
+
+        largest = max(splittable, key=lambda unit: (len(unit[1]), unit[0].full_name))
+        units.remove(largest)
+        units.append((largest[0], [largest[0].guid]))
+        units.extend((child, subtree(child)) for child in children[largest[0].guid])
+
+    # Dealt out largest first to whichever shard has the fewest accounts
+    units.sort(key=lambda unit: (-len(unit[1]), unit[0].full_name))
+
+    shards = [[] for i in range(min(workers, len(units)))]
+
+    for account, guids in units:
+        min(shards, key=len).extend(guids)
+
+    return [sorted(shard) for shard in shards]
+
+def date_shards(date_from, date_to, workers):
+
+    # Contiguous date ranges of as near equal length as the days allow
+    start = datetime.datetime.strptime(date_from, "%Y-%m-%d")
+    days = (datetime.datetime.strptime(date_to, "%Y-%m-%d") - start).days + 1
+    count = max(1, min(workers, days))
+
+    bounds = [start + datetime.timedelta(days=days * i // count) for i in range(count + 1)]
+
+    return [(bounds[i].strftime("%Y-%m-%d"),
+        (bounds[i + 1] - datetime.timedelta(days=1)).strftime("%Y-%m-%d"))
+        for i in range(count)]
+
+def report_shard(job):
+
+    # Runs in the worker processes, each opening its own read only session
+    # or snapshot and returning the integer balances for its shard. An
+    # Error raised here is re-raised from pool.map in the parent
+    records = open_records(job['source'])
+
+    try:
+        accounts = records.get_account_records()
+
+        if job['kind'] == 'pnl':
+            accounts = pnl_accounts(accounts)
+            labels, period_of = report_periods(*job['periods'])
+            period_count = len(labels)
+            price_date = lambda split: split.date
+        else:
+            period_of = trial_balance_period(job['as_of'])
+            period_count = 1
+            price_date = lambda split: job['as_of']
+
+        if job['guids'] is None:
+            splits = records.iter_split_records(None, job['date_from'], job['date_to'])
+        else:
+            splits = (split for guid in job['guids']
+                for split in records.iter_split_records(guid, job['date_from'],
+                    job['date_to']))
+
+        prices = None
+
+        if job['report_currency'] is not None:
+            prices, scu = records.report_currency(job['report_currency'])
+            accounts, splits = convert_report_records(accounts, splits, prices,
+                job['report_currency'], scu, price_date)
+
+        return {
+            'balances': accumulate_balances(accounts, splits, period_of, period_count),
+            'stats': None if prices is None else prices.stats()
+        }
+    finally:
+        records.close()
+
+def merge_balances(parts):
+
+    # Integer sums, so the merge is exact whatever order the shards finish
+    balances = {}
+
+    for part in parts:
+        for guid, units in part.items():
+            row = balances.get(guid)
+
+            if row is None:
+                balances[guid] = list(units)
+            else:
+                for i, value in enumerate(units):
+                    row[i] += value
+
+    return balances
+
+def sharded_report_balances(args, kind, date_from, date_to, periods=None):
+
+    # The accounts and shards are worked out here, then each shard's splits
+    # are read and accumulated in a worker process and the partial balances
+    # added together. Reports over the live book are sharded by date range,
+    # which a single split query can narrow, where a query per account
+    # would scan the splits once for every account. Snapshots store splits
+    # by account, so they are sharded by account subtree
+    started = time.time()
+
+    # Bring the replica up to date once rather than in every worker
+    if (args.snapshot is None and not args.no_replica
+        and is_sqlite_book(args.connection_string)
+        and not replica_is_current(args.connection_string)):
+        refresh_replica(args.connection_string)
+
+    records = open_records(args)
+
+    try:
+        accounts = records.get_account_records()
+
+        if kind == 'pnl':
+            accounts = pnl_accounts(accounts)
+
+        if args.report_currency is not None:
+            prices, scu = records.report_currency(args.report_currency)
+            accounts = convert_report_records(accounts, [], prices,
+                args.report_currency, scu, None)[0]
+
+        # The trial balance has no start date, its date ranges run from the
+        # book's first transaction
+        shard_start = date_from
+
+        if shard_start is None and args.snapshot is None:
+            shard_start = records.earliest_transaction_date()
+    finally:
+        records.close()
+
+    if args.snapshot is None:
+        if shard_start is None or shard_start > date_to:
+            shards = [(None, date_from, date_to)]
+        else:
+            shards = [(None, shard_from, shard_to) for shard_from, shard_to
+                in date_shards(shard_start, date_to, args.workers)]
+
+            # Open ended at the start, as the unsharded report is
+            shards[0] = (None, date_from, shards[0][2])
+    else:
+        shards = [(guids, date_from, date_to) for guids
+            in account_shards(accounts, args.workers)]
+
+    source = argparse.Namespace(connection_string=args.connection_string,
+        snapshot=args.snapshot, no_replica=args.no_replica)
+
+    jobs = [{'source': source, 'kind': kind, 'guids': guids, 'date_from': shard_from,
+        'date_to': shard_to, 'as_of': date_to, 'periods': periods,
+        'report_currency': args.report_currency}
+        for guids, shard_from, shard_to in shards]
+
+    if len(jobs) > 1:
+        pool = multiprocessing.Pool(len(jobs))
+
+        try:
+            parts = pool.map(report_shard, jobs, 1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        parts = [report_shard(job) for job in jobs]
+
+    stats = None
+
+    if args.report_currency is not None:
+        stats = {
+            'hits': sum(part['stats']['hits'] for part in parts),
+            'misses': sum(part['stats']['misses'] for part in parts)
+        }
+
+    sys.stderr.write('Merged %d shards in %.2fs\n' % (len(parts), time.time() - started))
+
+    return accounts, merge_balances(part['balances'] for part in parts), stats
+
+def write_report(columns, rows, format):
+
+    # Rows are written as they are produced rather than collected first
+    if format == 'json':
+        sys.stdout.write('[')
+
+        for i, row in enumerate(rows):
+            if i > 0:
+                sys.stdout.write(',')
+
+            sys.stdout.write(json.dumps(row))
+
+        sys.stdout.write(']\n')
+    elif format == 'csv':
+        writer = csv.DictWriter(sys.stdout, fieldnames=['account', 'commodity'] + columns,
+            extrasaction='ignore')
+        writer.writeheader()
+
+        for row in rows:
+            writer.writerow(row)
+    else:
+        print('%-50s %-5s' % ('Account', '') + ''.join('%16s' % column for column in columns))
+
+        for row in rows:
+            name = '  ' * row['depth'] + row['account'].split(':')[-1]
+
+            if row['account'] in ['Total', 'Net income']:
+                name = row['account']
+
+            print('%-50s %-5s' % (name[:50], row['commodity'])
+                + ''.join('%16s' % row[column] for column in columns))
+
+def next_month(month):
+
+    year, month = int(month[0:4]), int(month[5:7])
+
+    if month == 12:
+        return '%04d-01' % (year + 1)
+    else:
+        return '%04d-%02d' % (year, month + 1)
+
+def previous_month(month):
+
+    year, month = int(month[0:4]), int(month[5:7])
+
+    if month == 1:
+        return '%04d-12' % (year - 1)
+    else:
+        return '%04d-%02d' % (year, month - 1)
+
+def month_end(month):
+
+    return (datetime.datetime.strptime(next_month(month) + '-01', "%Y-%m-%d")
+        - datetime.timedelta(days=1)).strftime("%Y-%m-%d")
+
+BALANCE_STORE_VERSION = 2
+
+class BalanceStore(object):
+
+    # Per account cumulative balances at each month end in an SQLite
+    # sidecar. Checkpoints are dropped from a touched month onwards and
+    # rebuilt lazily, so the months kept for an account are always valid
+
+    def __init__(self, connection_string):
+        self.connection = sqlite3.connect(sidecar_path(connection_string, 'balances'))
+        self.connection.execute('CREATE TABLE IF NOT EXISTS meta '
+            '(name TEXT PRIMARY KEY, value TEXT)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS checkpoints '
+            '(account TEXT, month TEXT, units INTEGER, PRIMARY KEY (account, month))')
+
+        # Checkpoints from before split queries took in the whole of their
+        # last day are missing month end splits, so they're rebuilt
+        row = self.connection.execute(
+            "SELECT value FROM meta WHERE name = 'version'").fetchone()
+
+        if row is None or json.loads(row[0]) != BALANCE_STORE_VERSION:
+            self.invalidate_all()
+            self.connection.execute("INSERT OR REPLACE INTO meta VALUES ('version', ?)",
+                (json.dumps(BALANCE_STORE_VERSION),))
+            self.connection.commit()
+
+    @staticmethod
+    def exists(connection_string):
+        return os.path.exists(sidecar_path(connection_string, 'balances'))
+
+    def get_fingerprint(self):
+
+        row = self.connection.execute(
+            "SELECT value FROM meta WHERE name = 'fingerprint'").fetchone()
+
+        if row is None:
+            return None
+        else:
+            return json.loads(row[0])
+
+    def set_fingerprint(self, fingerprint):
+
+        self.connection.execute("INSERT OR REPLACE INTO meta VALUES ('fingerprint', ?)",
+            (json.dumps(fingerprint),))
+        self.connection.commit()
+
+    def invalidate(self, account_guid, date):
+
+        self.connection.execute('DELETE FROM checkpoints WHERE account = ? AND month >= ?',
+            (account_guid, date[0:7]))
+
+    def invalidate_all(self):
+
+        self.connection.execute('DELETE FROM checkpoints')
+
+    def latest(self, account_guid, month):
+
+        # The newest checkpoint at or before month
+        return self.connection.execute('SELECT month, units FROM checkpoints '
+            'WHERE account = ? AND month <= ? ORDER BY month DESC LIMIT 1',
+            (account_guid, month)).fetchone()
+
+    def balance(self, book, account, as_of):
+
+        account_guid = account.GetGUID().to_string()
+        scu = account.GetCommoditySCU()
+
+        checkpoint_month = previous_month(as_of[0:7])
+
+        latest = self.latest(account_guid, checkpoint_month)
+
+        if latest is None:
+            month, units = None, 0
+        else:
+            month, units = latest
+
+        # Fill in the missing month ends with one query from the newest
+        # checkpoint up to the end of the last whole month. Split queries
+        # take in the whole of their last day, so each month is the half
+        # open range from its first day to the next month's
+        if month != checkpoint_month:
+            if month is None:
+                date_from = None
+            else:
+                date_from = next_month(month) + '-01'
+
+            by_month = {}
+
+            for split in iter_split_records(book, account_guid, date_from,
+                month_end(checkpoint_month)):
+                by_month[split.date[0:7]] = by_month.get(split.date[0:7], 0) \
+                    + numeric_units(split.amount_num, split.amount_denom, scu)
+
+            if month is None:
+                month = min(list(by_month.keys()) + [checkpoint_month])
+            else:
+                month = next_month(month)
+
+            rows = []
+
+            while month <= checkpoint_month:
+                units += by_month.get(month, 0)
+                rows.append((account_guid, month, units))
+                month = next_month(month)
+
+            self.connection.executemany('INSERT OR REPLACE INTO checkpoints '
+                'VALUES (?, ?, ?)', rows)
+            self.connection.commit()
+
+        # Then add the splits in the part of the month up to and including
+        # the date
+        for split in iter_split_records(book, account_guid, as_of[0:7] + '-01', as_of):
+            units += numeric_units(split.amount_num, split.amount_denom, scu)
+
+        return units
+
+    def close(self):
+        self.connection.close()
+
+def update_balance_store(connection_string, book):
+
+    if not BalanceStore.exists(connection_string):
+        return
+
+    store = BalanceStore(connection_string)
+
+    try:
+        if changes.everything or store.get_fingerprint() != session_base_fingerprint:
+            store.invalidate_all()
+        else:
+            for transaction in changed_transactions(book, changes):
+                changes.touch_transaction(transaction)
+
+            for kind, invoice in changed_invoices(book, changes):
+                for transaction in invoice_transactions(invoice):
+                    changes.touch_transaction(transaction)
+
+            for account_guid, date in changes.accounts.items():
+                store.invalidate(account_guid, date)
+
+        store.set_fingerprint(book_fingerprint(connection_string))
+    finally:
+        store.close()
+
+def restamp_balance_store(connection_string, saved_fingerprint, fingerprint):
+
+    if not BalanceStore.exists(connection_string):
+        return
+
+    store = BalanceStore(connection_string)
+
+    try:
+        if saved_fingerprint is not None and store.get_fingerprint() == saved_fingerprint:
+            store.set_fingerprint(fingerprint)
+    finally:
+        store.close()
+
+save_hooks.append(update_balance_store)
+end_hooks.append(restamp_balance_store)
+
+def get_account_balance(connection_string, account_name, as_of, use_replica=True):
+
+    store = BalanceStore(connection_string)
+
+    try:
+        # Changes made outside gncli can't be attributed to accounts
+        fingerprint = book_fingerprint(connection_string)
+
+        if fingerprint is None or store.get_fingerprint() != fingerprint:
+            store.invalidate_all()
+            store.set_fingerprint(fingerprint)
+
+        session = start_read_session(connection_string, use_replica)
+
+        try:
+            account_guid = account_guid_from_name(session.book, account_name)
+
+            guid = gnucash.gnucash_core.GUID()
+            gnucash.gnucash_core.GUIDString(account_guid, guid)
+
+            account = guid.AccountLookup(session.book)
+
+            if account_guid == '' or account is None:
+                raise Error('NoAccount', 'No account exists with this name',
+                    {'field': 'account'})
+
+            units = store.balance(session.book, account, as_of)
+
+            return {
+                'account': account.get_full_name(),
+                'as_of': as_of,
+                'balance': format_units(units, account.GetCommoditySCU()),
+                'commodity': account.GetCommodity().get_mnemonic()
+            }
+        finally:
+            end_session(False)
+    finally:
+        store.close()
+
+TEMPLATE_TAG = re.compile(r'\{\{\s*([\w.]+)(?::([^}]*))?\s*\}\}'
+    r'|\{%\s*(?:for (\w+) in ([\w.]+)|if ([\w.]+)|(endfor|endif))\s*%\}')
+
+class Template(object):
+
+    # A compiled template, a tree of text, value, for and if nodes
+
+    def __init__(self, nodes, escape):
+        self.nodes = nodes
+        self.escape = escape
+
+    def lookup(self, scopes, path):
+
+        value = None
+
+        for scope in reversed(scopes):
+            if path[0] in scope:
+                value = scope[path[0]]
+                break
+
+        for name in path[1:]:
+            if value is None:
+                break
+
+            value = value.get(name)
+
+        return value
+
+    def render_nodes(self, nodes, scopes, output):
+
+        for node in nodes:
+            if node[0] == 'text':
+                output.append(node[1])
+            elif node[0] == 'value':
+                value = self.lookup(scopes, node[1])
+
+                if value is None:
+                    value = ''
+
+                value = format(value, node[2]) if node[2] else str(value)
+
+                output.append(html.escape(value) if self.escape else value)
+            elif node[0] == 'for':
+                for item in self.lookup(scopes, node[2]) or []:
+                    self.render_nodes(node[3], scopes + [{node[1]: item}], output)
+            elif self.lookup(scopes, node[1]):
+                self.render_nodes(node[2], scopes, output)
+
+    def render(self, context):
+
+        output = []
+
+        self.render_nodes(self.nodes, [context], output)
+
+        return ''.join(output)
+
+@lru_cache(maxsize=32)
+def compile_template(source, escape):
+
+    # Templates are parsed once per process. Values are {{ path }} or
+    # {{ path:format_spec }}, blocks are {% for x in path %} and
+    # {% if path %}, each closed by {% endfor %} or {% endif %}
+    root = []
+    stack = [('root', root)]
+    position = 0
+
+    for match in TEMPLATE_TAG.finditer(source):
+        if match.start() > position:
+            stack[-1][1].append(('text', source[position:match.start()]))
+
+        position = match.end()
+
+        if match.group(1) is not None:
+            stack[-1][1].append(('value', match.group(1).split('.'),
+                (match.group(2) or '').strip()))
+        elif match.group(3) is not None:
+            node = ('for', match.group(3), match.group(4).split('.'), [])
+            stack[-1][1].append(node)
+            stack.append(('endfor', node[3]))
+        elif match.group(5) is not None:
+            node = ('if', match.group(5).split('.'), [])
+            stack[-1][1].append(node)
+            stack.append(('endif', node[2]))
+        elif stack[-1][0] == match.group(6):
+            stack.pop()
+        else:
+            raise Error('InvalidTemplate', 'The template has an unexpected '
+                + match.group(6), {'field': 'template'})
+
+    if len(stack) > 1:
+        raise Error('InvalidTemplate', 'The template is missing an ' + stack[-1][0],
+            {'field': 'template'})
+
+    if position < len(source):
+        root.append(('text', source[position:]))
+
+    return Template(root, escape)
+
+def pdf_escape(text):
+
+    return text.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)')
+
+def pdf_document(text):
+
+    # A minimal PDF of the text set in Courier on A4 pages, enough for
+    # statements and invoices without a PDF library
+    lines = text.expandtabs().splitlines() or ['']
+    pages = [lines[i:i + 60] for i in range(0, len(lines), 60)]
+
+    objects = [b'<< /Type /Catalog /Pages 2 0 R >>', None,
+        b'<< /Type /Font /Subtype /Type1 /BaseFont /Courier >>']
+    kids = []
+
+    for page in pages:
+        content = ['BT /F1 10 Tf 12 TL 40 800 Td']
+        content.extend("(" + pdf_escape(line) + ") '" for line in page)
+        content.append('ET')
+
+        stream = '\n'.join(content).encode('latin-1', 'replace')
+
+        objects.append(b'<< /Length %d >>\nstream\n' % len(stream) + stream
+            + b'\nendstream')
+        objects.append(b'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] '
+            b'/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>' % len(objects))
+        kids.append(len(objects))
+
+    objects[1] = b'<< /Type /Pages /Kids [%s] /Count %d >>' % (
+        b' '.join(b'%d 0 R' % kid for kid in kids), len(kids))
+
+    output = b'%PDF-1.4\n'
+    offsets = []
+
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(output))
+        output += b'%d 0 obj\n' % number + body + b'\nendobj\n'
+
+    xref = len(output)
+
+    output += b'xref\n0 %d\n0000000000 65535 f \n' % (len(objects) + 1)
+    output += b''.join(b'%010d 00000 n \n' % offset for offset in offsets)
+    output += b'trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (
+        len(objects) + 1, xref)
+
+    return output
+
+DOCUMENT_EXTENSIONS = {'text': 'txt', 'html': 'html', 'pdf': 'pdf'}
+
+def render_document(job):
+
+    # Runs in the worker processes, so takes and returns plain values
+    context, format, source, path = job
+
+    text = compile_template(source, format == 'html').render(context)
+
+    if format == 'pdf':
+        data = pdf_document(text)
+    else:
+        data = text.encode('utf-8')
+
+    write_file_atomic(path, data)
+
+    return path
+
+def render_documents(jobs, workers, noun):
+
+    # Rendering is pure Python and CPU bound so it's spread over processes,
+    # the book is closed by this point and the workers only see plain data
+    started = time.time()
+
+    if workers > 1 and len(jobs) > 1:
+        pool = multiprocessing.Pool(min(workers, len(jobs)))
+
+        try:
+            paths = pool.imap_unordered(render_document, jobs,
+                max(1, len(jobs) // (workers * 4)))
+
+            for count, path in enumerate(paths, 1):
+                sys.stderr.write('\r%d/%d %s' % (count, len(jobs), noun))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for count, job in enumerate(jobs, 1):
+            render_document(job)
+            sys.stderr.write('\r%d/%d %s' % (count, len(jobs), noun))
+
+    elapsed = time.time() - started
+
+    if jobs:
+        sys.stderr.write('\n')
+
+    sys.stderr.write('Rendered %d %s in %.2fs (%.1f %s/sec)\n' % (len(jobs), noun,
+        elapsed, len(jobs) / elapsed if elapsed > 0 else 0, noun))
+
+def read_template(path, format, defaults):
+
+    if path is None:
+        source = defaults[format]
+    else:
+        try:
+            with open(path, 'r') as template_file:
+                source = template_file.read()
+        except (IOError, OSError):
+            raise Error('InvalidTemplate', 'The template file could not be read',
+                {'field': 'template'})
+
+    # Compiled here first so template errors are reported before any work
+    compile_template(source, format == 'html')
+
+    return source
+
+def document_jobs(documents, format, source, out):
+
+    try:
+        os.makedirs(out, exist_ok=True)
+    except OSError:
+        raise Error('InvalidOutputDirectory', 'The output directory could not be created',
+            {'field': 'out'})
+
+    jobs = []
+
+    for name, context in documents:
+        path = os.path.join(out, re.sub(r'[^\w.-]', '_', name) + '.'
+            + DOCUMENT_EXTENSIONS[format])
+        jobs.append((context, format, source, path))
+
+    return jobs
+
+def format_decimal(value, fraction):
+
+    return str(value.quantize(Decimal(1).scaleb(-(len(str(fraction)) - 1))))
+
+def end_owner(owner):
+
+    # Invoices can be owned by a job, which is in turn owned by the customer
+    if isinstance(owner, Job):
+        return owner.GetOwner()
+
+    return owner
+
+def customer_context(book, id, customers):
+
+    # Looked up once per customer, customers caches them across documents
+    if id not in customers:
+        customer = book.CustomerLookupByID(id)
+
+        if customer is None:
+            raise Error('NoCustomer', 'A customer with the ID ' + id + ' does not exist',
+                {'field': 'customer'})
+
+        address = customer.GetAddr()
+
+        customers[id] = {
+            'id': id,
+            'name': customer.GetName(),
+            'contact': address.GetName(),
+            'address_1': address.GetAddr1(),
+            'address_2': address.GetAddr2(),
+            'address_3': address.GetAddr3(),
+            'address_4': address.GetAddr4(),
+            'email': address.GetEmail()
+        }
+
+    return customers[id]
+
+STATEMENT_TEMPLATES = {}
+
+STATEMENT_TEMPLATES['text'] = """Statement as of {{ as_of }}
+
+{{ customer.name }}
+{% if customer.contact %}{{ customer.contact }}
+{% endif %}{% if customer.address_1 %}{{ customer.address_1 }}
+{% endif %}{% if customer.address_2 %}{{ customer.address_2 }}
+{% endif %}{% if customer.address_3 %}{{ customer.address_3 }}
+{% endif %}{% if customer.address_4 %}{{ customer.address_4 }}
+{% endif %}
+Invoice         Posted      Due                  Total   Outstanding
+{% for item in items %}{{ item.id:<16 }}{{ item.date_posted:<12 }}{{ item.date_due:<12 }}{{ item.total:>14 }}{{ item.outstanding:>14 }}
+{% endfor %}
+Balance due                             {{ total:>28 }} {{ currency }}
+"""
+
+STATEMENT_TEMPLATES['html'] = """<!DOCTYPE html>
+<html>
+<head><meta charset="utf-8"><title>Statement {{ customer.id }} {{ as_of }}</title></head>
+<body>
+<h1>Statement as of {{ as_of }}</h1>
+<p>{{ customer.name }}{% if customer.contact %}<br>{{ customer.contact }}{% endif %}{% if customer.address_1 %}<br>{{ customer.address_1 }}{% endif %}{% if customer.address_2 %}<br>{{ customer.address_2 }}{% endif %}{% if customer.address_3 %}<br>{{ customer.address_3 }}{% endif %}{% if customer.address_4 %}<br>{{ customer.address_4 }}{% endif %}</p>
+<table>
+<tr><th>Invoice</th><th>Posted</th><th>Due</th><th>Total</th><th>Outstanding</th></tr>
+{% for item in items %}<tr><td>{{ item.id }}</td><td>{{ item.date_posted }}</td><td>{{ item.date_due }}</td><td>{{ item.total }}</td><td>{{ item.outstanding }}</td></tr>
+{% endfor %}<tr><th colspan="4">Balance due</th><th>{{ total }} {{ currency }}</th></tr>
+</table>
+</body>
+</html>
+"""
+
+STATEMENT_TEMPLATES['pdf'] = STATEMENT_TEMPLATES['text']
+
+def get_statements(book, as_of):
+
+    # One pass over the posted invoices, keeping those with an amount
+    # outstanding at the date grouped by customer and currency
+    statements = {}
+    customers = {}
+
+    for invoice in get_gnucash_invoices(book, {'is_posted': 1, 'date_posted_to': as_of}):
+        lot = invoice.GetPostedLot()
+
+        if lot is None:
+            continue
+
+        # Payments after the date don't count against the statement
+        outstanding = Decimal(0)
+
+        for split in lot.get_split_list():
+            if split.GetParent().GetDate().strftime("%Y-%m-%d") <= as_of:
+                outstanding += gnc_numeric_to_decimal(split.GetAmount())
+
+        if outstanding == 0:
+            continue
+
+        owner = end_owner(invoice.GetOwner())
+        currency = invoice.GetCurrency()
+        fraction = currency.get_fraction()
+
+        key = (owner.GetID(), currency.get_mnemonic())
+
+        if key not in statements:
+            statements[key] = {
+                'as_of': as_of,
+                'customer': customer_context(book, owner.GetID(), customers),
+                'currency': currency.get_mnemonic(),
+                'fraction': fraction,
+                'items': [],
+                'total': Decimal(0)
+            }
+
+        statement = statements[key]
+
+        date_due = format_date(invoice.GetDateDue(), str)
+
+        statement['items'].append({
+            'id': invoice.GetID(),
+            'date_posted': format_date(invoice.GetDatePosted(), str),
+            'date_due': date_due,
+            'overdue': date_due is not None and date_due < as_of,
+            'total': format_decimal(gnc_numeric_to_decimal(invoice.GetTotal()), fraction),
+            'outstanding': format_decimal(outstanding, fraction)
+        })
+
+        statement['total'] += outstanding
+
+    results = []
+
+    for (customer_id, currency), statement in sorted(statements.items()):
+        statement['items'].sort(key=lambda item: (item['date_posted'] or '', item['id']))
+        statement['total'] = format_decimal(statement['total'], statement.pop('fraction'))
+
+        # Customers with several currencies get a statement for each
+        if len([key for key in statements if key[0] == customer_id]) > 1:
+            results.append((customer_id + '-' + currency, statement))
+        else:
+            results.append((customer_id, statement))
+
+    return results
+
+def generate_statements(connection_string, as_of, out, format, template_path, workers,
+    use_replica=True):
+
+    source = read_template(template_path, format, STATEMENT_TEMPLATES)
+
+    session = start_read_session(connection_string, use_replica)
+
+    try:
+        statements = get_statements(session.book, as_of)
+    finally:
+        end_session(False)
+
+    jobs = document_jobs(statements, format, source, out)
+
+    render_documents(jobs, workers, 'statements')
+
+    return [job[3] for job in jobs]
+
+INVOICE_TEMPLATES = {}
+
+INVOICE_TEMPLATES['text'] = """Invoice {{ id }}
+
+{{ customer.name }}
+{% if customer.contact %}{{ customer.contact }}
+{% endif %}{% if customer.address_1 %}{{ customer.address_1 }}
+{% endif %}{% if customer.address_2 %}{{ customer.address_2 }}
+{% endif %}{% if customer.address_3 %}{{ customer.address_3 }}
+{% endif %}{% if customer.address_4 %}{{ customer.address_4 }}
+{% endif %}
+Date: {{ date_posted }}
+{% if date_due %}Due: {{ date_due }}
+{% endif %}
+""" + '%-12s%-32s%10s%12s%12s' % ('Date', 'Description', 'Quantity', 'Price', 'Amount') + """
+{% for entry in entries %}{{ entry.date:<12 }}{{ entry.description:<32.31 }}{{ entry.quantity:>10 }}{{ entry.price:>12 }}{{ entry.amount:>12 }}
+{% endfor %}
+""" + '%-44s' % 'Total' + """{{ total:>34 }} {{ currency }}
+{% if notes %}
+{{ notes }}
+{% endif %}"""
+
+INVOICE_TEMPLATES['html'] = """<!DOCTYPE html>
+<html>
+<head><meta charset="utf-8"><title>Invoice {{ id }}</title></head>
+<body>
+<h1>Invoice {{ id }}</h1>
+<p>{{ customer.name }}{% if customer.contact %}<br>{{ customer.contact }}{% endif %}{% if customer.address_1 %}<br>{{ customer.address_1 }}{% endif %}{% if customer.address_2 %}<br>{{ customer.address_2 }}{% endif %}{% if customer.address_3 %}<br>{{ customer.address_3 }}{% endif %}{% if customer.address_4 %}<br>{{ customer.address_4 }}{% endif %}</p>
+<p>Date: {{ date_posted }}{% if date_due %}<br>Due: {{ date_due }}{% endif %}</p>
+<table>
+<tr><th>Date</th><th>Description</th><th>Quantity</th><th>Price</th><th>Amount</th></tr>
+{% for entry in entries %}<tr><td>{{ entry.date }}</td><td>{{ entry.description }}</td><td>{{ entry.quantity }}</td><td>{{ entry.price }}</td><td>{{ entry.amount }}</td></tr>
+{% endfor %}<tr><th colspan="4">Total</th><th>{{ total }} {{ currency }}</th></tr>
+</table>
+{% if notes %}<p>{{ notes }}</p>
+{% endif %}</body>
+</html>
+"""
+
+INVOICE_TEMPLATES['pdf'] = INVOICE_TEMPLATES['text']
+
+def invoice_context(book, invoice, customers, owners, intern):
+
+    # Everything a template can use, as plain values for the workers
+    record = invoice_record(invoice, True, owners, intern)
+    fraction = invoice.GetCurrency().get_fraction()
+
+    entries = []
+
+    for entry in record.entries:
+        quantity = Decimal(entry.quantity_num) / Decimal(entry.quantity_denom)
+        price = Decimal(entry.price_num) / Decimal(entry.price_denom)
+
+        entries.append({
+            'date': entry.date,
+            'description': entry.description,
+            'quantity': '{:f}'.format(quantity.normalize()),
+            'price': format_decimal(price, fraction),
+            'amount': format_decimal(entry.amount(), fraction)
+        })
+
+    return {
+        'id': record.id,
+        'customer': customer_context(book, end_owner(invoice.GetOwner()).GetID(),
+            customers),
+        'currency': record.currency,
+        'date_opened': record.date_opened,
+        'date_posted': record.date_posted,
+        'date_due': record.date_due,
+        'notes': record.notes,
+        'entries': entries,
+        'total': format_decimal(Decimal(record.total_num) / Decimal(record.total_denom),
+            fraction)
+    }
+
+def get_invoice_contexts(book, ids, posted_since):
+
+    # A single invoice query either way, rather than a lookup per ID
+    if ids is not None:
+        wanted = set(ids)
+        invoices = [invoice for invoice in get_gnucash_invoices(book, {})
+            if invoice.GetID() in wanted]
+
+        missing = wanted - set(invoice.GetID() for invoice in invoices)
+
+        if missing:
+            raise Error('NoInvoice', 'No invoice exists with the ID '
+                + sorted(missing)[0], {'field': 'ids'})
+    else:
+        invoices = get_gnucash_invoices(book, {'is_posted': 1,
+            'date_posted_from': posted_since})
+
+    customers = {}
+    owners = {}
+    intern = Interner()
+
+    return [(invoice.GetID(), invoice_context(book, invoice, customers, owners, intern))
+        for invoice in invoices]
+
+def render_invoices(connection_string, ids, posted_since, out, format, template_path,
+    workers, use_replica=True):
+
+    source = read_template(template_path, format, INVOICE_TEMPLATES)
+
+    session = start_read_session(connection_string, use_replica)
+
+    try:
+        invoices = get_invoice_contexts(session.book, ids, posted_since)
+    finally:
+        end_session(False)
+
+    jobs = document_jobs(invoices, format, source, out)
+
+    render_documents(jobs, workers, 'invoices')
+
+    return [job[3] for job in jobs]
+
+def completion_values(book):
+
+    # The values offered for option arguments, by kind
+    values = {
+        'account': set(account.GetName()
+            for account in book.get_root_account().get_descendants()),
+        'customer': set(get_name_records(book, 'customer')),
+        'vendor': set(get_name_records(book, 'vendor')),
+        'invoice': set(invoice.GetID() for invoice in get_gnucash_invoices(book, {})),
+        'bill': set(bill.GetID() for bill in get_gnucash_bills(book, {}))
+    }
+
+    for kind in sorted(values):
+        for value in sorted(values[kind]):
+            yield kind, ' '.join(value.split())
+
+def write_completion_cache(connection_string, book, fingerprint):
+
+    # Plain kind<TAB>value lines so the shell can read it without Python,
+    # the first line holds the fingerprint of the book it was built from
+    lines = ['#\t' + json.dumps(fingerprint)]
+
+    lines.extend(kind + '\t' + value for kind, value in completion_values(book) if value)
+
+    write_file_atomic(sidecar_path(connection_string, 'completion'),
+        ('\n'.join(lines) + '\n').encode('utf-8'))
+
+def read_completion_fingerprint(connection_string):
+
+    try:
+        with open(sidecar_path(connection_string, 'completion'), 'r') as cache_file:
+            header = cache_file.readline()
+    except (IOError, OSError):
+        return None
+
+    try:
+        return json.loads(header.split('\t', 1)[1])
+    except (IndexError, ValueError):
+        return None
+
+def update_completion_cache(connection_string, book):
+
+    if os.path.exists(sidecar_path(connection_string, 'completion')):
+        write_completion_cache(connection_string, book, book_fingerprint(connection_string))
+
+def restamp_completion_cache(connection_string, saved_fingerprint, fingerprint):
+
+    path = sidecar_path(connection_string, 'completion')
+
+    if saved_fingerprint is None or read_completion_fingerprint(connection_string) != saved_fingerprint:
+        return
+
+    # Rewriting also leaves the cache newer than the book, which is what
+    # the shell checks
+    with open(path, 'r') as cache_file:
+        lines = cache_file.read().split('\n')
+
+    lines[0] = '#\t' + json.dumps(fingerprint)
+
+    write_file_atomic(path, '\n'.join(lines).encode('utf-8'))
+
+save_hooks.append(update_completion_cache)
+end_hooks.append(restamp_completion_cache)
+
+def refresh_completion_cache(connection_string, use_replica=True):
+
+    fingerprint = book_fingerprint(connection_string)
+
+    if fingerprint is not None and read_completion_fingerprint(connection_string) == fingerprint:
+        os.utime(sidecar_path(connection_string, 'completion'))
+        return
+
+    session = start_read_session(connection_string, use_replica)
+
+    try:
+        write_completion_cache(connection_string, session.book, fingerprint)
+    finally:
+        end_session(False)
+
+# Options whose values come from the completion cache, --id depends on the
+# command it belongs to
+COMPLETION_KINDS = {
+    '--account': 'account',
+    '--posted_account': 'account',
+    '--transfer_account': 'account',
+    '--transfer-account': 'account',
+    '--customer': 'customer',
+    '--customer_id': 'customer',
+    '--vendor_id': 'vendor',
+    '--invoice_id': 'invoice',
+    '--ids': 'invoice',
+    '--bill_id': 'bill'
+}
+
+def completion_tree(parser):
+
+    # Maps each command path to the subcommands and options that can follow
+    tree = {}
+    flags = set()
+    value_options = set()
+
+    def walk(parser, path):
+
+        words = []
+
+        for action in parser._actions:
+            if isinstance(action, argparse._SubParsersAction):
+                for name, subparser in action.choices.items():
+                    words.append(name)
+                    walk(subparser, path + [name])
+            elif action.option_strings:
+                options = [option for option in action.option_strings
+                    if option.startswith('--')]
+
+                words.extend(options)
+
+                if action.nargs == 0:
+                    flags.update(options)
+                elif not path:
+                    value_options.update(options)
+
+        tree[' '.join(path)] = sorted(words)
+
+    walk(parser, [])
+
+    return tree, flags, value_options
+
+def completion_kind(path, option):
+
+    if option == '--id' and path.split(' ')[0] in ['invoice', 'bill', 'customer', 'vendor']:
+        return path.split(' ')[0]
+
+    return COMPLETION_KINDS.get(option)
+
+BASH_COMPLETION = r'''# gncli completion, generated by gncli completion bash
+_gncli_words() {
+    case "$1" in
+@WORDS@
+        *) return 1 ;;
+    esac
+}
+
+_gncli_kind() {
+    case "$1|$2" in
+@KINDS@
+        *) _gncli_k="" ;;
+    esac
+}
+
+_gncli_cache_path() {
+    local hash
+    _gncli_book=""
+    case "$1" in
+        sqlite3://*|xml://*|file://*)
+            _gncli_book="${1#*://}"
+            _gncli_cache="$_gncli_book.gncli-completion" ;;
+        *://*)
+            hash=$(printf '%s' "$1" | sha1sum)
+            _gncli_cache="$HOME/.cache/gncli/${hash%% *}.completion" ;;
+        *)
+            _gncli_book="$1"
+            _gncli_cache="$1.gncli-completion" ;;
+    esac
+}
+
+_gncli_values() {
+    local command="$1" cs="$2" kind="$3" cur="$4" value lock
+    local -a values refresh
+
+    _gncli_cache_path "$cs"
+
+    # Stale or missing caches are rebuilt in the background, completion
+    # carries on with whatever is there now. Only one rebuild runs at a
+    # time, a TAB while one holds the lock starts nothing
+    if [[ ! -f "$_gncli_cache" || ( -n "$_gncli_book" && ( "$_gncli_book" -nt "$_gncli_cache" || "$_gncli_book-wal" -nt "$_gncli_cache" ) ) ]]; then
+        if [[ -n "$GNCLI_CONNECTION_STRING" ]]; then
+            refresh=("$command" completion refresh)
+        else
+            refresh=("$command" "$cs" completion refresh)
+        fi
+
+        lock="$_gncli_cache.lock"
+        mkdir -p "${lock%/*}" 2>/dev/null
+
+        if command -v flock >/dev/null 2>&1; then
+            ( ( flock -n 9 || exit 0; "${refresh[@]}" ) 9>"$lock" >/dev/null 2>&1 & )
+        elif [[ -z $(find "$lock" -mmin -1 2>/dev/null) ]]; then
+            # Without flock the lock file's age stands in, a rebuild
+            # started in the last minute is left to finish
+            : >"$lock" 2>/dev/null
+            ( "${refresh[@]}" >/dev/null 2>&1 & )
+        fi
+    fi
+
+    [[ -f "$_gncli_cache" ]] || return
+
+    cur="${cur#[\"\']}"
+
+    mapfile -t values < <(awk -F '\t' -v kind="$kind" -v cur="$cur" \
+        '$1 == kind && index($2, cur) == 1 { print $2 }' "$_gncli_cache")
+
+    for value in "${values[@]}"; do
+        printf -v value '%q' "$value"
+        COMPREPLY+=("$value")
+    done
+}
+
+_gncli() {
+    local cur="${COMP_WORDS[COMP_CWORD]}" prev="${COMP_WORDS[COMP_CWORD-1]}"
+    local cs="$GNCLI_CONNECTION_STRING" path="" word skip="" i
+    COMPREPLY=()
+
+    for ((i = 1; i < COMP_CWORD; i++)); do
+        word="${COMP_WORDS[i]}"
+
+        if [[ -n "$skip" ]]; then
+            skip=""
+            continue
+        fi
+
+        case " @VALUE_OPTIONS@ " in
+            *" $word "*) skip=1; continue ;;
+        esac
+
+        [[ "$word" == -* ]] && continue
+
+        if [[ -z "$cs" ]]; then
+            cs="$word"
+        elif _gncli_words "${path:+$path }$word"; then
+            path="${path:+$path }$word"
+        fi
+    done
+
+    if [[ -z "$cs" ]]; then
+        mapfile -t COMPREPLY < <(compgen -f -- "$cur")
+        return
+    fi
+
+    if [[ "$prev" == --* && " @FLAGS@ " != *" $prev "* ]]; then
+        _gncli_kind "$path" "$prev"
+
+        if [[ -n "$_gncli_k" ]]; then
+            _gncli_values "${COMP_WORDS[0]}" "$cs" "$_gncli_k" "$cur"
+        fi
+
+        return
+    fi
+
+    _gncli_words "$path"
+    mapfile -t COMPREPLY < <(compgen -W "$_gncli_w" -- "$cur")
+}
+
+complete -o default -F _gncli gncli gncli.py
+'''
+
+ZSH_COMPLETION = '''#compdef gncli gncli.py
+# gncli completion, generated by gncli completion zsh
+autoload -U +X bashcompinit && bashcompinit
+'''
+
+def completion_script(parser, shell):
+
+    tree, flags, value_options = completion_tree(parser)
+
+    words = []
+    kinds = []
+
+    for path in sorted(tree):
+        words.append('        "%s") _gncli_w="%s" ;;' % (path, ' '.join(tree[path])))
+
+        for option in tree[path]:
+            kind = completion_kind(path, option)
+
+            if kind is not None:
+                kinds.append('        "%s|%s") _gncli_k=%s ;;' % (path, option, kind))
+
+    script = BASH_COMPLETION.replace('@WORDS@', '\n'.join(words)) \
+        .replace('@KINDS@', '\n'.join(kinds)) \
+        .replace('@FLAGS@', ' '.join(sorted(flags))) \
+        .replace('@VALUE_OPTIONS@', ' '.join(sorted(value_options)))
+
+    if shell == 'zsh':
+        script = ZSH_COMPLETION + script
+
+    return script
+
+SNAPSHOT_MAGIC = b'GNCLISNAP1\n'
+SNAPSHOT_BLOCK_SIZE = 4096
+
+class SnapshotWriter(object):
+
+    # Rows are written in zlib compressed JSON blocks of a single kind,
+    # followed by an index of each block's offset, row count and first and
+    # last key, and finally the index's own offset. Readers only decompress
+    # the blocks a query can touch
+
+    def __init__(self, path):
+        self.path = path
+        handle, self.temp_path = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(path)), prefix='.gncli-')
+        self.file = os.fdopen(handle, 'wb')
+        self.file.write(SNAPSHOT_MAGIC)
+        self.index = {}
+
+    def write_block(self, kind, rows, key):
+
+        data = zlib.compress(json.dumps(rows, separators=(',', ':')).encode('utf-8'))
+
+        self.index[kind].append([self.file.tell(), len(data), len(rows),
+            key(rows[0]) if key else None, key(rows[-1]) if key else None])
+
+        self.file.write(data)
+
+    def write(self, kind, rows, key=None):
+
+        # rows must already be in key order when a key is given
+        self.index.setdefault(kind, [])
+
+        block = []
+
+        for row in rows:
+            block.append(row)
+
+            if len(block) == SNAPSHOT_BLOCK_SIZE:
+                self.write_block(kind, block, key)
+                block = []
+
+        if block:
+            self.write_block(kind, block, key)
+
+    def close(self, meta):
+
+        offset = self.file.tell()
+
+        self.file.write(zlib.compress(json.dumps({'meta': meta, 'blocks': self.index})
+            .encode('utf-8')))
+        self.file.write(struct.pack('>Q', offset))
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+
+        os.replace(self.temp_path, self.path)
+
+    def abort(self):
+
+        self.file.close()
+        os.remove(self.temp_path)
+
+def invoice_snapshot_row(record):
+
+    return record.as_tuple()[:2] + (record.owner.as_tuple(),) + record.as_tuple()[3:-1] \
+        + ([entry.as_tuple() for entry in record.entries],)
+
+def invoice_from_snapshot_row(row):
+
+    return InvoiceRecord(*(row[:2] + [OwnerRecord(*row[2])] + row[3:-1]
+        + [tuple(entry_from_snapshot_row(entry) for entry in row[-1])]))
+
+def entry_from_snapshot_row(row):
+
+    # Snapshots written before entries carried their discount have none
+    return EntryRecord(*(row + [0, 1, 'value'][len(row) - 8:]))
+
+def transaction_snapshot_rows(book):
+
+    query = gnucash.Query()
+    query.search_for('Trans')
+    query.set_book(book)
+
+    rows = []
+
+    for result in query.run():
+        transaction = Transaction(instance=result)
+
+        rows.append([transaction.GetGUID().to_string(),
+            transaction.GetDate().strftime("%Y-%m-%d"), transaction.GetNum(),
+            transaction.GetDescription(), transaction.GetCurrency().get_mnemonic(),
+            transaction.GetNotes()])
+
+    query.destroy()
+
+    rows.sort()
+
+    return rows
+
+def earliest_transaction_date(book):
+
+    # One pass over the transactions alone, without building their splits
+    query = gnucash.Query()
+    query.search_for('Trans')
+    query.set_book(book)
+
+    earliest = None
+
+    for result in query.run():
+        date = Transaction(instance=result).GetDate().strftime("%Y-%m-%d")
+
+        if earliest is None or date < earliest:
+            earliest = date
+
+    query.destroy()
+
+    return earliest
+
+def price_snapshot_rows(book):
+
+    cache = PriceCache.from_book(book)
+
+    for (base, quote), (dates, values) in sorted(cache.pairs.items()):
+        for date, value in zip(dates, values):
+            yield [base, quote, date, str(value)]
+
+def currency_fractions(book):
+
+    fractions = {}
+
+    for namespace in book.get_table().get_namespaces_list():
+        for commodity in namespace.get_commodity_list():
+            fractions[commodity.get_mnemonic()] = commodity.get_fraction()
+
+    return fractions
+
+def create_snapshot(connection_string, path, use_replica=True):
+
+    session = start_read_session(connection_string, use_replica)
+
+    try:
+        book = session.book
+        writer = SnapshotWriter(path)
+
+        try:
+            writer.write('accounts', (account.as_tuple()
+                for account in get_account_records(book)))
+
+            for kind in ['customer', 'vendor']:
+                writer.write(kind + 's', sorted(get_name_records(book, kind).values()),
+                    lambda row: row[0])
+
+            writer.write('invoices', (invoice_snapshot_row(invoice) for invoice in
+                sorted(get_invoice_records(book, {}, True), key=lambda record: record.id)),
+                lambda row: row[1])
+            writer.write('bills', (invoice_snapshot_row(bill) for bill in
+                sorted(get_bill_records(book, {}, True), key=lambda record: record.id)),
+                lambda row: row[1])
+
+            writer.write('transactions', transaction_snapshot_rows(book),
+                lambda row: row[0])
+
+            # Splits are ordered by account and date so account and date
+            # range queries only read the blocks that cover them
+            splits = get_split_records(book, None, None, None)
+            splits.sort(key=lambda split: (split.account_guid, split.date or '',
+                split.transaction_guid))
+
+            writer.write('splits', (split.as_tuple() for split in splits),
+                lambda row: [row[2], row[3] or ''])
+
+            writer.write('prices', price_snapshot_rows(book))
+
+            writer.close({
+                'created': datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                'fingerprint': book_fingerprint(connection_string),
+                'currencies': currency_fractions(book)
+            })
+        except BaseException:
+            writer.abort()
+            raise
+    finally:
+        end_session(False)
+
+    return dict((kind, sum(block[2] for block in blocks))
+        for kind, blocks in writer.index.items())
+
+class Snapshot(object):
+
+    # Answers the record queries used by the read only commands from a
+    # snapshot file, without the bindings or a session
+
+    def __init__(self, path):
+
+        try:
+            self.file = open(path, 'rb')
+
+            if self.file.read(len(SNAPSHOT_MAGIC)) != SNAPSHOT_MAGIC:
+                raise ValueError(path)
+
+            self.file.seek(-8, os.SEEK_END)
+            offset, = struct.unpack('>Q', self.file.read(8))
+            self.file.seek(offset)
+
+            index = json.loads(zlib.decompress(self.file.read()[:-8]).decode('utf-8'))
+        except (IOError, OSError, ValueError, struct.error, zlib.error):
+            raise Error('InvalidSnapshot', 'The snapshot file could not be read',
+                {'field': 'snapshot'})
+
+        self.meta = index['meta']
+        self.blocks = index['blocks']
+
+    def rows(self, kind, low=None, high=None):
+
+        # Blocks wholly outside [low, high] are skipped without reading them
+        for offset, length, count, first, last in self.blocks.get(kind, []):
+            if low is not None and last < low:
+                continue
+
+            if high is not None and first > high:
+                continue
+
+            self.file.seek(offset)
+
+            for row in json.loads(zlib.decompress(self.file.read(length)).decode('utf-8')):
+                yield row
+
+    def get_account_records(self):
+
+        return [AccountRecord(*row) for row in self.rows('accounts')]
+
+    def account_guid_from_name(self, account_name):
+
+        # The same first match in tree order as account_guid_from_name
+        for account, depth in walk_accounts(self.get_account_records()):
+            if account.name.lower() == account_name.lower():
+                return account.guid
+
+        return ''
+
+    def iter_split_records(self, guid, date_posted_from, date_posted_to):
+
+        for value, type, field in [
+            (date_posted_from, 'InvalidDatePostedFrom', 'date_posted_from'),
+            (date_posted_to, 'InvalidDatePostedTo', 'date_posted_to')]:
+            if value is not None:
+                try:
+                    datetime.datetime.strptime(value, "%Y-%m-%d")
+                except ValueError:
+                    raise Error(type, 'The dates must be provided in the form YYYY-MM-DD',
+                        {'field': field})
+
+        intern = Interner()
+
+        if guid is None:
+            low = high = None
+        else:
+            low = [guid, date_posted_from or '']
+            high = [guid, date_posted_to or '\uffff']
+
+        for row in self.rows('splits', low, high):
+            if guid is not None and row[2] != guid:
+                continue
+
+            if date_posted_from is not None and (row[3] is None or row[3] < date_posted_from):
+                continue
+
+            if date_posted_to is not None and (row[3] is None or row[3] > date_posted_to):
+                continue
+
+            row[1:4] = [intern(value) for value in row[1:4]]
+            row[7] = intern(row[7])
+
+            yield SplitRecord(*row)
+
+    def get_split_records(self, guid, date_posted_from, date_posted_to):
+
+        return list(self.iter_split_records(guid, date_posted_from, date_posted_to))
+
+    def get_invoice_records(self, properties, with_entries=True, kind='invoices'):
+
+        # Supports the is_posted, is_paid and is_active filters of invoice
+        # list, snapshots always hold the entries
+        records = []
+
+        for row in self.rows(kind):
+            record = invoice_from_snapshot_row(row)
+
+            if properties.get('is_posted') is not None \
+                and bool(record.posted) != bool(properties['is_posted']):
+                continue
+
+            if properties.get('is_paid') is not None \
+                and bool(record.paid) != bool(properties['is_paid']):
+                continue
+
+            if properties.get('is_active') is not None \
+                and bool(record.active) != bool(properties['is_active']):
+                continue
+
+            records.append(record)
+
+        return records
+
+    def get_bill_records(self, properties, with_entries=True):
+        return self.get_invoice_records(properties, with_entries, 'bills')
+
+    def name_rows(self, kind):
+        return self.rows(kind + 's')
+
+    def transaction_rows(self):
+        return self.rows('transactions')
+
+    def get_customers(self):
+
+        # Only the fields a snapshot keeps, a subset of the live book's
+        # customer dicts with the same names, enough for customer list
+        return [{
+            'id': row[0],
+            'name': row[1],
+            'address': {
+                'name': row[2],
+                'email': row[3],
+                'line_1': row[4],
+                'line_2': row[5],
+                'line_3': row[6],
+                'line_4': row[7]
+            }
+        } for row in self.rows('customers')]
+
+    def report_currency(self, mnemonic):
+
+        if mnemonic not in self.meta['currencies']:
+            raise Error('InvalidReportCurrency', 'A valid report currency must be supplied',
+                {'field': 'report_currency'})
+
+        prices = {}
+
+        for base, quote, date, value in self.rows('prices'):
+            prices.setdefault((base, quote), ([], []))
+            prices[(base, quote)][0].append(date)
+            prices[(base, quote)][1].append(Decimal(value))
+
+        cache = PriceCache()
+        cache.pairs = prices
+
+        return cache, self.meta['currencies'][mnemonic]
+
+    def close(self):
+        self.file.close()
+
+class BookRecords(object):
+
+    # The live book behind the same interface as Snapshot, so the read
+    # only commands can run against either
+
+    def __init__(self, connection_string, use_replica):
+        self.book = start_read_session(connection_string, use_replica).book
+
+    def get_account_records(self):
+        return get_account_records(self.book)
+
+    def account_guid_from_name(self, account_name):
+        return account_guid_from_name(self.book, account_name)
+
+    def iter_split_records(self, guid, date_posted_from, date_posted_to):
+        return iter_split_records(self.book, guid, date_posted_from, date_posted_to)
+
+    def get_split_records(self, guid, date_posted_from, date_posted_to):
+        return get_split_records(self.book, guid, date_posted_from, date_posted_to)
+
+    def get_invoice_records(self, properties, with_entries=False):
+        return get_invoice_records(self.book, properties, with_entries)
+
+    def get_bill_records(self, properties, with_entries=False):
+        return get_bill_records(self.book, properties, with_entries)
+
+    def name_rows(self, kind):
+        return sorted(get_name_records(self.book, kind).values())
+
+    def transaction_rows(self):
+        return transaction_snapshot_rows(self.book)
+
+    def earliest_transaction_date(self):
+        return earliest_transaction_date(self.book)
+
+    def get_customers(self):
+        return get_customers(self.book)
+
+    def report_currency(self, mnemonic):
+        return report_currency(self.book, mnemonic)
+
+    def close(self):
+        end_session(False)
+
+def open_records(args):
+
+    if args.snapshot is not None:
+        return Snapshot(args.snapshot)
+    else:
+        return BookRecords(args.connection_string, not args.no_replica)
+
+DIFF_KINDS = ['account', 'customer', 'vendor', 'invoice', 'bill', 'transaction']
+
+NAME_FIELDS = ['id', 'name', 'contact', 'email', 'address_1', 'address_2',
+    'address_3', 'address_4']
+
+def diff_digest(fields):
+
+    return int.from_bytes(hashlib.sha1(json.dumps(fields, sort_keys=True,
+        default=str).encode('utf-8')).digest()[:16], 'big')
+
+def diff_number(num, denom):
+
+    # The same amount compares equal whatever its denominator
+    return '{:f}'.format((Decimal(num) / Decimal(denom)).normalize())
+
+def split_diff_fields(split):
+
+    return {
+        'account_guid': split.account_guid,
+        'memo': split.memo,
+        'value': diff_number(split.value_num, split.value_denom),
+        'amount': diff_number(split.amount_num, split.amount_denom),
+        'reconcile': split.reconcile
+    }
+
+def transaction_diff_fields(row):
+
+    return dict(zip(['date', 'num', 'description', 'currency', 'notes'], row[1:]))
+
+def iter_entities(records):
+
+    # (kind, key, label, fields) for every entity except transactions,
+    # which need their splits gathered
+    for account in records.get_account_records():
+        fields = account.to_dict()
+        del fields['guid']
+
+        yield 'account', account.guid, account.full_name, fields
+
+    for kind in ['customer', 'vendor']:
+        for row in records.name_rows(kind):
+            yield kind, row[0], row[0] + ' ' + row[1], dict(zip(NAME_FIELDS, row))
+
+    for kind, invoices in [('invoice', records.get_invoice_records({}, True)),
+        ('bill', records.get_bill_records({}, True))]:
+
+        for invoice in invoices:
+            fields = invoice.to_dict()
+            del fields['guid']
+            fields['owner'] = invoice.owner.id
+            fields['entries'] = dict((entry.pop('guid'), entry)
+                for entry in fields['entries'])
+
+            yield kind, invoice.guid, invoice.id, fields
+
+def entity_hashes(records):
+
+    # One streaming pass keeping only a digest and a label per entity. A
+    # transaction's digest folds in its splits' digests by addition, so the
+    # splits can arrive in any order
+    hashes = {}
+
+    for kind, key, label, fields in iter_entities(records):
+        hashes[(kind, key)] = (diff_digest(fields), label)
+
+    splits = {}
+
+    for split in records.iter_split_records(None, None, None):
+        splits[split.transaction_guid] = (splits.get(split.transaction_guid, 0)
+            + diff_digest([split.guid, split_diff_fields(split)])) % (1 << 128)
+
+    for row in records.transaction_rows():
+        hashes[('transaction', row[0])] = (diff_digest([transaction_diff_fields(row),
+            splits.get(row[0], 0)]), (row[1] or '') + ' ' + row[3])
+
+    return hashes
+
+def entity_fields(records, wanted):
+
+    # Full fields, only for the entities in wanted
+    fields = {}
+
+    for kind, key, label, entity in iter_entities(records):
+        if (kind, key) in wanted:
+            fields[(kind, key)] = entity
+
+    if any(kind == 'transaction' for kind, key in wanted):
+        for row in records.transaction_rows():
+            if ('transaction', row[0]) in wanted:
+                fields[('transaction', row[0])] = dict(transaction_diff_fields(row),
+                    splits={})
+
+        for split in records.iter_split_records(None, None, None):
+            transaction = fields.get(('transaction', split.transaction_guid))
+
+            if transaction is not None:
+                transaction['splits'][split.guid] = split_diff_fields(split)
+
+    return fields
+
+def flatten_fields(fields, prefix=''):
+
+    flat = {}
+
+    for name, value in fields.items():
+        if isinstance(value, dict):
+            flat.update(flatten_fields(value, prefix + name + '.'))
+        else:
+            flat[prefix + name] = value
+
+    return flat
+
+def field_changes(fields_a, fields_b):
+
+    fields_a = flatten_fields(fields_a)
+    fields_b = flatten_fields(fields_b)
+
+    return [{'field': name, 'a': fields_a.get(name), 'b': fields_b.get(name)}
+        for name in sorted(set(fields_a) | set(fields_b))
+        if fields_a.get(name) != fields_b.get(name)]
+
+def open_diff_source(path, use_replica):
+
+    # Either side may be a snapshot or anything start_read_session accepts
+    try:
+        with open(path, 'rb') as source_file:
+            is_snapshot = source_file.read(len(SNAPSHOT_MAGIC)) == SNAPSHOT_MAGIC
+    except (IOError, OSError):
+        is_snapshot = False
+
+    if is_snapshot:
+        return Snapshot(path)
+    else:
+        return BookRecords(path, use_replica)
+
+def diff_books(source_a, source_b, use_replica=True):
+
+    # Digests for both sides, then full fields for the changed entities
+    # only, so neither side is ever held in memory as a whole. Only one book
+    # can be open at a time, so the first side is read a second time when
+    # anything changed
+    records = open_diff_source(source_a, use_replica)
+
+    try:
+        hashes_a = entity_hashes(records)
+    finally:
+        records.close()
+
+    records = open_diff_source(source_b, use_replica)
+
+    try:
+        hashes_b = entity_hashes(records)
+
+        changed = set(key for key, (digest, label) in hashes_b.items()
+            if key in hashes_a and hashes_a[key][0] != digest)
+
+        fields_b = entity_fields(records, changed)
+    finally:
+        records.close()
+
+    fields_a = {}
+
+    if changed:
+        records = open_diff_source(source_a, use_replica)
+
+        try:
+            fields_a = entity_fields(records, changed)
+        finally:
+            records.close()
+
+    def entity(key, label):
+        return {'kind': key[0], 'key': key[1], 'label': label}
+
+    def order(entity):
+        return (DIFF_KINDS.index(entity['kind']), entity['label'], entity['key'])
+
+    results = {
+        'added': sorted([entity(key, label) for key, (digest, label) in hashes_b.items()
+            if key not in hashes_a], key=order),
+        'removed': sorted([entity(key, label) for key, (digest, label) in hashes_a.items()
+            if key not in hashes_b], key=order),
+        'changed': []
+    }
+
+    for key in changed:
+        result = entity(key, hashes_b[key][1])
+        result['fields'] = field_changes(fields_a.get(key, {}), fields_b.get(key, {}))
+        results['changed'].append(result)
+
+    results['changed'].sort(key=order)
+
+    return results
+
+# inotify(7) constants, the values are part of the Linux ABI
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+INOTIFY_EVENT = struct.Struct('iIII')
+
+class InotifyWatcher(object):
+
+    # Watches the book's directory rather than the file, as saves may
+    # replace the file and the WAL comes and goes. Only events for the book
+    # and its WAL count, so the sidecars written beside it are ignored
+
+    def __init__(self, path):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError('inotify is not available')
+
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+
+        directory = os.path.dirname(os.path.abspath(path))
+        name = os.path.basename(path)
+
+        self.names = set([name.encode('utf-8'), (name + '-wal').encode('utf-8')])
+
+        if libc.inotify_add_watch(self.fd, directory.encode('utf-8'),
+            IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE) < 0:
+            os.close(self.fd)
+            raise OSError(ctypes.get_errno(), 'inotify_add_watch failed')
+
+    def wait(self, timeout):
+
+        # True when the book changed within timeout seconds
+        deadline = time.time() + timeout
+
+        while True:
+            remaining = deadline - time.time()
+
+            if remaining <= 0 or not select.select([self.fd], [], [], remaining)[0]:
+                return False
+
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                continue
+
+            offset = 0
+            changed = False
+
+            while offset < len(data):
+                wd, mask, cookie, length = INOTIFY_EVENT.unpack_from(data, offset)
+                offset += INOTIFY_EVENT.size
+
+                if data[offset:offset + length].rstrip(b'\x00') in self.names:
+                    changed = True
+
+                offset += length
+
+            if changed:
+                return True
+
+    def close(self):
+        os.close(self.fd)
+
+class PollingWatcher(object):
+
+    # The fallback where inotify isn't available, the book's fingerprint is
+    # checked every interval. SQLite books also have their data_version
+    # checked, which moves with every commit from another connection
+
+    def __init__(self, path, interval):
+        self.path = path
+        self.interval = interval
+        self.fingerprint = book_fingerprint(path)
+        self.connection = None
+        self.data_version = None
+
+        if is_sqlite_book(path):
+            self.connection = sqlite3.connect('file:' + pathname2url(
+                os.path.abspath(path)) + '?mode=ro', uri=True)
+            self.data_version = self.get_data_version()
+
+    def get_data_version(self):
+
+        try:
+            return self.connection.execute('PRAGMA data_version').fetchone()[0]
+        except sqlite3.Error:
+            return None
+
+    def wait(self, timeout):
+
+        deadline = time.time() + timeout
+
+        while True:
+            fingerprint = book_fingerprint(self.path)
+            data_version = None
+
+            if self.connection is not None:
+                data_version = self.get_data_version()
+
+            if fingerprint != self.fingerprint or data_version != self.data_version:
+                self.fingerprint = fingerprint
+                self.data_version = data_version
+                return True
+
+            remaining = deadline - time.time()
+
+            if remaining <= 0:
+                return False
+
+            time.sleep(min(self.interval, remaining))
+
+    def close(self):
+
+        if self.connection is not None:
+            self.connection.close()
+
+def book_watcher(connection_string, interval):
+
+    path = book_path(connection_string)
+
+    if path is None or not os.path.exists(path):
+        raise Error('WatchNotSupported',
+            'Only books stored in a local file can be watched',
+            {'field': 'connection_string'})
+
+    try:
+        return InotifyWatcher(path)
+    except (OSError, AttributeError):
+        return PollingWatcher(path, interval)
+
+def refresh_sidecars(connection_string, use_replica=True):
+
+    # Brings each sidecar that exists up to date with the book as it is
+    # now, returning the names of those refreshed. Changes made outside
+    # gncli can't be attributed, so balances are invalidated and rebuilt
+    # lazily and the others are rebuilt from one read session
+    fingerprint = book_fingerprint(connection_string)
+
+    refreshed = []
+
+    if (is_sqlite_book(connection_string)
+        and os.path.exists(sidecar_path(connection_string, 'replica'))
+        and not replica_is_current(connection_string)):
+        refresh_replica(connection_string)
+        refreshed.append('replica')
+
+    if BalanceStore.exists(connection_string):
+        store = BalanceStore(connection_string)
+
+        try:
+            if store.get_fingerprint() != fingerprint:
+                store.invalidate_all()
+                store.set_fingerprint(fingerprint)
+                refreshed.append('balances')
+        finally:
+            store.close()
+
+    index = None
+
+    if SearchIndex.exists(connection_string):
+        index = SearchIndex(connection_string)
+
+        if index.get_fingerprint() == fingerprint:
+            index.close()
+            index = None
+
+    completion = (os.path.exists(sidecar_path(connection_string, 'completion'))
+        and read_completion_fingerprint(connection_string) != fingerprint)
+
+    if index is None and not completion:
+        return refreshed
+
+    try:
+        session = start_read_session(connection_string, use_replica)
+
+        try:
+            if index is not None:
+                index.rebuild(session.book)
+                index.set_fingerprint(fingerprint)
+                refreshed.append('search')
+
+            if completion:
+                write_completion_cache(connection_string, session.book, fingerprint)
+                refreshed.append('completion')
+        finally:
+            end_session(False)
+    finally:
+        if index is not None:
+            index.close()
+
+    return refreshed
+
+def watch_book(connection_string, on_change, debounce, interval, use_replica=True):
+
+    # Waits for the book to change, then for a quiet period of debounce
+    # seconds so a burst of writes is handled once. Nothing runs unless the
+    # book's fingerprint moved since the last refresh
+    watcher = book_watcher(connection_string, interval)
+
+    sys.stderr.write('Watching %s (%s)\n' % (book_path(connection_string),
+        'inotify' if isinstance(watcher, InotifyWatcher) else 'polling'))
+
+    last = None
+
+    try:
+        while True:
+            fingerprint = book_fingerprint(connection_string)
+
+            if fingerprint != last:
+                started = time.time()
+
+                try:
+                    refreshed = refresh_sidecars(connection_string, use_replica)
+                except Error as error:
+                    sys.stderr.write(error.message + '\n')
+                    refreshed = []
+
+                sys.stderr.write('Refreshed %s in %.2fs\n' % (', '.join(refreshed)
+                    or 'nothing', time.time() - started))
+
+                # The first pass only brings the sidecars up to date
+                if on_change is not None and last is not None:
+                    env = dict(os.environ, GNCLI_BOOK=connection_string)
+
+                    returncode = subprocess.call(on_change, shell=True, env=env)
+
+                    if returncode != 0:
+                        sys.stderr.write('The change command exited with %d\n'
+                            % returncode)
+
+                last = fingerprint
+
+            # Block until something happens, then until it settles, but
+            # never put off a refresh for more than ten quiet periods
+            while not watcher.wait(interval):
+                pass
+
+            settle = time.time() + debounce * 10
+
+            while time.time() < settle and watcher.wait(debounce):
+                pass
+    finally:
+        watcher.close()
+
+def benchmark_results(connection_string, kind, variant):
+
+    # Runs in its own process so the peak RSS belongs to one variant alone
+    session = start_read_session(connection_string)
+
+    try:
+        rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        tracemalloc.start()
+        started = time.time()
+
+        if kind == 'invoices' and variant == 'dicts':
+            results = get_invoices(session.book, {})
+        elif kind == 'invoices':
+            results = get_invoice_records(session.book, {}, True)
+        elif variant == 'dicts':
+            results = get_account_splits(session.book, None, None, None)
+        else:
+            results = get_split_records(session.book, None, None, None)
+
+        elapsed = time.time() - started
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    finally:
+        end_session(False)
+
+    return {
+        'variant': variant,
+        'rows': len(results),
+        'seconds': elapsed,
+        'python_peak_mb': peak / 1048576.0,
+        # ru_maxrss is in kilobytes on Linux
+        'rss_growth_mb': (rss_after - rss_before) / 1024.0,
+        'peak_rss_mb': rss_after / 1024.0
+    }
+
+def gnc_numeric_to_decimal(numeric):
+
+    return Decimal(numeric.num()) / Decimal(numeric.denom())
+
+class Error(Exception):
+    """Base class for exceptions in this module."""
+    def __init__(self, type, message, data):
+        self.type = type
+        self.message = message
+        self.data = data
+
+def flatten_accounts(account):
+
+    accounts = [];
+    
+    accounts.append(account)
+
+    for subaccount in account['subaccounts']:
+        accounts = accounts + flatten_accounts(subaccount)
+
+    # we don't actually remove the subaccounts
+
+    return accounts
+
+
+class SaveScheduler(object):
+
+    # Coalesces saves in long running modes, the session is saved after
+    # max_batch mutations, after quiet_ms without a mutation or on an
+    # explicit flush, whichever comes first
+
+    def __init__(self, max_batch, quiet_ms):
+        self.max_batch = max_batch
+        self.quiet = quiet_ms / 1000.0
+        self.pending = 0
+        self.last_mutation = None
+        self.saves = 0
+        self.saved_mutations = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        self.last_latency = None
+        self.last_batch = 0
+
+    def mutated(self):
+
+        # Returns True once the batch is full and should be flushed
+        self.pending += 1
+        self.last_mutation = time.time()
+
+        return self.pending >= self.max_batch
+
+    def timeout(self):
+
+        # Seconds until a quiet flush is due, or None when nothing is pending
+        if self.pending == 0:
+            return None
+
+        return max(0, self.last_mutation + self.quiet - time.time())
+
+    def flush(self):
+
+        if self.pending == 0:
+            return
+
+        started = time.time()
+        save_session()
+        latency = time.time() - started
+
+        self.saves += 1
+        self.saved_mutations += self.pending
+        self.total_latency += latency
+        self.max_latency = max(self.max_latency, latency)
+        self.last_latency = latency
+        self.last_batch = self.pending
+
+        self.pending = 0
+
+        sys.stderr.write('Saved %d mutations in %.1f ms\n'
+            % (self.last_batch, latency * 1000))
+
+    def stats(self):
+
+        if self.saves == 0:
+            average_latency = None
+            average_batch = None
+        else:
+            average_latency = self.total_latency / self.saves * 1000
+            average_batch = self.saved_mutations / float(self.saves)
+
+        if self.last_latency is None:
+            last_latency = None
+        else:
+            last_latency = self.last_latency * 1000
+
+        return {
+            'pending': self.pending,
+            'saves': self.saves,
+            'saved_mutations': self.saved_mutations,
+            'last_batch': self.last_batch,
+            'average_batch': average_batch,
+            'last_latency_ms': last_latency,
+            'average_latency_ms': average_latency,
+            'max_latency_ms': self.max_latency * 1000
+        }
+
+def flush_session(book):
+
+    if save_scheduler is None:
+        save_session()
+        return {}
+
+    save_scheduler.flush()
+
+    return save_scheduler.stats()
+
+def get_save_stats(book):
+
+    if save_scheduler is None:
+        return {}
+
+    return save_scheduler.stats()
+
+class Engine(threading.Thread):
+
+    # The GnuCash bindings aren't thread safe so every call into them is
+    # made from this one thread, fed by a queue of jobs from the event loop
+
+    def __init__(self, connection_string, max_batch, quiet_ms):
+        threading.Thread.__init__(self, name='gncli-engine')
+        self.daemon = True
+        self.connection_string = connection_string
+        self.max_batch = max_batch
+        self.quiet_ms = quiet_ms
+        self.jobs = queue.Queue()
+        self.started = threading.Event()
+        self.error = None
+
+    def submit(self, func, args, mutating):
+        future = concurrent.futures.Future()
+        self.jobs.put((future, func, args, mutating))
+        return future
+
+    def stop(self):
+        self.jobs.put(None)
+
+    def run(self):
+
+        global save_scheduler
+
+        app.connection_string = self.connection_string
+
+        try:
+            start_write_session(app.connection_string, False)
+        except Error as error:
+            self.error = error
+            self.started.set()
+            return
+
+        save_scheduler = SaveScheduler(self.max_batch, self.quiet_ms)
+
+        self.started.set()
+
+        while True:
+            try:
+                job = self.jobs.get(timeout=save_scheduler.timeout())
+            except queue.Empty:
+                self.flush()
+                continue
+
+            if job is None:
+                break
+
+            self.run_job(*job)
+
+            # A steady stream of jobs never lets the get time out, so the
+            # quiet period is also checked after each one
+            if save_scheduler.timeout() == 0:
+                self.flush()
+
+        try:
+            end_session()
+        except Error as error:
+            sys.stderr.write(error.message + '\n')
+
+            # Keep the unsaved mutations for the next start to replay
+            close_journal(False)
+
+        save_scheduler = None
+
+    def flush(self):
+
+        try:
+            save_scheduler.flush()
+        except Error as error:
+            # Leave the mutations pending so the next flush retries them
+            sys.stderr.write(error.message + '\n')
+
+    def run_job(self, future, func, args, mutating):
+
+        if not future.set_running_or_notify_cancel():
+            return
+
+        try:
+            result = func(session.book, *args)
+        except Exception as e:
+            future.set_exception(e)
+            return
+
+        future.set_result(result)
+
+        # Only mutations that went through have anything to save
+        if mutating and save_scheduler.mutated():
+            self.flush()
+
+class HttpRequest(object):
+
+    def __init__(self, method, path, params, keep_alive):
+        self.method = method
+        self.path = path
+        self.params = params
+        self.keep_alive = keep_alive
+
+HTTP_REASONS = {
+    200: 'OK',
+    201: 'Created',
+    204: 'No Content',
+    400: 'Bad Request',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    500: 'Internal Server Error'
+}
+
+# Requests read ahead of their responses on a pipelined connection
+HTTP_PIPELINE_DEPTH = 32
+
+# Items per chunk when streaming list results
+HTTP_STREAM_BATCH = 256
+
+def http_param(params, name, default=''):
+
+    value = params.get(name, default)
+
+    if value is None:
+        return default
+    else:
+        return value
+
+def http_id_param(params, name):
+
+    # An empty or missing ID lets GnuCash allocate the next one
+    value = params.get(name)
+
+    if value == '':
+        return None
+    else:
+        return value
+
+def http_int_param(params, name, default=None):
+
+    value = params.get(name)
+
+    if value is None or value == '':
+        return default
+    else:
+        return sint(str(value))
+
+def http_splits_param(params):
+
+    splits = params.get('splits', [])
+
+    if isinstance(splits, str):
+        try:
+            splits = json.loads(splits)
+        except ValueError:
+            raise Error('InvalidSplits', 'The splits must be a JSON list',
+                {'field': 'splits'})
+
+    return splits
+
+def http_invoice_properties(params):
+
+    properties = {}
+
+    for name in ['customer', 'date_opened_from', 'date_opened_to',
+        'date_due_from', 'date_due_to', 'date_posted_from', 'date_posted_to']:
+        if params.get(name, '') != '':
+            properties[name] = params[name]
+
+    for name in ['is_posted', 'is_paid', 'is_active']:
+        properties[name] = http_int_param(params, name)
+
+    return properties
+
+def http_address_args(params):
+
+    return [http_param(params, 'contact'), http_param(params, 'address_line_1'),
+        http_param(params, 'address_line_2'), http_param(params, 'address_line_3'),
+        http_param(params, 'address_line_4'), http_param(params, 'phone'),
+        http_param(params, 'fax'), http_param(params, 'email')]
+
+def http_post_args(params):
+
+    return [http_param(params, 'notes'), http_int_param(params, 'posted', 0),
+        http_param(params, 'posted_account_guid'), http_param(params, 'posted_date'),
+        http_param(params, 'due_date'), http_param(params, 'posted_memo'),
+        http_int_param(params, 'posted_accumulatesplits', 0) == 1,
+        http_int_param(params, 'posted_autopay', 0) == 1]
+
+# Each route maps a method and path onto one of the library functions, the
+# lambda builds its arguments (after the book) from the path and parameters
+HTTP_ROUTES = [
+    ('GET', r'/accounts', get_accounts, lambda m, p: []),
+    ('POST', r'/accounts', add_account, lambda m, p: [
+        http_param(p, 'name'), http_param(p, 'currency'),
+        http_int_param(p, 'account_type_id'),
+        http_param(p, 'parent_account_guid')]),
+    ('GET', r'/accounts/([^/]+)', get_account, lambda m, p: [m.group(1)]),
+    ('GET', r'/accounts/([^/]+)/splits', get_account_splits, lambda m, p: [
+        m.group(1), p.get('date_posted_from'), p.get('date_posted_to')]),
+
+    ('GET', r'/customers', get_customers, lambda m, p: []),
+    ('POST', r'/customers', add_customer, lambda m, p: [
+        http_id_param(p, 'id'), http_param(p, 'currency'),
+        http_param(p, 'name')] + http_address_args(p)),
+    ('GET', r'/customers/([^/]+)', get_customer, lambda m, p: [m.group(1)]),
+    ('POST', r'/customers/([^/]+)', update_customer, lambda m, p: [
+        m.group(1), http_param(p, 'name')] + http_address_args(p)),
+
+    ('GET', r'/vendors', get_vendors, lambda m, p: []),
+    ('POST', r'/vendors', add_vendor, lambda m, p: [
+        http_id_param(p, 'id'), http_param(p, 'currency'),
+        http_param(p, 'name')] + http_address_args(p)),
+    ('GET', r'/vendors/([^/]+)', get_vendor, lambda m, p: [m.group(1)]),
+
+    ('GET', r'/invoices', get_invoices, lambda m, p: [
+        http_invoice_properties(p)]),
+    ('POST', r'/invoices', add_invoice, lambda m, p: [
+        http_id_param(p, 'id'), http_param(p, 'customer_id'),
+        http_id_param(p, 'currency'), http_param(p, 'date_opened'),
+        http_param(p, 'notes')]),
+    ('GET', r'/invoices/([^/]+)', get_invoice, lambda m, p: [m.group(1)]),
+    ('POST', r'/invoices/([^/]+)', update_invoice, lambda m, p: [
+        m.group(1), http_param(p, 'customer_id'), http_id_param(p, 'currency'),
+        http_param(p, 'date_opened')] + http_post_args(p)),
+    ('POST', r'/invoices/([^/]+)/entries', add_entry, lambda m, p: [
+        m.group(1), http_param(p, 'date'), http_param(p, 'description'),
+        http_param(p, 'account_guid'), http_param(p, 'quantity'),
+        http_param(p, 'price'),
+        http_int_param(p, 'discount_type', GNC_AMT_TYPE_VALUE),
+        http_param(p, 'discount', '0')]),
+    ('POST', r'/invoices/([^/]+)/payments', pay_invoice, lambda m, p: [
+        m.group(1), http_param(p, 'transaction_guid'),
+        http_param(p, 'posted_account_guid'),
+        http_param(p, 'transfer_account_guid'), http_param(p, 'payment_date'),
+        http_param(p, 'memo'), http_param(p, 'num'),
+        http_int_param(p, 'auto_pay', 0) == 1]),
+
+    ('GET', r'/bills', get_bills, lambda m, p: [http_invoice_properties(p)]),
+    ('POST', r'/bills', add_bill, lambda m, p: [
+        http_id_param(p, 'id'), http_param(p, 'vendor_id'),
+        http_id_param(p, 'currency'), http_param(p, 'date_opened'),
+        http_param(p, 'notes')]),
+    ('GET', r'/bills/([^/]+)', get_bill, lambda m, p: [m.group(1)]),
+    ('POST', r'/bills/([^/]+)', update_bill, lambda m, p: [
+        m.group(1), http_param(p, 'vendor_id'), http_id_param(p, 'currency'),
+        http_param(p, 'date_opened')] + http_post_args(p)),
+    ('POST', r'/bills/([^/]+)/entries', add_bill_entry, lambda m, p: [
+        m.group(1), http_param(p, 'date'), http_param(p, 'description'),
+        http_param(p, 'account_guid'), http_param(p, 'quantity'),
+        http_param(p, 'price')]),
+    ('POST', r'/bills/([^/]+)/payments', pay_bill, lambda m, p: [
+        m.group(1), http_param(p, 'posted_account_guid'),
+        http_param(p, 'transfer_account_guid'), http_param(p, 'payment_date'),
+        http_param(p, 'memo'), http_param(p, 'num'),
+        http_int_param(p, 'auto_pay', 0) == 1]),
+
+    ('GET', r'/entries/([^/]+)', get_entry, lambda m, p: [m.group(1)]),
+    ('POST', r'/entries/([^/]+)', update_entry, lambda m, p: [
+        m.group(1), http_param(p, 'date'), http_param(p, 'description'),
+        http_param(p, 'account_guid'), http_param(p, 'quantity'),
+        http_param(p, 'price'),
+        http_int_param(p, 'discount_type', GNC_AMT_TYPE_VALUE),
+        p.get('discount')]),
+    ('DELETE', r'/entries/([^/]+)', delete_entry, lambda m, p: [m.group(1)]),
+
+    ('POST', r'/transactions', add_transaction, lambda m, p: [
+        http_param(p, 'num'), http_param(p, 'description'),
+        http_param(p, 'date_posted'), http_param(p, 'currency'),
+        http_splits_param(p)]),
+    ('GET', r'/transactions/([^/]+)', get_transaction, lambda m, p: [m.group(1)]),
+    ('POST', r'/transactions/([^/]+)', edit_transaction, lambda m, p: [
+        m.group(1), http_param(p, 'num'), http_param(p, 'description'),
+        http_param(p, 'date_posted'), http_param(p, 'currency'),
+        http_splits_param(p)]),
+    ('DELETE', r'/transactions/([^/]+)', delete_transaction, lambda m, p: [
+        m.group(1)]),
+
+    ('POST', r'/flush', flush_session, lambda m, p: []),
+    ('GET', r'/stats', get_save_stats, lambda m, p: [])
+]
+
+def http_error_body(type, message, data):
+
+    return {'errors': [{'type': type, 'message': message, 'data': data}]}
+
+async def read_http_request(reader):
+
+    line = await reader.readline()
+
+    if not line:
+        return None
+
+    parts = line.decode('latin-1').split()
+
+    if len(parts) != 3:
+        raise Error('BadRequest', 'The request line is malformed', {})
+
+    method, target, version = parts
+
+    headers = {}
+
+    while True:
+        line = await reader.readline()
+
+        if line in [b'\r\n', b'\n', b'']:
+            break
+
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+
+    if 'chunked' in headers.get('transfer-encoding', '').lower():
+        raise Error('BadRequest', 'Chunked request bodies are not supported', {})
+
+    length = sint(headers.get('content-length', '0'))
+
+    if length is None or length < 0:
+        raise Error('BadRequest', 'The content length is not valid', {})
+
+    body = await reader.readexactly(length)
+
+    url = urlsplit(target)
+
+    params = {}
+
+    for name, values in parse_qs(url.query, keep_blank_values=True).items():
+        params[name] = values[0]
+
+    if body:
+        if headers.get('content-type', '').startswith('application/json'):
+            try:
+                data = json.loads(body.decode('utf-8'))
+            except ValueError:
+                raise Error('BadRequest', 'The request body is not valid JSON', {})
+
+            if not isinstance(data, dict):
+                raise Error('BadRequest', 'The request body must be a JSON object', {})
+
+            params.update(data)
+        else:
+            for name, values in parse_qs(body.decode('utf-8'), keep_blank_values=True).items():
+                params[name] = values[0]
+
+    connection = headers.get('connection', '').lower()
+
+    if version == 'HTTP/1.1':
+        keep_alive = connection != 'close'
+    else:
+        keep_alive = connection == 'keep-alive'
+
+    return HttpRequest(method, url.path.rstrip('/') or '/', params, keep_alive)
+
+async def dispatch_http_request(engine, request):
+
+    allowed = False
+
+    for method, pattern, func, build_args in HTTP_ROUTES:
+        match = re.match('^' + pattern + '$', request.path)
+
+        if match is None:
+            continue
+        elif method != request.method:
+            allowed = True
+            continue
+
+        # Flushing saves rather than mutates so mustn't count towards a batch
+        mutating = method != 'GET' and func != flush_session
+
+        try:
+            args = build_args(match, request.params)
+            result = await asyncio.wrap_future(
+                engine.submit(func, args, mutating))
+        except Error as error:
+            return 400, http_error_body(error.type, error.message, error.data)
+        except Exception as e:
+            return 500, http_error_body('InternalError', str(e), {})
+
+        if result is None:
+            if method == 'DELETE':
+                return 204, None
+            else:
+                return 404, http_error_body('NotFound',
+                    'The requested resource does not exist', {})
+        elif method == 'POST' and len(match.groups()) == 0:
+            return 201, result
+        else:
+            return 200, result
+
+    if allowed:
+        return 405, http_error_body('MethodNotAllowed',
+            'This method is not allowed for this resource', {})
+    else:
+        return 404, http_error_body('NotFound',
+            'The requested resource does not exist', {})
+
+async def write_http_response(writer, status, body, keep_alive):
+
+    head = 'HTTP/1.1 %d %s\r\n' % (status, HTTP_REASONS[status])
+    head += 'Connection: %s\r\n' % ('keep-alive' if keep_alive else 'close')
+
+    if body is None:
+        writer.write((head + 'Content-Length: 0\r\n\r\n').encode('latin-1'))
+    elif isinstance(body, list):
+        # Lists are streamed in chunks so large results start arriving
+        # straight away and are never encoded as one string
+        head += 'Content-Type: application/json\r\n'
+        head += 'Transfer-Encoding: chunked\r\n\r\n'
+        writer.write(head.encode('latin-1'))
+
+        chunk = '['
+
+        for i in range(0, len(body), HTTP_STREAM_BATCH):
+            if i > 0:
+                chunk += ','
+
+            chunk += ','.join(json.dumps(item) for item in body[i:i + HTTP_STREAM_BATCH])
+            data = chunk.encode('utf-8')
+            writer.write(b'%x\r\n%s\r\n' % (len(data), data))
+            await writer.drain()
+            chunk = ''
+
+        data = (chunk + ']').encode('utf-8')
+        writer.write(b'%x\r\n%s\r\n0\r\n\r\n' % (len(data), data))
+    else:
+        data = json.dumps(body).encode('utf-8')
+        head += 'Content-Type: application/json\r\n'
+        head += 'Content-Length: %d\r\n\r\n' % len(data)
+        writer.write(head.encode('latin-1') + data)
+
+    await writer.drain()
+
+async def send_http_responses(responses, writer):
+
+    # Responses are written in request order, while the requests behind them
+    # are already queued on the engine
+    while True:
+        item = await responses.get()
+
+        if item is None:
+            break
+
+        keep_alive, response = item
+        status, body = await response
+
+        await write_http_response(writer, status, body, keep_alive)
+
+async def handle_http_connection(engine, reader, writer):
+
+    responses = asyncio.Queue(maxsize=HTTP_PIPELINE_DEPTH)
+    sender = asyncio.ensure_future(send_http_responses(responses, writer))
+
+    try:
+        while not sender.done():
+            try:
+                request = await read_http_request(reader)
+            except Error as error:
+                response = asyncio.Future()
+                response.set_result((400, http_error_body(error.type, error.message, error.data)))
+                await responses.put((False, response))
+                break
+
+            if request is None:
+                break
+
+            await responses.put((request.keep_alive,
+                asyncio.ensure_future(dispatch_http_request(engine, request))))
+
+            if not request.keep_alive:
+                break
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        if not sender.done():
+            await responses.put(None)
+
+        try:
+            await sender
+        except ConnectionError:
+            pass
+
+        writer.close()
+
+async def serve_http(engine, host, port):
+
+    server = await asyncio.start_server(
+        lambda reader, writer: handle_http_connection(engine, reader, writer),
+        host, port)
+
+    async with server:
+        await server.serve_forever()
+
+def run_http_server(connection_string, host, port, max_batch, quiet_ms):
+
+    engine = Engine(connection_string, max_batch, quiet_ms)
+    engine.start()
+    engine.started.wait()
+
+    if engine.error is not None:
+        raise engine.error
+
+    try:
+        asyncio.run(serve_http(engine, host, port))
+    finally:
+        engine.stop()
+        engine.join()
+
+
+def parse_book_new(args):
+
+    try:
+        start_session(args.connection_string, True, False)
+        end_session()
+    except Error as error:
+        print(error.message)
+        sys.exit(2)
+
+    print('New book created')
+
+
+def parse_book_replicate(args):
+
+    try:
+        refresh_replica(args.connection_string)
+        print('Replica refreshed')
+
+        # Keep refreshing on an interval, but only copy when the book changed
+        while args.interval is not None:
+            time.sleep(args.interval)
+
+            if not replica_is_current(args.connection_string):
+                refresh_replica(args.connection_string)
+                print('Replica refreshed')
+    except Error as error:
+        print(error.message)
+        sys.exit(2)
+    except KeyboardInterrupt:
+        pass
+
+def parse_http(args):
+
+    try:
+        print('Serving on http://%s:%d' % (args.host, args.port))
+        run_http_server(args.connection_string, args.host, args.port,
+            args.batch_size, args.batch_quiet_ms)
+    except Error as error:
+        print(error.message)
+        sys.exit(2)
+    except KeyboardInterrupt:
+        pass
+
+def parse_customer_list(args):
+
+    try:
+        records = open_records(args)
+        customers = records.get_customers()
+        records.close()
+    except Error as error:
+        print(error.message)
+        sys.exit(2)
+
+    customers = sorted(customers, key=lambda k: k['id']) 
+
+    if args.format == 'json':
+        print(json.dumps(customers))
+    else:
+        for customer in customers:
+            print(customer['id'] + " " + customer['name'])
+
+def parse_name_search(args):
+
+    try:
+        results = search_names(args.connection_string, args.kind, args.query,
+            args.limit, not args.no_replica)
+    except Error as error:
+        print(error.message)
+        sys.exit(2)
+
+    if args.format == 'json':
+        print(json.dumps(results))
+    else:
+        for result in results:
+            print(result['id'] + " " + result['name'])
+
+def parse_transaction_search(args):
+
+    try:
+        results = search_transactions(args.connection_string, args.query,
+            args.limit, not args.no_replica)
+    except Error as error:
+        print(error.message)
+        sys.exit(2)
+
+    if args.format == 'json':
+        print(json.dumps(results))
+    else:
+        for result in results:
+            print(result['guid'] + " " + result['summary'])
+
+def parse_transaction_import(args):
+
+    try:
+        lines = read_transaction_rows(args.csv)
+
+        session = start_write_session(args.connection_string)
+
+        results = import_transactions(session.book, lines, args.skip_duplicates)
+
+        end_session()
+    except Error as error:
+        print(error.message)
+        sys.exit(2)
+
+    if args.format == 'json':
+        print(json.dumps(results))
+    else:
+        for result in results:
+            detail = result.get('guid', result.get('reason', ''))
+
+            if 'duplicate_of' in result:
+                detail = (detail + ' duplicate of ' + result['duplicate_of']).strip()
+
+            print('line ' + str(result['line']) + ' ' + result['status'] + ' ' + detail)
+
+def parse_transaction_duplicates(args):
+
+    try:
+        session = start_read_session(args.connection_string, not args.no_replica)
+
+        groups = find_duplicate_transactions(session.book)
+
+        end_session(False)
+    except Error as error:
+        print(error.message)
+        sys.exit(2)
+
+    if args.format == 'json':
+        print(json.dumps(groups))
+    else:
+        for group in groups:
+            print(group[0]['date'] + ' ' + group[0]['amount'] + ' '
+                + group[0]['description'])
+
+            for transaction in group:
+                print('  ' + transaction['guid'] + ' ' + transaction['num'])
+
+def parse_customer_add(args):
+    
+    try:
+        session = start_write_session(args.connection_string)
+        customer = add_customer(session.book, args.id, args.currency, args.name, args.contact,
+        args.address_line_1, args.address_line_2, args.address_line_3, args.address_line_4,
+        args.phone, args.fax, args.email)
+        end_session()
+    except Error as error:
+        print(error.message)
+        sys.exit(2)
+
+    print('Customer ' + customer['id'] + ' created')
+
+def parse_invoice_list(args):
+
+    try:
+        options = {}
+
+        if args.posted == '1':
+            options['is_posted'] = 1
+        elif args.posted == '0':
+            options['is_posted'] = 0
+
+        if args.paid == '1':
+            options['is_paid'] = 1
+        elif args.paid == '0':
+            options['is_paid'] = 0
+
+        if args.active == '1':
+            options['is_active'] = 1
+        elif args.active == '0':
+            options['is_active'] = 0
+
+        if args.snapshot is not None:
+            snapshot = Snapshot(args.snapshot)
+            invoices = snapshot.get_invoice_records(options)
+            snapshot.close()
+
+            # A snapshot only holds the record fields, so its JSON is the
+            # records' own dicts rather than the bindings' fuller invoice
+            # dicts, amounts are exact decimal strings and owners nest whole
+            if args.format == 'json':
+                invoices = [invoice.to_dict() for invoice in invoices]
+        else:
+            session = start_read_session(args.connection_string, not args.no_replica)
+
+            if args.format == 'json':
+                invoices = get_invoices(session.book, options)
+            else:
+                invoices = get_invoice_records(session.book, options)
+
+            end_session(False)
+    except Error as error:
+        print(error.message)
+        sys.exit(2)
+
+    if args.format == 'json':
+        invoices = sorted(invoices, key=lambda k: k['id'])
+        print(json.dumps(invoices))
+    else:
+        for invoice in sorted(invoices, key=lambda k: k.id):
+            print(invoice.id)
+
+def parse_invoice_stats(args):
+
+    try:
+        group_by = parse_stats_fields(args.group_by, STATS_GROUPS, 'group_by')
+        metrics = parse_stats_fields(args.metrics, STATS_METRICS, 'metrics')
+
+        options = {}
+
+        for option, value in [('is_posted', args.posted), ('is_paid', args.paid),
+            ('is_active', args.active)]:
+            if value in ['0', '1']:
+                options[option] = int(value)
+
+        options['date_posted_from'] = args.posted_from
+        options['date_posted_to'] = args.posted_to
+
+        session = start_read_session(args.connection_string, not args.no_replica)
+
+        if args.kind == 'bill':
+            results = invoice_stats(get_gnucash_bills(session.book, options),
+                group_by, metrics, -1)
+        else:
+            results = invoice_stats(get_gnucash_invoices(session.book, options),
+                group_by, metrics, 1)
+
+        end_session(False)
+    except Error as error:
+        print(error.message)
+        sys.exit(2)
+
+    if args.format == 'json':
+        print(json.dumps(results))
+    else:
+        columns = group_by + [column for column in ['currency'] if column not in group_by]
+
+        for row in results:
+            print('  '.join(['%-12s' % row[column] for column in columns]
+                + ['%14s' % row[metric] for metric in metrics]))
+
+def parse_invoice_add(args):
+    
+    try:
+        session = start_write_session(args.connection_string)
+        invoice = add_invoice(session.book, args.id, args.customer_id, args.currency,
+                args.date_opened, args.notes)
+        end_session()
+    except Error as error:
+        print(error.message)
+        sys.exit(2)
+
+    print('Invoice ' + invoice['id'] + ' created')
+
+def parse_bill_add(args):
+
+    try:
+        session = start_write_session(args.connection_string)
+        bill = add_bill(session.book, args.id, args.vendor_id, args.currency,
+                args.date_opened, args.notes)
+        end_session()
+    except Error as error:
+        print(error.message)
+        sys.exit(2)
+
+    print('Bill ' + bill['id'] + ' created')
+
+def parse_bill_entry_add(args):
+
+    try:
+        session = start_write_session(args.connection_string)
+
+        account_guid = account_guid_from_name(session.book, args.account)
+
+        add_bill_entry(session.book, args.bill_id, args.date, args.description,
+            account_guid, args.quantity, args.price)
+        end_session()
+    except Error as error:
+        print(error.message)
+        sys.exit(2)
+
+    print('Entry created')
+
+def parse_bill_post(args):
+
+    try:
+        session = start_write_session(args.connection_string)
+
+        account_guid = account_guid_from_name(session.book, args.posted_account)
+
+        gnucash_bill = get_gnucash_bill(session.book, args.id)
+        if gnucash_bill is None:
+            raise Error('NoBill',
+            'A bill with this ID does not exist',
+            {'field': 'id'})
+
+        was_unposted = is_unposted(gnucash_bill)
+
+        if was_unposted:
+            bill = get_bill(session.book, args.id)
+
+            update_bill(session.book, bill['id'], bill['owner']['id'], bill['currency'],
+                bill['date_opened'], bill['notes'], 1, account_guid, args.posted_date,
+                args.due_date, args.posted_memo, args.posted_accumulatesplits,
+                args.posted_autopay)
+
+        end_session(was_unposted)
+    except Error as error:
+        print(error.message)
+        sys.exit(2)
+
+    if was_unposted:
+        print('Bill ' + args.id + ' posted')
+    else:
+        print('Bill ' + args.id + ' already posted')
+
+def parse_bill_pay(args):
+
+    try:
+        session = start_write_session(args.connection_string)
+
+        account_guid = account_guid_from_name(session.book, args.transfer_account)
+
+        bill = pay_bill(session.book, args.id, '', account_guid, args.payment_date,
+            args.memo, args.num, False)
+
+        end_session()
+    except Error as error:
+        print(error.message)
+        sys.exit(2)
+
+    print('Bill ' + bill['id'] + ' paid')
+
+def parse_bill_import(args):
+
+    try:
+        lines = read_bill_rows(args.csv)
+
+        started = time.time()
+
+        session = start_write_session(args.connection_string)
+
+        results = import_bills(session.book, lines)
+
+        end_session()
+
+        elapsed = time.time() - started
+    except Error as error:
+        print(error.message)
+        sys.exit(2)
+
+    if args.format == 'json':
+        print(json.dumps(results))
+    else:
+        for result in results:
+            status = result['status']
+
+            if result.get('posted'):
+                status += ', posted'
+
+            print('line ' + str(result['line']) + ' ' + result['bill_id'] + ' '
+                + status + ' ' + result.get('guid', result.get('reason', '')))
+
+    sys.stderr.write('Imported %d rows in %.2fs (%.1f rows/sec)\n' % (len(results),
+        elapsed, len(results) / elapsed if elapsed > 0 else 0))
+
+def parse_invoice_post(args):
+
+    if args.all_unposted:
+        parse_invoice_post_all(args)
+        return
+
+    try:
+        session = start_write_session(args.connection_string)
+
+        account_guid = account_guid_from_name(session.book, args.posted_account)
+
+        invoice = get_invoice(session.book, args.id)
+        if invoice is None:
+            raise Error('NoInvoice',
+            'An invoice with this ID does not exist',
+            {'field': 'id'})
+            
+        invoice = update_invoice(session.book, invoice['id'], invoice['owner']['id'], invoice['currency'],
+                invoice['date_opened'], invoice['notes'], True, account_guid, args.posted_date,
+                args.due_date, args.posted_memo, args.posted_accumulatesplits, args.posted_autopay)
+
+        end_session()
+    except Error as error:
+        print(error.message)
+        sys.exit(2)
+
+    print('Invoice ' + invoice['id'] + ' posted')
+
+def parse_invoice_render(args):
+
+    try:
+        if (args.ids is None) == (args.all_posted_since is None):
+            raise Error('NoInvoices', 'Either --ids or --all-posted-since must be provided',
+                {'field': 'ids'})
+
+        posted_since = None
+
+        if args.all_posted_since is not None:
+            posted_since = parse_report_date(args.all_posted_since, 'all_posted_since')
+
+        paths = render_invoices(args.connection_string, args.ids, posted_since, args.out,
+            args.format, args.template, args.workers, not args.no_replica)
+    except Error as error:
+        print(error.message)
+        sys.exit(2)
 
-        parent_account = account_guid.AccountLookup(book)
+    for path in paths:
+        print(path)
 
-    if parent_account is None:
-        raise Error('InvalidParentAccount',
-            'A valid account parent account must be supplied for this account',
-            {'field': 'parent_account_guid'})
+def parse_invoice_post_all(args):
 
-    account = Account(book)
-    parent_account.append_child(account)
-    account.SetName(name)
-    account.SetType(account_type_id)
-    account.SetCommodity(currency)
+    try:
+        session = start_write_session(args.connection_string)
 
-    return gnucash_simple.accountToDict(account)
+        account_guid = account_guid_from_name(session.book, args.posted_account)
 
-def add_transaction(book, num, description, date_posted, currency_mnumonic, splits):
+        if account_guid == '':
+            raise Error('NoAccount',
+                'No account exists with this name',
+                {'field': 'posted_account'})
 
-    transaction = Transaction(book)
+        options = {'date_opened_before': args.opened_before}
 
-    transaction.BeginEdit()
+        if args.customer is not None:
+            customer = session.book.CustomerLookupByID(args.customer)
 
-    commod_table = book.get_table()
-    currency = commod_table.lookup('CURRENCY', currency_mnumonic)
+            if customer is None:
+                raise Error('NoCustomer',
+                    'A customer with this ID does not exist',
+                    {'field': 'customer'})
 
-    if currency is None:
-        raise Error('InvalidTransactionCurrency',
-            'A valid currency must be supplied for this transaction',
-            {'field': 'currency'})
+            options['customer'] = customer.GetGUID().to_string()
 
-    try:
-        date_posted = datetime.datetime.strptime(date_posted, "%Y-%m-%d")
-    except ValueError:
-        raise Error('InvalidDatePosted',
-            'The date posted must be provided in the form YYYY-MM-DD',
-            {'field': 'date_posted'})
+        results = post_invoices(session.book, options, account_guid,
+            args.posted_date, args.due_date, args.posted_memo,
+            args.posted_accumulatesplits, args.posted_autopay)
 
-    if len(splits) is 0:
-        raise Error('NoSplits',
-            'At least one split must be provided',
-            {'field': 'splits'})
+        end_session()
+    except Error as error:
+        print(error.message)
+        sys.exit(2)
 
-    for split_values in splits:
-        account_guid = gnucash.gnucash_core.GUID() 
-        gnucash.gnucash_core.GUIDString(split_values['account_guid'], account_guid)
+    results = sorted(results, key=lambda k: k['id'])
 
-        account = account_guid.AccountLookup(book)
+    for result in results:
+        print('Invoice ' + result['id'] + ' ' + result['message'])
 
-        if account is None:
-            raise Error('InvalidSplitAccount',
-                'A valid account must be supplied for this split',
-                {'field': 'account'})
+    print(str(len([result for result in results if result['posted']])) + ' invoices posted')
 
-        if account.GetCommodity().get_mnemonic() != currency_mnumonic:
-            raise Error('InvalidSplitAccountCurrency',
-                'The transaction currency must match the account currency for this split',
-                {'field': 'account'})
+def parse_payments_match(args):
 
-        # TODO - the API should probably allow numerator and denomiator rather than assue 100 - it would also avoid the issue of rounding errrors with float/int conversion
-        value = split_values['value']
+    try:
+        lines = read_statement(args.csv)
 
-        try: 
-            value = float(value)
-            value = value * 100
-            value = round(value)
-        except ValueError:
-            raise Error('InvalidSplitValue',
-            'A valid value must be supplied for this split',
-            {'field': 'value'})
-        except TypeError:
-            raise Error('InvalidSplitValue',
-            'A valid value must be supplied for this split',
-            {'field': 'value'})
+        if args.dry_run:
+            session = start_read_session(args.connection_string, not args.no_replica)
+        else:
+            session = start_write_session(args.connection_string)
 
-        split = Split(book)
-        split.SetValue(GncNumeric(value, 100))
-        split.SetAccount(account)
-        split.SetParent(transaction)
+        account_guid = account_guid_from_name(session.book, args.transfer_account)
 
-    # TODO - check that splits match...
+        results = match_payments(session.book, lines, account_guid, not args.dry_run)
 
-    transaction.SetCurrency(currency)
-    transaction.SetDescription(description)
-    transaction.SetNum(num)
+        end_session(not args.dry_run)
+    except Error as error:
+        print(error.message)
+        sys.exit(2)
 
-    # This function changes at some point between Gnucash/Python 2/3
-    if sys.version_info >= (3,0):
-        transaction.SetDatePostedSecs(date_posted)
+    if args.format == 'json':
+        print(json.dumps(results))
     else:
-        transaction.SetDatePostedTS(date_posted)
+        for status in ['matched', 'ambiguous', 'unmatched']:
+            print(status.capitalize() + ': ' + str(len(results[status])))
 
-    transaction.CommitEdit()
+            for line in results[status]:
+                print('  line ' + str(line['line']) + ' ' + line['date'] + ' '
+                    + line['amount'] + ' ' + line['reference'] + ' - '
+                    + line.get('invoice', line['reason']))
 
-    return gnucash_simple.transactionToDict(transaction, ['splits'])
+def parse_reconcile(args):
 
-def get_transaction(book, transaction_guid):
+    if args.tolerance_days < 0:
+        print('The tolerance must be zero or more days')
+        sys.exit(2)
 
-    guid = gnucash.gnucash_core.GUID() 
-    gnucash.gnucash_core.GUIDString(transaction_guid, guid)
+    try:
+        lines = read_statement(args.statement)
 
-    transaction = guid.TransLookup(book)
+        if args.dry_run:
+            session = start_read_session(args.connection_string, not args.no_replica)
+        else:
+            session = start_write_session(args.connection_string)
 
-    if transaction is None:
-        return None
-    else:
-        return gnucash_simple.transactionToDict(transaction, ['splits'])
+        account_guid = account_guid_from_name(session.book, args.account)
 
-def edit_transaction(book, transaction_guid, num, description, date_posted,
-    currency_mnumonic, splits):
+        results = reconcile_account(session.book, account_guid, lines,
+            args.tolerance_days, RECONCILE_STATES[args.mark], not args.dry_run)
 
-    guid = gnucash.gnucash_core.GUID() 
-    gnucash.gnucash_core.GUIDString(transaction_guid, guid)
+        end_session(not args.dry_run)
+    except Error as error:
+        print(error.message)
+        sys.exit(2)
 
-    transaction = guid.TransLookup(book)
+    if args.format == 'json':
+        print(json.dumps(results))
+    else:
+        print('Matched: ' + str(len(results['matched'])))
 
-    if transaction is None:
-        raise Error('InvalidTransactionGuid',
-            'A transaction with this GUID does not exist',
-            {'field': 'guid'})
+        for line in results['matched']:
+            print('  line ' + str(line['line']) + ' ' + line['date'] + ' '
+                + line['amount'] + ' ' + line['reference'] + ' - '
+                + line['description'])
 
-    transaction.BeginEdit()
+        print('Unmatched statement lines: ' + str(len(results['unmatched_lines'])))
 
-    commod_table = book.get_table()
-    currency = commod_table.lookup('CURRENCY', currency_mnumonic)
+        for line in results['unmatched_lines']:
+            print('  line ' + str(line['line']) + ' ' + line['date'] + ' '
+                + line['amount'] + ' ' + line['reference']
+                + (' - ' + line['reason'] if 'reason' in line else ''))
 
-    if currency is None:
-        raise Error('InvalidTransactionCurrency',
-            'A valid currency must be supplied for this transaction',
-            {'field': 'currency'})
+        print('Unmatched splits: ' + str(len(results['unmatched_splits'])))
+
+        for split in results['unmatched_splits']:
+            print('  ' + split['date'] + ' ' + split['amount'] + ' '
+                + split['description'] + ' (' + split['guid'] + ')')
+
+def parse_recurring_run(args):
 
     try:
-        date_posted = datetime.datetime.strptime(date_posted, "%Y-%m-%d")
+        as_of = datetime.datetime.strptime(args.as_of, "%Y-%m-%d")
     except ValueError:
-        raise Error('InvalidDatePosted',
-            'The date posted must be provided in the form YYYY-MM-DD',
-            {'field': 'date_posted'})
+        print('The as of date must be provided in the form YYYY-MM-DD')
+        sys.exit(2)
 
-    if len(splits) is 0:
-        raise Error('NoSplits',
-            'At least one split must be provided',
-            {'field': 'splits'})
+    try:
+        schedules = read_schedules(args.schedule)
 
-    split_guids = []
+        if args.dry_run:
+            session = start_read_session(args.connection_string, not args.no_replica)
+        else:
+            session = start_write_session(args.connection_string)
 
-    # Should we do all checks before calling split_guid.SplitLookup(book) as it's not clear when these will be comitted?
-    for split_values in splits:
+        results = run_recurring(session.book, schedules, as_of, not args.dry_run)
 
-        split_guids.append(split_values['guid']);
+        end_session(not args.dry_run)
+    except Error as error:
+        print(error.message)
+        sys.exit(2)
 
-        split_guid = gnucash.gnucash_core.GUID() 
-        gnucash.gnucash_core.GUIDString(split_values['guid'], split_guid)
+    if args.format == 'json':
+        print(json.dumps(results))
+    else:
+        for result in results:
+            if result['status'] == 'exists':
+                continue
 
-        split = split_guid.SplitLookup(book)
+            status = result['status']
 
-        if split is None:
-            raise Error('InvalidSplitGuid',
-                'A valid guid must be supplied for this split',
-                {'field': 'guid'})
+            if result.get('posted'):
+                status += ', posted'
 
-        account_guid = gnucash.gnucash_core.GUID() 
-        gnucash.gnucash_core.GUIDString(
-            split_values['account_guid'], account_guid)
+            print(result['schedule'] + ' ' + (result['period'] or '') + ' ' + status
+                + ' ' + result.get('id', result.get('reason', '')))
 
-        account = account_guid.AccountLookup(book)
+        print(str(len([result for result in results if result['status'] == 'created']))
+            + ' invoices created, '
+            + str(len([result for result in results if result['status'] == 'exists']))
+            + ' already generated')
 
-        if account is None:
-            raise Error('InvalidSplitAccount',
-                'A valid account must be supplied for this split',
-                {'field': 'account'})
+def parse_add_account(args):
+    
+    try:
+        session = start_write_session(args.connection_string)
+        account = add_account(session.book, args.name, args.currency, args.account_type_id, args.parent_account_guid)
+        end_session()
+    except Error as error:
+        print(error.message)
+        sys.exit(2)
 
-        if account.GetCommodity().get_mnemonic() != currency_mnumonic:
-            raise Error('InvalidSplitAccountCurrency',
-                'The transaction currency must match the account currency for this split',
-                {'field': 'account'})
+    print('Account created')
 
-        # TODO - the API should probably allow numerator and denomiator rather than assue 100
-        value = split_values['value']
+def parse_account_list(args):
 
-        try: 
-            value = float(value)
-            value = value * 100
-            value = int(value)
-        except ValueError:
-            raise Error('InvalidSplitValue',
-            'A valid value must be supplied for this split',
-            {'field': 'value'})
-        except TypeError:
-            raise Error('InvalidSplitValue',
-            'A valid value must be supplied for this split',
-            {'field': 'value'})
+    if args.snapshot is not None:
+        parse_snapshot_account_list(args)
+        return
 
-        split.SetValue(GncNumeric(value, 100))
-        split.SetAccount(account)
-        split.SetParent(transaction)
+    try:
+        session = start_read_session(args.connection_string, not args.no_replica)
+        accounts = get_accounts(session.book)
+        end_session(False)
+    except Error as error:
+        print(error.message)
+        sys.exit(2)
 
-    if len(split_guids) != len(set(split_guids)):
-        raise Error('DuplicateSplitGuid',
-            'One of the splits provided shares a GUID with another split',
-            {'field': 'guid'})
+    for account in flatten_accounts(accounts):
+        print(account['name'])
 
-    transaction.SetCurrency(currency)
-    transaction.SetDescription(description)
-    transaction.SetNum(num)
+def parse_snapshot_account_list(args):
 
-    # This function changes at some point between Guncash/Python 2/3
-    if sys.version_info >= (3,0):
-        transaction.SetDatePostedSecs(date_posted)
-    else:
-        transaction.SetDatePostedTS(date_posted)
+    try:
+        snapshot = Snapshot(args.snapshot)
+        accounts = snapshot.get_account_records()
+        snapshot.close()
+    except Error as error:
+        print(error.message)
+        sys.exit(2)
 
-    transaction.CommitEdit()
+    # Snapshots don't hold the root account
+    for account, depth in walk_accounts(accounts):
+        print(account.name)
 
-    return gnucash_simple.transactionToDict(transaction, ['splits'])
+def parse_account_splits(args):
 
-def start_session(connection_string, is_new, ignore_lock):
+    try:
+        records = open_records(args)
 
-    global session
+        account_guid = None
 
-    # If no parameters are supplied attempt to use the app.connection_string if one exists
-    if connection_string == '' and is_new == '' and  ignore_lock == '' and hasattr(app, 'connection_string') and app.connection_string != '':
-        is_new = False
-        ignore_lock = False
-        connection_string = app.connection_string
+        if args.account is not None:
+            account_guid = records.account_guid_from_name(args.account)
 
-    if connection_string == '':
-        raise Error('InvalidConnectionString', 'A connection string must be supplied',
-            {'field': 'connection_string'})
+            if account_guid == '':
+                raise Error('NoAccount', 'No account exists with this name',
+                    {'field': 'account'})
 
-    if str(is_new).lower() in ['true', '1', 't', 'y', 'yes']:
-        is_new = True
-    elif str(is_new).lower() in ['false', '0', 'f', 'n', 'no']:
-        is_new = False
-    else:
-        raise Error('InvalidIsNew', 'is_new must be true or false',
-            {'field': 'is_new'})
+        splits = records.get_split_records(account_guid, args.date_from,
+            args.date_to)
 
-    if str(ignore_lock).lower() in ['true', '1', 't', 'y', 'yes']:
-        ignore_lock = True
-    elif str(ignore_lock).lower() in ['false', '0', 'f', 'n', 'no']:
-        ignore_lock = False
-    else:
-        raise Error('InvalidIgnoreLock', 'ignore_lock must be true or false',
-            {'field': 'ignore_lock'})
+        prices = None
 
-    if session is not None:
-        raise Error('SessionExists',
-            'The session already exists',
-            {})
+        if args.report_currency is not None:
+            prices, scu = records.report_currency(args.report_currency)
 
-    try:
-        session = gnucash.Session(connection_string, is_new=is_new, ignore_lock=ignore_lock)
-    except gnucash.GnuCashBackendException as e:
-        raise Error('GnuCashBackendException',
-            'There was an error starting the session',
-            {
-                'message': e.args[0],
-                'code': parse_gnucash_backend_exception(e.args[0])
-            })
+        records.close()
+    except Error as error:
+        print(error.message)
+        sys.exit(2)
+
+    splits.sort(key=lambda split: (split.date, split.transaction_guid))
+
+    write_split_records(splits, args.format, prices, args.report_currency)
+
+    write_price_stats(None if prices is None else prices.stats())
+
+def split_record_dict(split, prices, currency):
+
+    row = split.to_dict()
 
-    return session
+    # Values are restated at the split's date, blank when there's no price
+    if prices is not None:
+        price = prices.lookup(split.currency, currency, split.date)
 
-def end_session():
+        row['report_currency'] = currency
 
-    global session
+        if price is None:
+            row['report_value'] = None
+        else:
+            row['report_value'] = str((Decimal(split.value_num) * price
+                / Decimal(split.value_denom)).quantize(Decimal('.01'), ROUND_HALF_UP))
 
-    if session == None:
-        raise Error('SessionDoesNotExist',
-            'The session does not exist',
-            {})
+    return row
 
-    try:
-        session.save()
-    except gnucash.GnuCashBackendException as e:
-        raise Error('GnuCashBackendException',
-            'There was an error saving the session',
-            {
-                'message': e.args[0],
-                'code': parse_gnucash_backend_exception(e.args[0])
-            })
+def write_split_records(splits, format, prices=None, currency=None):
 
-    session.end()
-    session.destroy()
+    # Records are only turned into dicts here, one at a time, as they're output
+    if format == 'json':
+        sys.stdout.write('[')
 
-    session = None
+        for i, split in enumerate(splits):
+            if i > 0:
+                sys.stdout.write(',')
 
-def get_session():
+            sys.stdout.write(json.dumps(split_record_dict(split, prices, currency)))
 
-    global session
+        sys.stdout.write(']\n')
+    elif format == 'csv':
+        writer = None
 
-    if session == None:
-        raise Error('SessionDoesNotExist',
-            'The session does not exist',
-            {})
+        for split in splits:
+            row = split_record_dict(split, prices, currency)
 
-    return session
+            if writer is None:
+                writer = csv.DictWriter(sys.stdout, fieldnames=list(row.keys()))
+                writer.writeheader()
 
-def parse_gnucash_backend_exception(exception_string):
-    # Argument is of the form "call to %s resulted in the following errors, %s" - extract the second string
-    reresult = re.match(r'^call to (.*?) resulted in the following errors, (.*?)$', exception_string)
-    if len(reresult.groups()) == 2:
-        return reresult.group(2)
+            writer.writerow(row)
     else:
-        return ''
+        for split in splits:
+            fields = [split.date or '', split.description,
+                str(Decimal(split.value_num) / Decimal(split.value_denom)),
+                split.currency]
 
-def sint(s):
-    try:
-        return int(s)
-    except ValueError:
-        return None
+            if prices is not None:
+                row = split_record_dict(split, prices, currency)
+                fields += [row['report_value'] or '?', currency]
 
-def gnc_numeric_from_decimal(decimal_value):
-    sign, digits, exponent = decimal_value.as_tuple()
+            print(' '.join(fields))
 
-    # convert decimal digits to a fractional numerator
-    # equivlent to
-    # numerator = int(''.join(digits))
-    # but without the wated conversion to string and back,
-    # this is probably the same algorithm int() uses
-    numerator = 0
-    TEN = int(Decimal(0).radix()) # this is always 10
-    numerator_place_value = 1
-    # add each digit to the final value multiplied by the place value
-    # from least significant to most sigificant
-    for i in range(len(digits)-1,-1,-1):
-        numerator += digits[i] * numerator_place_value
-        numerator_place_value *= TEN
+def parse_report_date(value, field):
 
-    if decimal_value.is_signed():
-        numerator = -numerator
+    try:
+        return datetime.datetime.strptime(value, "%Y-%m-%d").strftime("%Y-%m-%d")
+    except (ValueError, TypeError):
+        raise Error('InvalidDate',
+            'The date must be provided in the form YYYY-MM-DD',
+            {'field': field})
 
-    # if the exponent is negative, we use it to set the denominator
-    if exponent < 0 :
-        denominator = TEN ** (-exponent)
-    # if the exponent isn't negative, we bump up the numerator
-    # and set the denominator to 1
-    else:
-        numerator *= TEN ** exponent
-        denominator = 1
+def parse_report_trial_balance(args):
 
-    return GncNumeric(numerator, denominator)
+    try:
+        as_of = parse_report_date(args.as_of, 'as_of')
 
-class Error(Exception):
-    """Base class for exceptions in this module."""
-    def __init__(self, type, message, data):
-        self.type = type
-        self.message = message
-        self.data = data
+        if args.workers > 1:
+            accounts, balances, stats = sharded_report_balances(args,
+                'trial-balance', None, as_of)
+        else:
+            records = open_records(args)
 
-def flatten_accounts(account):
+            try:
+                accounts = records.get_account_records()
+                splits = records.iter_split_records(None, None, as_of)
+                prices = None
 
-    accounts = [];
-    
-    accounts.append(account)
+                # Balances are restated at the as of date
+                if args.report_currency is not None:
+                    prices, scu = records.report_currency(args.report_currency)
+                    accounts, splits = convert_report_records(accounts, splits, prices,
+                        args.report_currency, scu, lambda split: as_of)
 
-    for subaccount in account['subaccounts']:
-        accounts = accounts + flatten_accounts(subaccount)
+                balances = accumulate_balances(accounts, splits,
+                    trial_balance_period(as_of), 1)
+            finally:
+                records.close()
 
-    # we don't actually remove the subaccounts
+            stats = None if prices is None else prices.stats()
 
-    return accounts
+        write_report(['debit', 'credit'], trial_balance_rows(accounts, balances),
+            args.format)
 
+        write_price_stats(stats)
+    except Error as error:
+        print(error.message)
+        sys.exit(2)
 
-def parse_book_new(args):
+def parse_report_pnl(args):
 
     try:
-        start_session(args.connection_string, True, False)
-        end_session()
+        date_from = parse_report_date(args.date_from, 'from')
+        date_to = parse_report_date(args.date_to, 'to')
+
+        labels, period_of = report_periods(date_from, date_to, args.by)
+
+        if args.workers > 1:
+            accounts, balances, stats = sharded_report_balances(args, 'pnl',
+                date_from, date_to, [date_from, date_to, args.by])
+        else:
+            records = open_records(args)
+
+            try:
+                accounts = pnl_accounts(records.get_account_records())
+                splits = records.iter_split_records(None, date_from, date_to)
+                prices = None
+
+                # Income and expenses are restated at the date of each split
+                if args.report_currency is not None:
+                    prices, scu = records.report_currency(args.report_currency)
+                    accounts, splits = convert_report_records(accounts, splits, prices,
+                        args.report_currency, scu, lambda split: split.date)
+
+                balances = accumulate_balances(accounts, splits, period_of, len(labels))
+            finally:
+                records.close()
+
+            stats = None if prices is None else prices.stats()
+
+        write_report(labels, pnl_rows(accounts, balances, labels), args.format)
+
+        write_price_stats(stats)
     except Error as error:
         print(error.message)
         sys.exit(2)
 
-    print('New book created')
-
-
-def parse_customer_list(args):
+def parse_account_balance(args):
 
     try:
-        session = start_session(args.connection_string, False, True)
-        customers = get_customers(session.book)
-        end_session()
+        as_of = parse_report_date(args.as_of, 'as_of')
+
+        balance = get_account_balance(args.connection_string, args.account,
+            as_of, not args.no_replica)
     except Error as error:
         print(error.message)
         sys.exit(2)
 
-    customers = sorted(customers, key=lambda k: k['id']) 
-
     if args.format == 'json':
-        print(json.dumps(customers))
+        print(json.dumps(balance))
     else:
-        for customer in customers:
-            print(customer['id'] + " " + customer['name'])
+        print(balance['account'] + ' ' + balance['balance'] + ' ' + balance['commodity'])
+
+def parse_statements(args):
 
-def parse_customer_add(args):
-    
     try:
-        session = start_session(args.connection_string, False, True)
-        customer = add_customer(session.book, args.id, args.currency, args.name, args.contact,
-        args.address_line_1, args.address_line_2, args.address_line_3, args.address_line_4,
-        args.phone, args.fax, args.email)
-        end_session()
+        as_of = parse_report_date(args.as_of, 'as_of')
+
+        paths = generate_statements(args.connection_string, as_of, args.out, args.format,
+            args.template, args.workers, not args.no_replica)
     except Error as error:
         print(error.message)
         sys.exit(2)
 
-    print('Customer ' + customer['id'] + ' created')
-
-def parse_invoice_list(args):
+    for path in paths:
+        print(path)
 
-    try:
-        session = start_session(args.connection_string, False, True)
-        
-        options = {}
+def parse_completion_script(args):
 
-        if args.posted == '1':
-            options['is_posted'] = 1
-        elif args.posted == '0':
-            options['is_posted'] = 0
+    sys.stdout.write(completion_script(args.parser, args.shell))
 
-        if args.paid == '1':
-            options['is_paid'] = 1
-        elif args.paid == '0':
-            options['is_paid'] = 0
+def parse_completion_refresh(args):
 
-        if args.active == '1':
-            options['is_active'] = 1
-        elif args.active == '0':
-            options['is_active'] = 0
+    try:
+        refresh_completion_cache(args.connection_string, not args.no_replica)
+    except Error as error:
+        print(error.message)
+        sys.exit(2)
 
-        invoices = get_invoices(session.book, options)
+def parse_snapshot_create(args):
 
-        end_session()
+    try:
+        counts = create_snapshot(args.connection_string, args.out, not args.no_replica)
     except Error as error:
         print(error.message)
         sys.exit(2)
 
-    invoices = sorted(invoices, key=lambda k: k['id'])  
+    for kind in sorted(counts):
+        print(kind + ' ' + str(counts[kind]))
 
-    if args.format == 'json':
-        print(json.dumps(invoices))
-    else:
-        for invoice in invoices:
-            print(invoice['id'])
+def parse_diff(args):
 
-def parse_invoice_add(args):
-    
     try:
-        session = start_session(args.connection_string, False, True)
-        invoice = add_invoice(session.book, args.id, args.customer_id, args.currency,
-                args.date_opened, args.notes)
-        end_session()
+        results = diff_books(args.book_a, args.book_b, not args.no_replica)
     except Error as error:
         print(error.message)
         sys.exit(2)
 
-    print('Invoice ' + invoice['id'] + ' created')
+    if args.format == 'json':
+        print(json.dumps(results))
+        return
 
-def parse_invoice_post(args):
-    
-    try:
-        session = start_session(args.connection_string, False, True)
+    for sign, status in [('+', 'added'), ('-', 'removed'), ('~', 'changed')]:
+        for entity in results[status]:
+            print(sign + ' ' + entity['kind'] + ' ' + entity['label'] + ' ('
+                + entity['key'] + ')')
 
-        account_guid = account_guid_from_name(session.book, args.posted_account)
+            for field in entity.get('fields', []):
+                print('    ' + field['field'] + ': ' + json.dumps(field['a']) + ' -> '
+                    + json.dumps(field['b']))
 
-        invoice = get_invoice(session.book, args.id)
-        if invoice is None:
-            raise Error('NoInvoice',
-            'An invoice with this ID does not exist',
-            {'field': 'id'})
-            
-        invoice = update_invoice(session.book, invoice['id'], invoice['owner']['id'], invoice['currency'],
-                invoice['date_opened'], invoice['notes'], True, account_guid, args.posted_date,
-                args.due_date, args.posted_memo, args.posted_accumulatesplits, args.posted_autopay)
+def parse_watch(args):
 
-        end_session()
-    except Error as error:
-        print(error.message)
+    if args.debounce_ms < 0 or args.poll_interval <= 0:
+        print('The debounce must be zero or more and the poll interval more than zero')
         sys.exit(2)
 
-    print('Invoice ' + invoice['id'] + ' posted')
-
-def parse_add_account(args):
-    
     try:
-        session = start_session(args.connection_string, False, True)
-        account = add_account(session.book, args.name, args.currency, args.account_type_id, args.parent_account_guid)
-        end_session()
+        watch_book(args.connection_string, args.on_change, args.debounce_ms / 1000.0,
+            args.poll_interval, not args.no_replica)
     except Error as error:
         print(error.message)
         sys.exit(2)
+    except KeyboardInterrupt:
+        pass
 
-    print('Account created')
+def parse_bench_records(args):
+
+    results = []
 
-def parse_account_list(args):
-    
     try:
-        session = start_session(args.connection_string, False, True)
-        accounts = get_accounts(session.book)
-        end_session()
+        for variant in ['dicts', 'records']:
+            # A fresh process per variant keeps their peak RSS apart
+            with concurrent.futures.ProcessPoolExecutor(max_workers=1) as executor:
+                results.append(executor.submit(benchmark_results,
+                    args.connection_string, args.kind, variant).result())
     except Error as error:
         print(error.message)
         sys.exit(2)
 
-    for account in flatten_accounts(accounts):
-        print(account['name'])
+    for result in results:
+        print('%-8s %8d rows %8.2f s  python peak %8.1f MB  rss growth %8.1f MB  peak rss %8.1f MB' % (
+            result['variant'], result['rows'], result['seconds'],
+            result['python_peak_mb'], result['rss_growth_mb'],
+            result['peak_rss_mb']))
+
+    if results[0]['python_peak_mb'] > 0:
+        print('Python peak reduced by %.0f%%' % (100 - 100
+            * results[1]['python_peak_mb'] / results[0]['python_peak_mb']))
+
+    if results[0]['rss_growth_mb'] > 0:
+        print('RSS growth reduced by %.0f%%' % (100 - 100
+            * results[1]['rss_growth_mb'] / results[0]['rss_growth_mb']))
 
 def account_guid_from_name(book, account_name):
     account_guid = ''
@@ -1768,7 +8540,7 @@ def account_guid_from_name(book, account_name):
 def parse_entry_add(args):
 
     try:
-        session = start_session(args.connection_string, False, True)
+        session = start_write_session(args.connection_string)
         
         account_guid = account_guid_from_name(session.book, args.account)
 
@@ -1780,10 +8552,38 @@ def parse_entry_add(args):
 
     print('Entry created')
 
+def parse_entry_import(args):
+
+    try:
+        lines = read_entry_rows(args.csv)
+
+        started = time.time()
+
+        session = start_write_session(args.connection_string)
+
+        results = import_entries(session.book, lines)
+
+        end_session()
+
+        elapsed = time.time() - started
+    except Error as error:
+        print(error.message)
+        sys.exit(2)
+
+    if args.format == 'json':
+        print(json.dumps(results))
+    else:
+        for result in results:
+            print('line ' + str(result['line']) + ' ' + result['invoice_id'] + ' '
+                + result['status'] + ' ' + result.get('guid', result.get('reason', '')))
+
+    sys.stderr.write('Imported %d rows in %.2fs (%.1f rows/sec)\n' % (len(results),
+        elapsed, len(results) / elapsed if elapsed > 0 else 0))
+
 def parse_guestpost_add(args):
     
     try:
-        session = start_session(args.connection_string, False, True)
+        session = start_write_session(args.connection_string)
 
         if args.currency == 'GBP':
             account_guid = account_guid_from_name(session.book, 'Sales')
@@ -1821,8 +8621,6 @@ def parse_guestpost_add(args):
 
 if __name__ == "__main__":
 
-    import os
-    import argparse
     import json
 
     parser = argparse.ArgumentParser()
@@ -1835,6 +8633,12 @@ if __name__ == "__main__":
         # Left this first as was originally causing issues when later
         parser.add_argument("connection_string", type=str, help="the file or database to connect to")
 
+    parser.add_argument("--no-replica", action="store_true",
+        help="read from the live book rather than the SQLite read replica")
+    parser.add_argument("--snapshot", type=str,
+        help="run list commands, account splits and reports against a snapshot file "
+        "instead of the book, JSON output then holds only the fields a snapshot keeps")
+
     command_parser = parser.add_subparsers(help='command help')
 
     ####
@@ -1853,6 +8657,23 @@ if __name__ == "__main__":
     account_list_parser = account_subparsers.add_parser('list')
     account_list_parser.set_defaults(func=parse_account_list)
 
+    account_splits_parser = account_subparsers.add_parser('splits')
+    account_splits_parser.add_argument("--account", type=str,
+        help="the account name, all accounts if omitted")
+    account_splits_parser.add_argument("--from", dest="date_from", type=str)
+    account_splits_parser.add_argument("--to", dest="date_to", type=str)
+    account_splits_parser.add_argument("--format", type=str,
+        help="json, csv or text")
+    account_splits_parser.add_argument("--report-currency", type=str,
+        help="add each split's value in this currency using the price database")
+    account_splits_parser.set_defaults(func=parse_account_splits)
+
+    account_balance_parser = account_subparsers.add_parser('balance')
+    account_balance_parser.add_argument("--account", type=str, required=True)
+    account_balance_parser.add_argument("--as-of", type=str, required=True)
+    account_balance_parser.add_argument("--format", type=str)
+    account_balance_parser.set_defaults(func=parse_account_balance)
+
     ####
 
     invoice_parser = command_parser.add_parser('invoice')
@@ -1865,6 +8686,19 @@ if __name__ == "__main__":
     invoice_list_parser.add_argument("--paid", type=str)
     invoice_list_parser.set_defaults(func=parse_invoice_list)
 
+    invoice_stats_parser = invoice_subparsers.add_parser('stats')
+    invoice_stats_parser.add_argument("--group-by", type=str, default='owner',
+        help="comma separated groups from " + ', '.join(STATS_GROUPS))
+    invoice_stats_parser.add_argument("--metrics", type=str, default='count,total',
+        help="comma separated metrics from " + ', '.join(STATS_METRICS))
+    invoice_stats_parser.add_argument("--active", type=str)
+    invoice_stats_parser.add_argument("--posted", type=str)
+    invoice_stats_parser.add_argument("--paid", type=str)
+    invoice_stats_parser.add_argument("--posted-from", type=str)
+    invoice_stats_parser.add_argument("--posted-to", type=str)
+    invoice_stats_parser.add_argument("--format", type=str)
+    invoice_stats_parser.set_defaults(func=parse_invoice_stats, kind='invoice')
+
     invoice_new_parser = invoice_subparsers.add_parser('new')
     invoice_new_parser.add_argument("--id", type=str)
     invoice_new_parser.add_argument("--customer_id", type=str)
@@ -1881,8 +8715,93 @@ if __name__ == "__main__":
     invoice_post_parser.add_argument("--posted_memo", type=str)
     invoice_post_parser.add_argument("--posted_accumulatesplits", type=bool)
     invoice_post_parser.add_argument("--posted_autopay", type=bool)
+    invoice_post_parser.add_argument("--all-unposted", action="store_true",
+        help="post every unposted invoice instead of --id")
+    invoice_post_parser.add_argument("--opened-before", type=str,
+        help="with --all-unposted only post invoices opened before this date")
+    invoice_post_parser.add_argument("--customer", type=str,
+        help="with --all-unposted only post invoices for this customer ID")
     invoice_post_parser.set_defaults(func=parse_invoice_post)
 
+    invoice_render_parser = invoice_subparsers.add_parser('render')
+    invoice_render_parser.add_argument("--ids", type=str, nargs='+',
+        help="the IDs of the invoices to render")
+    invoice_render_parser.add_argument("--all-posted-since", type=str,
+        help="render every invoice posted on or after this date instead of --ids")
+    invoice_render_parser.add_argument("--out", type=str, required=True,
+        help="the directory to write a file per invoice into")
+    invoice_render_parser.add_argument("--format", type=str, default='html',
+        choices=['text', 'html', 'pdf'])
+    invoice_render_parser.add_argument("--template", type=str,
+        help="a template file to use instead of the built in one")
+    invoice_render_parser.add_argument("--workers", type=int, default=os.cpu_count(),
+        help="the number of processes rendering invoices")
+    invoice_render_parser.set_defaults(func=parse_invoice_render)
+
+    ####
+
+    bill_parser = command_parser.add_parser('bill')
+    bill_subparsers = bill_parser.add_subparsers()
+
+    bill_stats_parser = bill_subparsers.add_parser('stats')
+    bill_stats_parser.add_argument("--group-by", type=str, default='owner',
+        help="comma separated groups from " + ', '.join(STATS_GROUPS))
+    bill_stats_parser.add_argument("--metrics", type=str, default='count,total',
+        help="comma separated metrics from " + ', '.join(STATS_METRICS))
+    bill_stats_parser.add_argument("--active", type=str)
+    bill_stats_parser.add_argument("--posted", type=str)
+    bill_stats_parser.add_argument("--paid", type=str)
+    bill_stats_parser.add_argument("--posted-from", type=str)
+    bill_stats_parser.add_argument("--posted-to", type=str)
+    bill_stats_parser.add_argument("--format", type=str)
+    bill_stats_parser.set_defaults(func=parse_invoice_stats, kind='bill')
+
+    bill_new_parser = bill_subparsers.add_parser('new')
+    bill_new_parser.add_argument("--id", type=str)
+    bill_new_parser.add_argument("--vendor_id", type=str)
+    bill_new_parser.add_argument("--currency", type=str)
+    bill_new_parser.add_argument("--date_opened", type=str)
+    bill_new_parser.add_argument("--notes", type=str)
+    bill_new_parser.set_defaults(func=parse_bill_add)
+
+    bill_entry_parser = bill_subparsers.add_parser('entry')
+    bill_entry_subparsers = bill_entry_parser.add_subparsers()
+
+    bill_entry_new_parser = bill_entry_subparsers.add_parser('new')
+    bill_entry_new_parser.add_argument("--bill_id", type=str)
+    bill_entry_new_parser.add_argument("--date", type=str)
+    bill_entry_new_parser.add_argument("--description", type=str)
+    bill_entry_new_parser.add_argument("--account", type=str)
+    bill_entry_new_parser.add_argument("--quantity", type=str)
+    bill_entry_new_parser.add_argument("--price", type=str)
+    bill_entry_new_parser.set_defaults(func=parse_bill_entry_add)
+
+    bill_post_parser = bill_subparsers.add_parser('post')
+    bill_post_parser.add_argument("--id", type=str)
+    bill_post_parser.add_argument("--posted_account", type=str)
+    bill_post_parser.add_argument("--posted_date", type=str)
+    bill_post_parser.add_argument("--due_date", type=str)
+    bill_post_parser.add_argument("--posted_memo", type=str)
+    bill_post_parser.add_argument("--posted_accumulatesplits", type=bool)
+    bill_post_parser.add_argument("--posted_autopay", type=bool)
+    bill_post_parser.set_defaults(func=parse_bill_post)
+
+    bill_pay_parser = bill_subparsers.add_parser('pay')
+    bill_pay_parser.add_argument("--id", type=str)
+    bill_pay_parser.add_argument("--transfer_account", type=str)
+    bill_pay_parser.add_argument("--payment_date", type=str)
+    bill_pay_parser.add_argument("--memo", type=str, default='')
+    bill_pay_parser.add_argument("--num", type=str, default='')
+    bill_pay_parser.set_defaults(func=parse_bill_pay)
+
+    bill_import_parser = bill_subparsers.add_parser('import')
+    bill_import_parser.add_argument("--csv", type=str, required=True,
+        help="a row per entry with bill_id, vendor_id, date_opened, date, description, "
+        "account, quantity and price, plus optional currency, notes, posted_account, "
+        "posted_date and due_date")
+    bill_import_parser.add_argument("--format", type=str)
+    bill_import_parser.set_defaults(func=parse_bill_import)
+
     ####
 
     entry_parser = command_parser.add_parser('entry')
@@ -1899,6 +8818,81 @@ if __name__ == "__main__":
     entry_new_parser.add_argument("--discount", type=str)
     entry_new_parser.set_defaults(func=parse_entry_add)
 
+    entry_import_parser = entry_subparsers.add_parser('import')
+    entry_import_parser.add_argument("--csv", type=str, required=True,
+        help="rows of invoice_id, date, description, account, quantity, price "
+        "and an optional value discount")
+    entry_import_parser.add_argument("--format", type=str)
+    entry_import_parser.set_defaults(func=parse_entry_import)
+
+    ####
+
+    transaction_parser = command_parser.add_parser('transaction')
+    transaction_subparsers = transaction_parser.add_subparsers()
+
+    transaction_search_parser = transaction_subparsers.add_parser('search')
+    transaction_search_parser.add_argument("query", type=str)
+    transaction_search_parser.add_argument("--limit", type=int, default=20)
+    transaction_search_parser.add_argument("--format", type=str)
+    transaction_search_parser.set_defaults(func=parse_transaction_search)
+
+    transaction_import_parser = transaction_subparsers.add_parser('import')
+    transaction_import_parser.add_argument("--csv", type=str, required=True,
+        help="rows of date, num, description, currency, amount, account, "
+        "transfer_account and an optional external_id")
+    transaction_import_parser.add_argument("--skip-duplicates", action="store_true",
+        help="skip rows matching an existing transaction rather than only reporting them")
+    transaction_import_parser.add_argument("--format", type=str)
+    transaction_import_parser.set_defaults(func=parse_transaction_import)
+
+    transaction_duplicates_parser = transaction_subparsers.add_parser('duplicates')
+    transaction_duplicates_parser.add_argument("--format", type=str)
+    transaction_duplicates_parser.set_defaults(func=parse_transaction_duplicates)
+
+    ####
+
+    payments_parser = command_parser.add_parser('payments')
+    payments_subparsers = payments_parser.add_subparsers()
+
+    payments_match_parser = payments_subparsers.add_parser('match')
+    payments_match_parser.add_argument("--csv", type=str, required=True,
+        help="a statement with date, amount and reference columns")
+    payments_match_parser.add_argument("--transfer-account", type=str, required=True)
+    payments_match_parser.add_argument("--dry-run", action="store_true",
+        help="report matches without applying any payments")
+    payments_match_parser.add_argument("--format", type=str)
+    payments_match_parser.set_defaults(func=parse_payments_match)
+
+    ####
+
+    reconcile_parser = command_parser.add_parser('reconcile')
+    reconcile_parser.add_argument("--account", type=str, required=True)
+    reconcile_parser.add_argument("--statement", type=str, required=True,
+        help="a bank statement with date, amount and reference columns")
+    reconcile_parser.add_argument("--tolerance-days", type=int, default=3,
+        help="how many days a statement line and a split's date may differ")
+    reconcile_parser.add_argument("--mark", type=str, default='cleared',
+        choices=sorted(RECONCILE_STATES), help="the state to mark matched splits")
+    reconcile_parser.add_argument("--dry-run", action="store_true",
+        help="report matches without marking any splits")
+    reconcile_parser.add_argument("--format", type=str)
+    reconcile_parser.set_defaults(func=parse_reconcile)
+
+    ####
+
+    recurring_parser = command_parser.add_parser('recurring')
+    recurring_subparsers = recurring_parser.add_subparsers()
+
+    recurring_run_parser = recurring_subparsers.add_parser('run')
+    recurring_run_parser.add_argument("--schedule", type=str, required=True,
+        help="a YAML (or JSON) file of recurring invoice schedules")
+    recurring_run_parser.add_argument("--as-of", type=str, required=True,
+        help="generate every invoice due up to this date")
+    recurring_run_parser.add_argument("--dry-run", action="store_true",
+        help="list the invoices that are due without creating them")
+    recurring_run_parser.add_argument("--format", type=str)
+    recurring_run_parser.set_defaults(func=parse_recurring_run)
+
     ####
 
     customer_parser = command_parser.add_parser('customer')
@@ -1922,6 +8916,23 @@ if __name__ == "__main__":
     customer_list_parser.add_argument("--format", type=str)
     customer_list_parser.set_defaults(func=parse_customer_list)
 
+    customer_search_parser = customer_subparsers.add_parser('search')
+    customer_search_parser.add_argument("query", type=str)
+    customer_search_parser.add_argument("--limit", type=int, default=10)
+    customer_search_parser.add_argument("--format", type=str)
+    customer_search_parser.set_defaults(func=parse_name_search, kind='customer')
+
+    ####
+
+    vendor_parser = command_parser.add_parser('vendor')
+    vendor_subparsers = vendor_parser.add_subparsers()
+
+    vendor_search_parser = vendor_subparsers.add_parser('search')
+    vendor_search_parser.add_argument("query", type=str)
+    vendor_search_parser.add_argument("--limit", type=int, default=10)
+    vendor_search_parser.add_argument("--format", type=str)
+    vendor_search_parser.set_defaults(func=parse_name_search, kind='vendor')
+
     ####
 
     book_parser = command_parser.add_parser('book')
@@ -1930,6 +8941,115 @@ if __name__ == "__main__":
     book_new_parser = book_subparsers.add_parser('new')
     book_new_parser.set_defaults(func=parse_book_new)
 
+    book_replicate_parser = book_subparsers.add_parser('replicate')
+    book_replicate_parser.add_argument("--interval", type=float,
+        help="keep refreshing the replica every INTERVAL seconds")
+    book_replicate_parser.set_defaults(func=parse_book_replicate)
+
+    ####
+
+    http_parser = command_parser.add_parser('http')
+    http_parser.add_argument("--host", type=str, default='127.0.0.1')
+    http_parser.add_argument("--port", type=int, default=8080)
+    http_parser.add_argument("--batch-size", type=int, default=100,
+        help="save after this many mutations")
+    http_parser.add_argument("--batch-quiet-ms", type=int, default=200,
+        help="save after this many milliseconds without a mutation")
+    http_parser.set_defaults(func=parse_http)
+
+    ####
+
+    report_parser = command_parser.add_parser('report')
+    report_subparsers = report_parser.add_subparsers()
+
+    report_trial_balance_parser = report_subparsers.add_parser('trial-balance')
+    report_trial_balance_parser.add_argument("--as-of", type=str, required=True)
+    report_trial_balance_parser.add_argument("--format", type=str,
+        help="json, csv or text")
+    report_trial_balance_parser.add_argument("--report-currency", type=str,
+        help="restate every account in this currency using the price database")
+    report_trial_balance_parser.add_argument("--workers", type=int, default=1,
+        help="the number of processes to shard the report over")
+    report_trial_balance_parser.set_defaults(func=parse_report_trial_balance)
+
+    report_pnl_parser = report_subparsers.add_parser('pnl')
+    report_pnl_parser.add_argument("--from", dest="date_from", type=str, required=True)
+    report_pnl_parser.add_argument("--to", dest="date_to", type=str, required=True)
+    report_pnl_parser.add_argument("--by", type=str, choices=['month'],
+        help="split the report into a column per month")
+    report_pnl_parser.add_argument("--format", type=str,
+        help="json, csv or text")
+    report_pnl_parser.add_argument("--report-currency", type=str,
+        help="restate every account in this currency using the price database")
+    report_pnl_parser.add_argument("--workers", type=int, default=1,
+        help="the number of processes to shard the report over")
+    report_pnl_parser.set_defaults(func=parse_report_pnl)
+
+    ####
+
+    statements_parser = command_parser.add_parser('statements')
+    statements_parser.add_argument("--as-of", type=str, required=True)
+    statements_parser.add_argument("--out", type=str, required=True,
+        help="the directory to write a statement per customer into")
+    statements_parser.add_argument("--format", type=str, default='text',
+        choices=['text', 'html', 'pdf'])
+    statements_parser.add_argument("--template", type=str,
+        help="a template file to use instead of the built in one")
+    statements_parser.add_argument("--workers", type=int, default=os.cpu_count(),
+        help="the number of processes rendering statements")
+    statements_parser.set_defaults(func=parse_statements)
+
+    ####
+
+    snapshot_parser = command_parser.add_parser('snapshot')
+    snapshot_subparsers = snapshot_parser.add_subparsers()
+
+    snapshot_create_parser = snapshot_subparsers.add_parser('create')
+    snapshot_create_parser.add_argument("--out", type=str, required=True)
+    snapshot_create_parser.set_defaults(func=parse_snapshot_create)
+
+    ####
+
+    diff_parser = command_parser.add_parser('diff')
+    diff_parser.add_argument("book_a", type=str, help="a book or snapshot")
+    diff_parser.add_argument("book_b", type=str, help="a book or snapshot")
+    diff_parser.add_argument("--format", type=str)
+    diff_parser.set_defaults(func=parse_diff)
+
+    ####
+
+    watch_parser = command_parser.add_parser('watch')
+    watch_parser.add_argument("--on-change", type=str,
+        help="a shell command to run after each change, with GNCLI_BOOK set")
+    watch_parser.add_argument("--debounce-ms", type=int, default=500,
+        help="how long the book must be quiet before a change is handled")
+    watch_parser.add_argument("--poll-interval", type=float, default=1.0,
+        help="seconds between checks when inotify is not available")
+    watch_parser.set_defaults(func=parse_watch)
+
+    ####
+
+    completion_parser = command_parser.add_parser('completion')
+    completion_subparsers = completion_parser.add_subparsers()
+
+    for shell in ['bash', 'zsh']:
+        completion_shell_parser = completion_subparsers.add_parser(shell)
+        completion_shell_parser.set_defaults(func=parse_completion_script, shell=shell,
+            parser=parser)
+
+    completion_refresh_parser = completion_subparsers.add_parser('refresh')
+    completion_refresh_parser.set_defaults(func=parse_completion_refresh)
+
+    ####
+
+    bench_parser = command_parser.add_parser('bench')
+    bench_subparsers = bench_parser.add_subparsers()
+
+    bench_records_parser = bench_subparsers.add_parser('records')
+    bench_records_parser.add_argument("--kind", type=str, default='invoices',
+        choices=['invoices', 'splits'])
+    bench_records_parser.set_defaults(func=parse_bench_records)
+
     ####
 
     guestpost_parser = command_parser.add_parser('guestpost')